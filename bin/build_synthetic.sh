@@ -0,0 +1,27 @@
+#!/usr/bin/env bash
+
+# Builds a synthetic dataset in the format of Polyvore Outfits with generated features
+# Builds the training dataset, validation FITB, test FITB and categories file
+
+TFRECORD_TEMPLATE="data/processed/tfrecords/synthetic-features-train-{0:03}-{1}.tfrecord"
+CATEGORY_FILE="data/processed/synthetic-categories.csv"
+
+python -m "src.data.build_synthetic_dataset" \
+  --schema "po" \
+  --with-features \
+  --outfit-count 100000 \
+  --item-count 200000 \
+  --tfrecord-template "${TFRECORD_TEMPLATE}" \
+  --shard-count 10 \
+  --category-file "${CATEGORY_FILE}" \
+  --fitb-output-path "data/processed/tfrecords/synthetic-fitb-features-valid.tfrecord" \
+  --catalog-seed 1 \
+  --seed 1
+
+python -m "src.data.build_synthetic_dataset" \
+  --schema "po" \
+  --with-features \
+  --item-count 200000 \
+  --fitb-output-path "data/processed/tfrecords/synthetic-fitb-features-test.tfrecord" \
+  --catalog-seed 1 \
+  --seed 2
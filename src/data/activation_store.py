@@ -0,0 +1,44 @@
+import numpy as np
+import tensorflow as tf
+import src.data.input_pipeline as input_pipeline
+from src.data.image_cache import MemmapItemCache
+
+
+class ActivationStore(MemmapItemCache):
+    """
+    Disk-backed store of CNN activations at the boundary of the frozen layers
+
+    The frozen layers of the CNN (the trunk) are never trained, so their output for an image is always the same.
+    The store runs the trunk once per image and keeps the activations, the training then runs only the fine-tuned
+    layers on top of them.
+    """
+
+    def __init__(self, cache_dir: str, trunk: tf.keras.Model, dtype="float16", initial_capacity: int = 10000,
+                 flush_every: int = 1000):
+        """
+        Open or create the store
+
+        Args:
+            cache_dir: Directory with the store files
+            trunk: Model that maps preprocessed images to the activations, the input and output shapes must be
+                fully defined
+            dtype: "float16" (half of the disk space) or "float32"
+            initial_capacity: Number of activations to allocate space for when creating a new store
+            flush_every: Number of inserted activations after which the index is written to the disk
+        """
+        self.trunk = trunk
+        self.image_size = trunk.input_shape[1]
+        activation_shape = trunk.output_shape[1:]
+        dtype = np.dtype(dtype)
+        # Activations of different trunks or precisions must not be mixed
+        name = "activations-{}-{}-{}".format(trunk.output_names[0], self.image_size, dtype.name)
+        super(ActivationStore, self).__init__(cache_dir, name + ".bin", name + "-index.npy", activation_shape, dtype,
+                                              initial_capacity, flush_every)
+        self._run_trunk = tf.function(lambda images: self.trunk(images, training=False), input_signature=[
+            tf.TensorSpec([None, self.image_size, self.image_size, 3], tf.float32)])
+
+    def compute(self, raw_items) -> np.ndarray:
+        images = [input_pipeline.decode_img(raw_image, self.image_size) for raw_image in raw_items]
+        images = tf.stack(images)
+        activations = self._run_trunk(images)
+        return tf.cast(activations, self.dtype).numpy()
@@ -0,0 +1,197 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+import tensorflow as tf
+import src.data.input_pipeline as input_pipeline
+import src.models.encoder.utils as utils
+
+
+def _batch_stats(batch, pipeline):
+    """
+    Count outfits, items and bytes of one batch
+
+    The bytes are given by the shapes and only the categories are counted, so the batch is not copied.
+
+    Args:
+        batch: one element of the benchmarked dataset
+        pipeline: "train" or "fitb"
+
+    Returns: (outfit_count, item_count, byte_count)
+
+    """
+    tensors = tf.nest.flatten(batch)
+    byte_count = sum(tensor.shape.num_elements() * tensor.dtype.size for tensor in tensors)
+    if pipeline == "train":
+        item_count = int(tf.math.count_nonzero(tensors[1]))
+    else:
+        # Inputs and targets of the FITB questions
+        item_count = int(tf.math.count_nonzero(tensors[1]) + tf.math.count_nonzero(tensors[3]))
+    return int(tensors[1].shape[0]), item_count, byte_count
+
+
+def _peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux, every config runs in its own process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark(dataset: tf.data.Dataset, pipeline: str, steps: int, warmup_steps: int = 0):
+    """
+    Iterate the dataset and measure its throughput
+
+    The sizes of the timed batches are counted during the iteration from their shapes and categories.
+
+    Args:
+        dataset: dataset to benchmark
+        pipeline: "train" or "fitb"
+        steps: number of measured batches
+        warmup_steps: number of batches that are read after the first batch and excluded from the throughput
+
+    Returns: dict with the measured values
+
+    """
+    measured_steps = 0
+    outfits = 0
+    items = 0
+    byte_count = 0
+
+    start = time.perf_counter()
+    iterator = iter(dataset)
+    next(iterator)
+    first_batch_latency = time.perf_counter() - start
+
+    for _ in range(warmup_steps):
+        next(iterator, None)
+
+    start = time.perf_counter()
+    for batch in itertools.islice(iterator, steps):
+        batch_outfits, batch_items, batch_bytes = _batch_stats(batch, pipeline)
+        outfits += batch_outfits
+        items += batch_items
+        byte_count += batch_bytes
+        measured_steps += 1
+    elapsed = time.perf_counter() - start
+    peak_rss = _peak_rss_mb()
+
+    return {
+        "steps": measured_steps,
+        "elapsed_sec": elapsed,
+        "outfits_per_sec": outfits / elapsed if elapsed > 0 else 0,
+        "items_per_sec": items / elapsed if elapsed > 0 else 0,
+        "bytes_per_sec": byte_count / elapsed if elapsed > 0 else 0,
+        "first_batch_latency_sec": first_batch_latency,
+        "peak_rss_mb": peak_rss
+    }
+
+
+def build_dataset(config: dict) -> tf.data.Dataset:
+    """
+    Build the benchmarked dataset
+
+    Args:
+        config: dict with the settings of the pipeline
+
+    Returns: tf.data.Dataset
+
+    """
+    lookup = None
+    if config["with_category_grouping"]:
+        if config["category_file"] is not None:
+            lookup = utils.build_po_category_lookup_table(config["category_file"])
+        else:
+            lookup = utils.build_mp_category_lookup_table()
+
+    if config["pipeline"] == "train":
+        dataset = input_pipeline.get_training_dataset(config["files"], config["batch_size"], config["with_features"],
+                                                      lookup, cache=config["cache"],
+                                                      num_parallel_calls=config["num_parallel_calls"],
+                                                      bucket_boundaries=config["bucket_boundaries"],
+                                                      image_size=config["image_size"])
+    else:
+        # The FITB outfits are padded to the lengths of the buckets as with XLA
+        bucket_lengths = None
+        if config["bucket_boundaries"] is not None:
+            bucket_lengths = [boundary - 1 for boundary in config["bucket_boundaries"]]
+        dataset = input_pipeline.get_fitb_dataset(config["files"], config["with_features"], lookup, True,
+                                                  cache=config["cache"],
+                                                  num_parallel_calls=config["num_parallel_calls"],
+                                                  bucket_lengths=bucket_lengths,
+                                                  image_size=config["image_size"])
+        # The questions are batched as in the evaluation
+        dataset = dataset.padded_batch(config["batch_size"])
+
+    # Repeat the dataset, so the number of steps is not limited by the dataset size
+    return dataset.repeat()
+
+
+def _run_config(config: dict, steps: int, warmup_steps: int) -> dict:
+    """Benchmark one config, runs in a separate process"""
+    return benchmark(build_dataset(config), config["pipeline"], steps, warmup_steps)
+
+
+def main():
+    """
+    Measure the throughput of the input pipelines without the model
+
+    Every combination of the listed settings is benchmarked in a new process, so the peak memory is measured
+    for each of them. The results are printed as JSON
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=str, nargs="+", help="Paths to dataset files", required=True)
+    parser.add_argument("--pipeline", type=str, help="Benchmarked pipeline", choices=["train", "fitb"],
+                        default="train")
+    parser.add_argument("--with-features", help="The files contain extracted features (else images)",
+                        type=utils.str_to_bool, default=True)
+    parser.add_argument("--image-size", type=int, help="Width and height of the decoded images", default=299)
+    parser.add_argument("--category-file", type=str, help="Path to polyvore outfits categories")
+    parser.add_argument("--with-category-grouping", type=utils.str_to_bool, nargs="+", default=[True],
+                        help="Categories are mapped into high-level groups")
+    parser.add_argument("--cache", type=utils.str_to_bool, nargs="+", default=[True],
+                        help="Cache the parsed outfits in memory")
+    parser.add_argument("--num-parallel-calls", type=int, nargs="+", default=[tf.data.experimental.AUTOTUNE],
+                        help="Number of outfits parsed in parallel (-1 for autotune)")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[96],
+                        help="Batch size (number of questions for the FITB pipeline)")
+    parser.add_argument("--bucket-boundaries", type=int, nargs="+",
+                        help="Outfit length boundaries of the buckets")
+    parser.add_argument("--bucketing", type=utils.str_to_bool, nargs="+", default=[False],
+                        help="Batch outfits of similar lengths (FITB outfits are padded to the bucket lengths)")
+    parser.add_argument("--steps", type=int, help="Number of measured batches", default=100)
+    parser.add_argument("--warmup-steps", type=int, help="Number of batches excluded from the measurement", default=0)
+    parser.add_argument("--output", type=str, help="Path to an output .json file")
+
+    args = parser.parse_args()
+
+    results = []
+    for grouping, cache, parallel_calls, batch_size, bucketing in itertools.product(
+            args.with_category_grouping, args.cache, args.num_parallel_calls, args.batch_size, args.bucketing):
+        config = {
+            "pipeline": args.pipeline,
+            "files": args.files,
+            "with_features": args.with_features,
+            "image_size": args.image_size,
+            "category_file": args.category_file,
+            "with_category_grouping": grouping,
+            "cache": cache,
+            "num_parallel_calls": parallel_calls,
+            "batch_size": batch_size,
+            "bucket_boundaries": (args.bucket_boundaries or [4, 6, 8, 10]) if bucketing else None,
+        }
+        # A spawned process doesn't inherit the memory of the previous configs
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(_run_config, config, args.steps, args.warmup_steps).result()
+        del config["files"]
+        result["config"] = config
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ def main():
     parser.add_argument("--tfrecord-template", type=str, help="Template for .tfrecord file names", required=True)
     parser.add_argument("--shard-count", type=int, help="Number of .tfrecord files", required=True)
     parser.add_argument("--with-features", help="With CNN features extracted", action='store_true')
+    parser.add_argument("--image-size", type=int, help="Width and height of the images the features are extracted "
+                                                     "from", default=299)
 
     args = parser.parse_args()
 
@@ -26,7 +28,7 @@ def main():
 
     print("Arguments parsed", flush=True)
 
-    examples = process_dataset(dataset_root, dataset_filename, with_features=with_features)
+    examples = process_dataset(dataset_root, dataset_filename, with_features=with_features, image_size=args.image_size)
 
     print("Processed " + str(len(examples)) + " examples", flush=True)
 
@@ -53,7 +55,8 @@ def main():
     print("Saved the dataset successfully", flush=True)
 
 
-def process_dataset(dataset_root: str, dataset_filename: str, with_features: bool = False, model_path: str = None):
+def process_dataset(dataset_root: str, dataset_filename: str, with_features: bool = False, model_path: str = None,
+                    image_size: int = 299):
     """
     Create list of Sequence Examples from the dataset
 
@@ -62,6 +65,7 @@ def process_dataset(dataset_root: str, dataset_filename: str, with_features: boo
         dataset_filename: Filename of the dataset file
         with_features: bool whether use CNN to extract features (or use raw images)
         model_path: path to a CNN keras model to use for extraction (IncpetionV3 is used if None)
+        image_size: width and height of the images the features are extracted from
 
     Returns: List of SequenceExample
 
@@ -92,7 +96,7 @@ def process_dataset(dataset_root: str, dataset_filename: str, with_features: boo
 
                 image_path = Path(dataset_root, "images", str(set_id), str(item["index"]) + ".jpg")
                 if with_features:
-                    features = utils.extract_features(model, image_path)
+                    features = utils.extract_features(model, image_path, image_size)
                     images.append(features)
                 else:
                     with open(image_path, "rb") as img_file:
@@ -105,22 +109,7 @@ def process_dataset(dataset_root: str, dataset_filename: str, with_features: boo
                 outfits_disposed = outfits_disposed + 1
                 continue
 
-            if with_features:
-                outfit_features = {
-                    "categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in categories]),
-                    "features": tf.train.FeatureList(
-                        feature=[tf.train.Feature(float_list=tf.train.FloatList(value=f)) for f in images])
-                }
-            else:
-                outfit_features = {
-                    "categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in categories]),
-                    "images": tf.train.FeatureList(feature=[utils.bytes_feature(f) for f in images])
-                }
-
-            feature_lists = tf.train.FeatureLists(feature_list=outfit_features)
-
-            example = tf.train.SequenceExample(feature_lists=feature_lists)
-            examples.append(example.SerializeToString())
+            examples.append(utils.outfit_example(categories, images, with_features))
 
     print("Disposed " + str(total_disposed) + " products")
     print("Disposed " + str(outfits_disposed) + " outfits")
@@ -16,6 +16,8 @@ def main():
     parser.add_argument("--output-path", type=str, help="Path to output file", required=True)
     parser.add_argument("--fitb-file", type=str, help="Filename of FITB .json file", required=True)
     parser.add_argument("--with-features", help="With CNN features extracted", action='store_true')
+    parser.add_argument("--image-size", type=int, help="Width and height of the images the features are extracted "
+                                                     "from", default=299)
 
     args = parser.parse_args()
 
@@ -25,7 +27,7 @@ def main():
     output_path = args.output_path
     fitb_filename = args.fitb_file
 
-    examples = build_fitb(dataset_root, dataset_filename, with_features, fitb_filename)
+    examples = build_fitb(dataset_root, dataset_filename, with_features, fitb_filename, args.image_size)
     with tf.io.TFRecordWriter(output_path) as writer:
         for i in range(len(examples)):
             writer.write(examples[i])
@@ -33,7 +35,8 @@ def main():
     print("Saved the fitb successfully", flush=True)
 
 
-def build_fitb(dataset_root: str, dataset_filename: str, with_features: bool, fitb_filename: str):
+def build_fitb(dataset_root: str, dataset_filename: str, with_features: bool, fitb_filename: str,
+               image_size: int = 299):
     """
     Create list of tf.SequenceExample that represents the fill-in-the-blank task
 
@@ -42,6 +45,7 @@ def build_fitb(dataset_root: str, dataset_filename: str, with_features: bool, fi
         dataset_filename: Dataset filename
         with_features: bol whether to use CNN to extract features
         fitb_filename: Filename of the FITB file
+        image_size: Width and height of the images the features are extracted from
 
     Returns: List of tf.SequenceExample that represent FITB samples
 
@@ -61,7 +65,7 @@ def build_fitb(dataset_root: str, dataset_filename: str, with_features: bool, fi
             for item in outfit["items"]:
                 image_path = Path(dataset_root, "images", str(set_id), str(item["index"]) + ".jpg")
                 if with_features:
-                    features = utils.extract_features(model, image_path)
+                    features = utils.extract_features(model, image_path, image_size)
                     items.update({(set_id, item["index"]): (features, item["categoryid"])})
                 else:
                     with open(image_path, "rb") as img_file:
@@ -98,29 +102,8 @@ def build_fitb(dataset_root: str, dataset_filename: str, with_features: bool, fi
                 target_categories.append(item_category)
                 pos += 1
 
-            if with_features:
-                question_features = {
-                    "input_categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in input_categories]),
-                    "inputs": tf.train.FeatureList(
-                        feature=[tf.train.Feature(float_list=tf.train.FloatList(value=f)) for f in inputs]),
-                    "target_categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in target_categories]),
-                    "targets": tf.train.FeatureList(
-                        feature=[tf.train.Feature(float_list=tf.train.FloatList(value=f)) for f in targets])
-                }
-            else:
-                question_features = {
-                    "input_categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in input_categories]),
-                    "inputs": tf.train.FeatureList(feature=[utils.bytes_feature(f) for f in inputs]),
-                    "target_categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in target_categories]),
-                    "targets": tf.train.FeatureList(feature=[utils.bytes_feature(f) for f in targets])
-                }
-            feature_lists = tf.train.FeatureLists(feature_list=question_features)
-            context = {
-                "target_position": utils.int64_feature(target_pos)
-            }
-            context = tf.train.Features(feature=context)
-            example = tf.train.SequenceExample(feature_lists=feature_lists, context=context)
-            examples.append(example.SerializeToString())
+            examples.append(utils.fitb_example(inputs, input_categories, targets, target_categories, target_pos,
+                                               with_features))
         return examples
 
 
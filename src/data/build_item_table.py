@@ -0,0 +1,75 @@
+import argparse
+import hashlib
+import numpy as np
+import src.data.input_pipeline as input_pipeline
+import src.models.encoder.quantization as quantization
+
+
+def build_item_table(filenames, dtype="float16"):
+    """
+    Collect the distinct items of a training dataset with features
+
+    The items are identified by their feature vectors, so the same item in different outfits is counted once.
+
+    Args:
+        filenames: Paths to the training .tfrecord files with features
+        dtype: dtype of the stored features, "int8" features are collected as float16 and quantized by
+            save_item_table
+
+    Returns: (features, categories, counts) ndarrays of shapes [item_count, feature_dim], [item_count], [item_count]
+
+    """
+    index = {}
+    features = []
+    categories = []
+    counts = []
+
+    for outfit_features, outfit_categories in input_pipeline.get_dataset(filenames, True):
+        for item_features, category in zip(outfit_features.numpy(), outfit_categories.numpy()):
+            key = hashlib.blake2b(item_features.tobytes(), digest_size=8).digest()
+            slot = index.get(key)
+            if slot is None:
+                index[key] = len(features)
+                features.append(item_features.astype(dtype if dtype != "int8" else np.float16))
+                categories.append(category)
+                counts.append(1)
+            else:
+                counts[slot] += 1
+
+    return np.stack(features), np.asarray(categories, dtype=np.int64), np.asarray(counts, dtype=np.int64)
+
+
+def save_item_table(path: str, features, categories, counts, dtype="float16"):
+    """
+    Save the item table to an .npz file, the int8 features are stored with the scales of their dimensions
+    """
+    if dtype == "int8":
+        quantizer = quantization.ScalarQuantizer()
+        quantizer.fit(features)
+        np.savez(path, features=quantizer.encode(features), feature_scale=quantizer.scale, categories=categories,
+                 counts=counts)
+    else:
+        np.savez(path, features=features, categories=categories, counts=counts)
+
+
+def main():
+    """
+    Build the table of the catalog items used for sampling of the negatives in training
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=str, nargs="+", help="Paths to training dataset files with features",
+                        required=True)
+    parser.add_argument("--output-path", type=str, help="Path to the output .npz file", required=True)
+    parser.add_argument("--dtype", type=str, help="Dtype of the stored features",
+                        choices=["int8", "float16", "float32"],
+                        default="float16")
+
+    args = parser.parse_args()
+
+    features, categories, counts = build_item_table(args.files, args.dtype)
+    save_item_table(args.output_path, features, categories, counts, args.dtype)
+    print("Saved " + str(len(categories)) + " items", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ def main():
     parser.add_argument("--tfrecord-template", type=str, help="Template for .tfrecord file names", required=True)
     parser.add_argument("--shard-count", type=int, help="Number of .tfrecord files", required=True)
     parser.add_argument("--with-features", help="With CNN features extracted", action='store_true')
+    parser.add_argument("--image-size", type=int, help="Width and height of the images the features are extracted "
+                                                     "from", default=299)
 
     args = parser.parse_args()
 
@@ -25,7 +27,7 @@ def main():
     with_features = args.with_features
     print("Arguments parsed", flush=True)
 
-    examples = process_dataset(dataset_root, dataset_filepath, with_features=with_features)
+    examples = process_dataset(dataset_root, dataset_filepath, with_features=with_features, image_size=args.image_size)
 
     print("Processed " + str(len(examples)) + " examples", flush=True)
 
@@ -52,7 +54,7 @@ def main():
     print("Saved the dataset successfully", flush=True)
 
 
-def process_dataset(dataset_root, dataset_filepath, with_features: bool = False, model_path=None):
+def process_dataset(dataset_root, dataset_filepath, with_features: bool = False, model_path=None, image_size=299):
     with open(Path(dataset_root, "polyvore_item_metadata.json")) as json_file:
         metadata = json.load(json_file)
     with open(Path(dataset_filepath)) as json_file:
@@ -75,7 +77,7 @@ def process_dataset(dataset_root, dataset_filepath, with_features: bool = False,
                 ids.append(int(item["item_id"]))
                 image_path = Path(dataset_root, "images", str(item["item_id"]) + ".jpg")
                 if with_features:
-                    features = utils.extract_features(model, image_path)
+                    features = utils.extract_features(model, image_path, image_size)
                     images.append(features)
                 else:
                     with open(image_path, "rb") as img_file:
@@ -84,24 +86,7 @@ def process_dataset(dataset_root, dataset_filepath, with_features: bool = False,
 
                 categories.append(int(metadata[item["item_id"]]["category_id"]))
 
-            if with_features:
-                outfit_features = {
-                    "categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in categories]),
-                    "ids": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in ids]),
-                    "features": tf.train.FeatureList(
-                        feature=[tf.train.Feature(float_list=tf.train.FloatList(value=f)) for f in images])
-                }
-            else:
-                outfit_features = {
-                    "categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in categories]),
-                    "ids": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in ids]),
-                    "images": tf.train.FeatureList(feature=[utils.bytes_feature(f) for f in images])
-                }
-
-            feature_lists = tf.train.FeatureLists(feature_list=outfit_features)
-
-            example = tf.train.SequenceExample(feature_lists=feature_lists)
-            examples.append(example.SerializeToString())
+            examples.append(utils.outfit_example(categories, images, with_features, ids))
 
     return examples
 
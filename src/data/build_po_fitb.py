@@ -13,6 +13,8 @@ def main():
     parser.add_argument("--output-path", type=str, help="Path to output file", required=True)
     parser.add_argument("--fitb-file", type=str, help="Filepath of FITB .json file", required=True)
     parser.add_argument("--with-features", help="With CNN features extracted", action='store_true')
+    parser.add_argument("--image-size", type=int, help="Width and height of the images the features are extracted "
+                                                     "from", default=299)
 
     args = parser.parse_args()
 
@@ -22,7 +24,7 @@ def main():
     output_path = args.output_path
     fitb_file = args.fitb_file
 
-    examples = build_fitb(dataset_root, dataset_file, with_features, fitb_file)
+    examples = build_fitb(dataset_root, dataset_file, with_features, fitb_file, args.image_size)
     with tf.io.TFRecordWriter(output_path) as writer:
         for i in range(len(examples)):
             writer.write(examples[i])
@@ -30,7 +32,7 @@ def main():
     print("Saved the fitb successfully", flush=True)
 
 
-def build_fitb(dataset_root, test_file, with_features, fitb_filepath):
+def build_fitb(dataset_root, test_file, with_features, fitb_filepath, image_size=299):
     with open(Path(dataset_root, "polyvore_item_metadata.json")) as json_file:
         metadata = json.load(json_file)
     with open(Path(test_file)) as json_file:
@@ -48,7 +50,7 @@ def build_fitb(dataset_root, test_file, with_features, fitb_filepath):
             for item in outfit["items"]:
                 image_path = Path(dataset_root, "images", item["item_id"] + ".jpg")
                 if with_features:
-                    features = utils.extract_features(model, image_path)
+                    features = utils.extract_features(model, image_path, image_size)
                     items.update({(set_id, item["index"]): (features, int(metadata[item["item_id"]]["category_id"]))})
                 else:
                     with open(image_path, "rb") as img_file:
@@ -85,29 +87,8 @@ def build_fitb(dataset_root, test_file, with_features, fitb_filepath):
                 target_categories.append(item_category)
                 pos += 1
 
-            if with_features:
-                question_features = {
-                    "input_categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in input_categories]),
-                    "inputs": tf.train.FeatureList(
-                        feature=[tf.train.Feature(float_list=tf.train.FloatList(value=f)) for f in inputs]),
-                    "target_categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in target_categories]),
-                    "targets": tf.train.FeatureList(
-                        feature=[tf.train.Feature(float_list=tf.train.FloatList(value=f)) for f in targets])
-                }
-            else:
-                question_features = {
-                    "input_categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in input_categories]),
-                    "inputs": tf.train.FeatureList(feature=[utils.bytes_feature(f) for f in inputs]),
-                    "target_categories": tf.train.FeatureList(feature=[utils.int64_feature(f) for f in target_categories]),
-                    "targets": tf.train.FeatureList(feature=[utils.bytes_feature(f) for f in targets])
-                }
-            feature_lists = tf.train.FeatureLists(feature_list=question_features)
-            context = {
-                "target_position": utils.int64_feature(target_pos)
-            }
-            context = tf.train.Features(feature=context)
-            example = tf.train.SequenceExample(feature_lists=feature_lists, context=context)
-            examples.append(example.SerializeToString())
+            examples.append(utils.fitb_example(inputs, input_categories, targets, target_categories, target_pos,
+                                               with_features))
         return examples
 
 
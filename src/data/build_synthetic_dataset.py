@@ -0,0 +1,259 @@
+import argparse
+import csv
+import numpy as np
+import tensorflow as tf
+import src.data.data_utils as utils
+import src.models.encoder.utils as encoder_utils
+
+# Approximate distribution of outfit lengths in Polyvore Outfits (lengths 3 to 19)
+_POLYVORE_MIN_LENGTH = 3
+_POLYVORE_LENGTH_WEIGHTS = [0.19, 0.24, 0.2, 0.14, 0.09, 0.05, 0.03, 0.02, 0.01, 0.01, 0.005, 0.005, 0.002, 0.001,
+                            0.001, 0.0005, 0.0005]
+# Weight of the lengths outside the Polyvore distribution
+_LENGTH_WEIGHT_FLOOR = 0.0001
+
+
+def polyvore_length_weights(lengths) -> np.ndarray:
+    """Get the weights of the outfit lengths from the Polyvore distribution, not normalized"""
+    weights = []
+    for length in lengths:
+        index = length - _POLYVORE_MIN_LENGTH
+        weights.append(_POLYVORE_LENGTH_WEIGHTS[index] if 0 <= index < len(_POLYVORE_LENGTH_WEIGHTS)
+                       else _LENGTH_WEIGHT_FLOOR)
+    return np.asarray(weights, dtype=np.float64)
+
+
+class SyntheticCatalog:
+    """Catalog of synthetic items with categories and visual features or fake JPEG images"""
+
+    def __init__(self, item_count: int, category_ids, category_weights, with_features: bool, feature_dim: int = 2048,
+                 pool_size: int = 1024, image_size: int = 64, seed: int = 1):
+        """
+        Generate the catalog
+
+        The features are composed of a category center and a vector from a shared pool, so the catalog doesn't need
+        to hold a vector for every item. The images are taken from a pool of random JPEG images for the same reason.
+
+        Args:
+            item_count: Number of items in the catalog
+            category_ids: List of category ids
+            category_weights: Probabilities of the categories
+            with_features: bool whether the items have feature vectors (or JPEG images)
+            feature_dim: Dimension of the feature vectors
+            pool_size: Number of distinct feature vectors or images
+            image_size: Width and height of the generated images
+            seed: Random seed
+        """
+        self.rng = np.random.default_rng(seed)
+        self.with_features = with_features
+        self.category_ids = np.asarray(category_ids, dtype=np.int64)
+        self.item_categories = self.rng.choice(self.category_ids, size=item_count, p=category_weights)
+        self.pool_size = pool_size
+
+        if with_features:
+            self._centers = {int(c): self.rng.random(feature_dim, dtype=np.float32) for c in self.category_ids}
+            self._pool = self.rng.random((pool_size, feature_dim), dtype=np.float32) * 0.5
+        else:
+            self._pool = [tf.io.encode_jpeg(self.rng.integers(0, 256, (image_size, image_size, 3), dtype=np.uint8))
+                          .numpy() for _ in range(pool_size)]
+
+        # Items of every category, used to draw FITB candidates
+        self._category_items = {}
+        order = np.argsort(self.item_categories, kind="stable")
+        sorted_categories = self.item_categories[order]
+        for category in np.unique(sorted_categories):
+            lo, hi = np.searchsorted(sorted_categories, [category, category + 1])
+            self._category_items[int(category)] = order[lo:hi]
+
+    def __len__(self):
+        return len(self.item_categories)
+
+    def item(self, item_id: int):
+        """
+        Get the item
+
+        Args:
+            item_id: Id of the item
+
+        Returns: (feature vector or JPEG bytes, category id)
+
+        """
+        category = int(self.item_categories[item_id])
+        if self.with_features:
+            return self._centers[category] + self._pool[item_id % self.pool_size], category
+        return self._pool[item_id % self.pool_size], category
+
+    def items_of_category(self, category: int):
+        return self._category_items[category]
+
+
+def zipf_weights(count: int, exponent: float) -> np.ndarray:
+    """
+    Get probabilities of ranks following Zipf's law
+
+    Args:
+        count: Number of ranks
+        exponent: Exponent of the distribution, 0 for uniform distribution
+
+    Returns: ndarray of shape [count] with probabilities
+
+    """
+    weights = 1 / np.arange(1, count + 1) ** exponent
+    return weights / weights.sum()
+
+
+def generate_outfits(catalog: SyntheticCatalog, outfit_count: int, lengths, length_weights, rng):
+    """
+    Generate outfits as lists of item ids
+
+    Args:
+        catalog: SyntheticCatalog
+        outfit_count: Number of outfits
+        lengths: List of possible outfit lengths
+        length_weights: Probabilities of the lengths
+        rng: numpy random Generator
+
+    Yields: ndarray of item ids
+
+    """
+    for _ in range(outfit_count):
+        length = rng.choice(lengths, p=length_weights)
+        yield rng.choice(len(catalog), size=length, replace=False)
+
+
+def write_training_dataset(catalog: SyntheticCatalog, outfit_count: int, lengths, length_weights,
+                           output_template: str, shard_count: int, with_ids: bool, seed: int):
+    """
+    Write the training dataset in the schema of build_dataset (or build_po_dataset with ids)
+
+    The outfits are written as they are generated, so the size of the dataset is not limited by memory.
+    """
+    rng = np.random.default_rng(seed)
+    outfits_per_file = -(-outfit_count // shard_count)
+    writer = None
+
+    for i, item_ids in enumerate(generate_outfits(catalog, outfit_count, lengths, length_weights, rng)):
+        if i % outfits_per_file == 0:
+            if writer is not None:
+                writer.close()
+            writer = tf.io.TFRecordWriter(output_template.format(i // outfits_per_file, shard_count - 1))
+
+        items, categories = zip(*[catalog.item(int(item_id)) for item_id in item_ids])
+        ids = [int(item_id) for item_id in item_ids] if with_ids else None
+        writer.write(utils.outfit_example(categories, items, catalog.with_features, ids))
+
+        if (i + 1) % 100000 == 0:
+            print("Written " + str(i + 1) + " outfits", flush=True)
+
+    if writer is not None:
+        writer.close()
+
+
+def write_fitb_dataset(catalog: SyntheticCatalog, question_count: int, lengths, length_weights, output_path: str,
+                       candidate_count: int, seed: int):
+    """
+    Write the FITB dataset in the schema of build_fitb and build_po_fitb
+
+    The negative candidates are drawn from the category of the missing item when possible.
+    """
+    rng = np.random.default_rng(seed)
+
+    with tf.io.TFRecordWriter(output_path) as writer:
+        for item_ids in generate_outfits(catalog, question_count, lengths, length_weights, rng):
+            blank = rng.integers(len(item_ids))
+            answer = int(item_ids[blank])
+            question_ids = np.delete(item_ids, blank)
+
+            inputs, input_categories = zip(*[catalog.item(int(item_id)) for item_id in question_ids])
+
+            same_category = catalog.items_of_category(int(catalog.item_categories[answer]))
+            same_category = same_category[same_category != answer]
+            if len(same_category) >= candidate_count - 1:
+                negatives = rng.choice(same_category, size=candidate_count - 1, replace=False)
+            else:
+                negatives = rng.choice(len(catalog), size=candidate_count - 1, replace=False)
+
+            target_position = int(rng.integers(candidate_count))
+            candidate_ids = list(negatives)
+            candidate_ids.insert(target_position, answer)
+            targets, target_categories = zip(*[catalog.item(int(item_id)) for item_id in candidate_ids])
+
+            writer.write(utils.fitb_example(inputs, input_categories, targets, target_categories, target_position,
+                                            catalog.with_features))
+
+
+def write_po_categories(category_ids, group_count: int, path: str):
+    """
+    Write a categories file in the format of Polyvore Outfits (category id, name, group)
+    """
+    with open(path, "w", newline="") as categories_file:
+        csv_writer = csv.writer(categories_file)
+        for category in category_ids:
+            csv_writer.writerow([category, "category-{}".format(category), "group-{}".format(category % group_count)])
+
+
+def main():
+    """
+    Generate synthetic datasets with the same schemas as the Polyvore datasets
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--schema", type=str, help="Mimicked dataset", choices=["mp", "po"], default="po")
+    parser.add_argument("--with-features", help="Generate features (else fake JPEG images)", action='store_true')
+    parser.add_argument("--outfit-count", type=int, help="Number of outfits in the training dataset", default=10000)
+    parser.add_argument("--item-count", type=int, help="Number of items in the catalog", default=10000)
+    parser.add_argument("--tfrecord-template", type=str, help="Template for training .tfrecord file names")
+    parser.add_argument("--shard-count", type=int, help="Number of training .tfrecord files", default=1)
+    parser.add_argument("--fitb-output-path", type=str, help="Path to the output FITB file")
+    parser.add_argument("--fitb-count", type=int, help="Number of FITB questions", default=1000)
+    parser.add_argument("--candidate-count", type=int, help="Number of candidates of FITB questions", default=4)
+    parser.add_argument("--min-length", type=int, help="Minimum length of the outfits", default=3)
+    parser.add_argument("--max-length", type=int, help="Maximum length of the outfits", default=19)
+    parser.add_argument("--length-weights", type=float, nargs="+",
+                        help="Relative frequencies of the outfit lengths from min-length to max-length "
+                             "(Polyvore-like by default)")
+    parser.add_argument("--category-count", type=int, help="Number of categories (po schema only)", default=150)
+    parser.add_argument("--category-group-count", type=int, help="Number of category groups (po schema only)",
+                        default=11)
+    parser.add_argument("--category-skew", type=float, help="Zipf exponent of the category frequencies", default=1.0)
+    parser.add_argument("--category-file", type=str, help="Path to the output categories file (po schema only)")
+    parser.add_argument("--feature-dim", type=int, help="Dimension of the features", default=2048)
+    parser.add_argument("--pool-size", type=int, help="Number of distinct feature vectors or images", default=1024)
+    parser.add_argument("--image-size", type=int, help="Width and height of the fake images", default=64)
+    parser.add_argument("--catalog-seed", type=int, help="Random seed of the item catalog", default=1)
+    parser.add_argument("--seed", type=int, help="Random seed of the outfits and questions", default=1)
+
+    args = parser.parse_args()
+
+    lengths = np.arange(args.min_length, args.max_length + 1)
+    if args.length_weights is not None:
+        length_weights = np.asarray(args.length_weights, dtype=np.float64)
+    else:
+        length_weights = polyvore_length_weights(lengths)
+    if len(length_weights) != len(lengths):
+        raise RuntimeError("The number of length weights must match the number of outfit lengths")
+    length_weights = length_weights / length_weights.sum()
+
+    if args.schema == "mp":
+        category_ids = [cat_id for group in encoder_utils.MP_CATEGORY_GROUPS.values() for cat_id in group]
+    else:
+        category_ids = list(range(1, args.category_count + 1))
+        if args.category_file is not None:
+            write_po_categories(category_ids, args.category_group_count, args.category_file)
+
+    catalog = SyntheticCatalog(args.item_count, category_ids, zipf_weights(len(category_ids), args.category_skew),
+                               args.with_features, args.feature_dim, args.pool_size, args.image_size, args.catalog_seed)
+    print("Generated catalog of " + str(len(catalog)) + " items", flush=True)
+
+    if args.tfrecord_template is not None:
+        write_training_dataset(catalog, args.outfit_count, lengths, length_weights, args.tfrecord_template,
+                               args.shard_count, args.schema == "po", args.seed)
+        print("Saved the dataset successfully", flush=True)
+
+    if args.fitb_output_path is not None:
+        write_fitb_dataset(catalog, args.fitb_count, lengths, length_weights, args.fitb_output_path,
+                           args.candidate_count, args.seed + 1)
+        print("Saved the fitb successfully", flush=True)
+
+
+if __name__ == "__main__":
+    main()
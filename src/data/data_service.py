@@ -0,0 +1,132 @@
+import argparse
+import subprocess
+import sys
+import tensorflow as tf
+
+
+def start_dispatcher(port: int, work_dir: str = None) -> tf.data.experimental.service.DispatchServer:
+    """
+    Start a tf.data service dispatcher
+
+    Args:
+        port: Port of the dispatcher
+        work_dir: Optional directory where the dispatcher stores its state (allows the dispatcher to be restarted)
+
+    Returns: Running DispatchServer
+
+    """
+    config = tf.data.experimental.service.DispatcherConfig(port=port, work_dir=work_dir,
+                                                           fault_tolerant_mode=work_dir is not None)
+    return tf.data.experimental.service.DispatchServer(config)
+
+
+def start_worker(dispatcher_address: str, port: int, host: str = "localhost") \
+        -> tf.data.experimental.service.WorkerServer:
+    """
+    Start a tf.data service worker
+
+    Args:
+        dispatcher_address: Address of the dispatcher without the protocol, e.g. "localhost:5050"
+        port: Port of the worker
+        host: Hostname under which the worker is reachable for the training process
+
+    Returns: Running WorkerServer
+
+    """
+    config = tf.data.experimental.service.WorkerConfig(dispatcher_address=dispatcher_address,
+                                                       worker_address="{}:{}".format(host, port),
+                                                       port=port)
+    return tf.data.experimental.service.WorkerServer(config)
+
+
+def distribute(dataset: tf.data.Dataset, service_address: str, job_name: str = None,
+               processing_mode: str = "distributed_epoch", shard_count: int = None,
+               worker_count: int = None) -> tf.data.Dataset:
+    """
+    Move the processing of the dataset to the tf.data service
+
+    With "distributed_epoch", the dispatcher hands out the input files to the workers one by one, so each
+    element is produced exactly once per epoch, but at most as many workers as there are files produce
+    elements at the same time. With "parallel_epochs", every worker processes the whole dataset, so all the
+    workers are busy, but each element is produced once per worker in an epoch. The random operations of the
+    dataset must then not have fixed seeds, else all the workers produce the same sequence of elements.
+
+    Args:
+        dataset: Dataset to distribute
+        service_address: Address of the dispatcher, e.g. "grpc://localhost:5050"
+        job_name: Optional name of the job, the consumers with the same job name share the elements
+        processing_mode: "distributed_epoch" or "parallel_epochs"
+        shard_count: Optional number of the input files, used to check the distributed_epoch mode
+        worker_count: Optional number of the tf.data service workers, used to check the distributed_epoch mode
+
+    Returns: Dataset that reads the elements from the tf.data service workers
+
+    """
+    if processing_mode not in ["distributed_epoch", "parallel_epochs"]:
+        raise RuntimeError("Unexpected tf.data service processing mode " + processing_mode)
+
+    if processing_mode == "distributed_epoch" and shard_count is not None and worker_count is not None \
+            and shard_count < worker_count:
+        print("Warning: the dataset has {} files, so only {} of the {} tf.data service workers are used, split the "
+              "dataset into more files or use the parallel_epochs mode".format(shard_count, shard_count, worker_count),
+              flush=True)
+
+    return dataset.apply(tf.data.experimental.service.distribute(
+        processing_mode=processing_mode, service=service_address, job_name=job_name))
+
+
+def _run_local(port: int, worker_count: int, first_worker_port: int):
+    """Start a dispatcher and worker processes on localhost, block until interrupted"""
+    dispatcher = start_dispatcher(port)
+    print("Dispatcher running at grpc://localhost:{}".format(port), flush=True)
+
+    workers = []
+    for i in range(worker_count):
+        workers.append(subprocess.Popen([sys.executable, "-m", "src.data.data_service",
+                                         "--mode", "worker",
+                                         "--dispatcher-address", "localhost:{}".format(port),
+                                         "--port", str(first_worker_port + i)]))
+    try:
+        dispatcher.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+
+def main():
+    """
+    Run tf.data service processes that take over the input processing from the training process
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, help="Type of the process to run", choices=["dispatcher", "worker", "local"],
+                        required=True)
+    parser.add_argument("--port", type=int, help="Port of the dispatcher or the worker", default=5050)
+    parser.add_argument("--dispatcher-address", type=str, help="Address of the dispatcher (worker mode only)",
+                        default="localhost:5050")
+    parser.add_argument("--worker-host", type=str, help="Hostname of the worker (worker mode only)",
+                        default="localhost")
+    parser.add_argument("--work-dir", type=str, help="Directory for the dispatcher state (dispatcher mode only)")
+    parser.add_argument("--worker-count", type=int, help="Number of local workers (local mode only)", default=2)
+    parser.add_argument("--first-worker-port", type=int, help="Port of the first local worker (local mode only)",
+                        default=5051)
+
+    args = parser.parse_args()
+
+    if args.mode == "dispatcher":
+        server = start_dispatcher(args.port, args.work_dir)
+        print("Dispatcher running at grpc://localhost:{}".format(args.port), flush=True)
+        server.join()
+    elif args.mode == "worker":
+        server = start_worker(args.dispatcher_address, args.port, args.worker_host)
+        print("Worker running at {}:{}".format(args.worker_host, args.port), flush=True)
+        server.join()
+    else:
+        _run_local(args.port, args.worker_count, args.first_worker_port)
+
+
+if __name__ == "__main__":
+    main()
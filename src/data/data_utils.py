@@ -19,18 +19,81 @@ def int64_feature(value):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
 
-def extract_features(model: tf.keras.Model, path: str) -> np.ndarray:
+def float_list_feature(values):
+    """Returns a float_list from a sequence of floats (e.g. a feature vector)."""
+    return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+
+def outfit_example(categories, items, with_features: bool, ids=None) -> bytes:
+    """
+    Serialize an outfit of the training dataset
+
+    Args:
+        categories: List of category ids
+        items: List of feature vectors or JPEG bytes
+        with_features: bool whether the items are feature vectors (or JPEG images)
+        ids: Optional list of item ids
+
+    Returns: Serialized SequenceExample
+
+    """
+    outfit_features = {
+        "categories": tf.train.FeatureList(feature=[int64_feature(f) for f in categories])
+    }
+    if ids is not None:
+        outfit_features["ids"] = tf.train.FeatureList(feature=[int64_feature(f) for f in ids])
+    if with_features:
+        outfit_features["features"] = tf.train.FeatureList(feature=[float_list_feature(f) for f in items])
+    else:
+        outfit_features["images"] = tf.train.FeatureList(feature=[bytes_feature(f) for f in items])
+
+    feature_lists = tf.train.FeatureLists(feature_list=outfit_features)
+    return tf.train.SequenceExample(feature_lists=feature_lists).SerializeToString()
+
+
+def fitb_example(inputs, input_categories, targets, target_categories, target_position: int,
+                 with_features: bool) -> bytes:
+    """
+    Serialize a question of the FITB task
+
+    Args:
+        inputs: List of feature vectors or JPEG bytes of the question items
+        input_categories: List of category ids of the question items
+        targets: List of feature vectors or JPEG bytes of the candidates
+        target_categories: List of category ids of the candidates
+        target_position: Position of the correct candidate
+        with_features: bool whether the items are feature vectors (or JPEG images)
+
+    Returns: Serialized SequenceExample
+
+    """
+    item_feature = float_list_feature if with_features else bytes_feature
+    question_features = {
+        "input_categories": tf.train.FeatureList(feature=[int64_feature(f) for f in input_categories]),
+        "inputs": tf.train.FeatureList(feature=[item_feature(f) for f in inputs]),
+        "target_categories": tf.train.FeatureList(feature=[int64_feature(f) for f in target_categories]),
+        "targets": tf.train.FeatureList(feature=[item_feature(f) for f in targets])
+    }
+    feature_lists = tf.train.FeatureLists(feature_list=question_features)
+    context = tf.train.Features(feature={
+        "target_position": int64_feature(target_position)
+    })
+    return tf.train.SequenceExample(feature_lists=feature_lists, context=context).SerializeToString()
+
+
+def extract_features(model: tf.keras.Model, path: str, image_size: int = 299) -> np.ndarray:
     """
     Extract features via CNN
 
     Args:
         model: CNN to use for extraction
         path: Path to img
+        image_size: Width and height the image is resized to
 
     Returns: ndarray
 
     """
-    img = tf.keras.preprocessing.image.load_img(path, target_size=(299, 299))
+    img = tf.keras.preprocessing.image.load_img(path, target_size=(image_size, image_size))
     img_array = tf.keras.preprocessing.image.img_to_array(img)
     img_array = np.expand_dims(img_array, axis=0)
     img_array = tf.keras.applications.inception_v3.preprocess_input(img_array)
@@ -0,0 +1,185 @@
+import abc
+import atexit
+import hashlib
+import threading
+from pathlib import Path
+import numpy as np
+import tensorflow as tf
+import src.data.input_pipeline as input_pipeline
+
+
+class MemmapItemCache(abc.ABC):
+    """
+    Disk-backed cache of fixed-shape arrays computed from raw items (JPEG images)
+
+    The arrays are stored as raw blobs in a memory-mapped file. Every array is indexed by an item key - a 64-bit
+    fingerprint of the raw item - so the same item hits the cache regardless of the dataset it comes from
+    (training or FITB records, Maryland Polyvore or Polyvore Outfits). The cache is populated on the first epoch
+    and can be shared across runs, but only one process should write to the cache at a time.
+
+    Subclasses implement compute, which produces the arrays of the items that are not cached.
+    """
+
+    def __init__(self, cache_dir: str, data_name: str, index_name: str, item_shape, dtype,
+                 initial_capacity: int = 10000, flush_every: int = 1000):
+        """
+        Open or create the cache
+
+        Args:
+            cache_dir: Directory with the cache files
+            data_name: Name of the file with the arrays
+            index_name: Name of the .npy file with the item keys
+            item_shape: Shape of one cached array
+            dtype: numpy dtype of the cached arrays
+            initial_capacity: Number of arrays to allocate space for when creating a new cache
+            flush_every: Number of inserted arrays after which the index is written to the disk
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.item_shape = tuple(item_shape)
+        self.dtype = np.dtype(dtype)
+        self.flush_every = flush_every
+        self.data_path = Path(self.cache_dir, data_name)
+        self.index_path = Path(self.cache_dir, index_name)
+
+        self._lock = threading.Lock()
+        self._unflushed = 0
+
+        if self.index_path.exists():
+            keys = np.load(str(self.index_path))
+        else:
+            keys = np.zeros((0,), dtype=np.int64)
+        self._index = {int(key): slot for slot, key in enumerate(keys)}
+
+        capacity = max(initial_capacity, len(self._index))
+        if self.data_path.exists():
+            capacity = max(capacity, self.data_path.stat().st_size // self._item_bytes)
+        self._open(capacity)
+
+        atexit.register(self.flush)
+
+    @property
+    def _item_bytes(self):
+        return int(np.prod(self.item_shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return len(self._index)
+
+    def _open(self, capacity: int):
+        """Map the data file with the given capacity, the file is extended if needed"""
+        size = capacity * self._item_bytes
+        with open(str(self.data_path), "ab") as data_file:
+            if data_file.tell() < size:
+                data_file.truncate(size)
+        self._capacity = capacity
+        self._data = np.memmap(str(self.data_path), dtype=self.dtype, mode="r+", shape=(capacity,) + self.item_shape)
+
+    def flush(self):
+        """Write the cached arrays and the index to the disk"""
+        with self._lock:
+            self._data.flush()
+            keys = np.zeros((len(self._index),), dtype=np.int64)
+            for key, slot in self._index.items():
+                keys[slot] = key
+            np.save(str(self.index_path), keys)
+            self._unflushed = 0
+
+    @staticmethod
+    def item_key(raw_item: bytes) -> int:
+        """
+        Get the key of an item
+
+        Args:
+            raw_item: bytes of the item, e.g. JPEG image
+
+        Returns: 64-bit fingerprint of the item
+        """
+        return int.from_bytes(hashlib.blake2b(raw_item, digest_size=8).digest(), "little", signed=True)
+
+    @abc.abstractmethod
+    def compute(self, raw_items) -> np.ndarray:
+        """
+        Compute the arrays of items that are not cached
+
+        Args:
+            raw_items: list of bytes
+
+        Returns: ndarray of shape [len(raw_items)] + item_shape
+        """
+
+    def _insert(self, key: int, item: np.ndarray):
+        with self._lock:
+            if key in self._index:
+                return
+            slot = len(self._index)
+            if slot >= self._capacity:
+                self._data.flush()
+                self._open(self._capacity * 2)
+            self._data[slot] = item
+            self._index[key] = slot
+            self._unflushed += 1
+            should_flush = self._unflushed >= self.flush_every
+
+        if should_flush:
+            self.flush()
+
+    def get_or_compute(self, raw_items) -> np.ndarray:
+        """
+        Get arrays from the cache, the arrays of the items that are not cached are computed in one batch and inserted
+
+        Args:
+            raw_items: string tensor of shape [item_count]
+
+        Returns: ndarray of shape [item_count] + item_shape
+
+        """
+        raw_items = raw_items.numpy()
+        items = np.empty((len(raw_items),) + self.item_shape, dtype=self.dtype)
+
+        missing = []
+        for i, raw_item in enumerate(raw_items):
+            key = self.item_key(raw_item)
+            slot = self._index.get(key)
+            if slot is not None:
+                items[i] = self._data[slot]
+            else:
+                missing.append((i, key))
+
+        if missing:
+            computed = self.compute([raw_items[i] for i, _ in missing])
+            for (i, key), item in zip(missing, computed):
+                items[i] = item
+                self._insert(key, item)
+
+        return items
+
+
+class DecodedImageCache(MemmapItemCache):
+    """
+    Disk-backed cache of decoded and resized images
+
+    The images are stored as uint8 arrays of shape [image_size, image_size, 3], the images decoded without
+    the cache are rounded to uint8 the same way.
+    """
+
+    def __init__(self, cache_dir: str, image_size: int = 299, initial_capacity: int = 10000,
+                 flush_every: int = 1000):
+        """
+        Open or create the cache
+
+        Args:
+            cache_dir: Directory with the cache files
+            image_size: Width and height of the cached images
+            initial_capacity: Number of images to allocate space for when creating a new cache
+            flush_every: Number of inserted images after which the index is written to the disk
+        """
+        self.image_size = image_size
+        super(DecodedImageCache, self).__init__(cache_dir, "images-{}.u8".format(image_size),
+                                                "index-{}.npy".format(image_size), (image_size, image_size, 3),
+                                                np.uint8, initial_capacity, flush_every)
+
+    def compute(self, raw_items) -> np.ndarray:
+        images = np.empty((len(raw_items),) + self.item_shape, dtype=self.dtype)
+        for i, raw_image in enumerate(raw_items):
+            images[i] = input_pipeline.decode_resized_img(raw_image, self.image_size).numpy()
+        return images
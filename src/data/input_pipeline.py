@@ -1,4 +1,5 @@
 import tensorflow as tf
+import src.data.data_service as data_service
 
 
 def parse_example_with_features(raw):
@@ -10,13 +11,66 @@ def parse_example_with_features(raw):
     return example[1]["features"], example[1]["categories"]
 
 
-def decode_img(img):
+def decode_resized_img(img, image_size=299):
+    """
+    Decode a JPEG image and resize it, the resized image is rounded to uint8 like the images of the image cache,
+    so the CNN gets the same pixels with and without the cache
+
+    Returns: uint8 tensor of shape [image_size, image_size, 3]
+
+    """
     # convert the compressed string to a 3D uint8 tensor
     img = tf.image.decode_jpeg(img, channels=3)
-    return tf.keras.applications.inception_v3.preprocess_input(tf.image.resize(img, [299, 299]))
+    return tf.saturate_cast(tf.round(tf.image.resize(img, [image_size, image_size])), tf.uint8)
+
+
+def decode_img(img, image_size=299):
+    img = tf.cast(decode_resized_img(img, image_size), tf.float32)
+    return tf.keras.applications.inception_v3.preprocess_input(img)
+
+
+def decode_imgs(raw_imgs, image_cache=None, image_size=299):
+    """
+    Decode a sequence of JPEG images
+
+    Args:
+        raw_imgs: string tensor of shape [image_count]
+        image_cache: optional DecodedImageCache, the images are decoded only if they are not cached
+        image_size: width and height of the decoded images (the size of the image cache is used if it is given)
+
+    Returns: float tensor of shape [image_count, image_size, image_size, 3]
+
+    """
+    if image_cache is None:
+        return tf.map_fn(lambda img: decode_img(img, image_size), raw_imgs, dtype=tf.float32)
+
+    images = tf.py_function(image_cache.get_or_compute, [raw_imgs], tf.uint8)
+    images.set_shape((None,) + image_cache.item_shape)
+    return tf.keras.applications.inception_v3.preprocess_input(tf.cast(images, tf.float32))
+
+
+def load_images(raw_imgs, image_cache=None, activation_store=None, image_size=299):
+    """
+    Load a sequence of JPEG images as decoded images or as activations of the frozen CNN layers
+
+    Args:
+        raw_imgs: string tensor of shape [image_count]
+        image_cache: optional DecodedImageCache, the images are decoded only if they are not cached
+        activation_store: optional ActivationStore, the activations are returned instead of the images
+        image_size: width and height of the decoded images
 
+    Returns: float tensor of shape [image_count, image_size, image_size, 3] or [image_count] + activation shape
+
+    """
+    if activation_store is None:
+        return decode_imgs(raw_imgs, image_cache, image_size)
 
-def parse_example_with_images(raw):
+    activations = tf.py_function(activation_store.get_or_compute, [raw_imgs], tf.as_dtype(activation_store.dtype))
+    activations.set_shape((None,) + activation_store.item_shape)
+    return activations
+
+
+def parse_example_with_images(raw, image_cache=None, activation_store=None, image_size=299):
     example = tf.io.parse_single_sequence_example(
         raw, sequence_features={
             "categories": tf.io.FixedLenSequenceFeature([], tf.int64),
@@ -24,26 +78,59 @@ def parse_example_with_images(raw):
         })
 
     raw_imgs = example[1]["images"]
-    images = tf.map_fn(decode_img, raw_imgs, dtype=tf.float32)
+    images = load_images(raw_imgs, image_cache, activation_store, image_size)
     return images, example[1]["categories"]
 
 
-def get_dataset(filenames, with_features):
-    raw_dataset = tf.data.TFRecordDataset(filenames)
+def fingerprint_items(items, categories):
+    """
+    Get the 64-bit keys of items given by their stored features or encoded images and their categories
+
+    Args:
+        items: float tensor of shape [item_count, 2048] or string tensor of shape [item_count] of the raw records
+        categories: int tensor of shape [item_count], the categories of the records
+
+    Returns: int64 tensor of shape [item_count]
+
+    """
+    item_fingerprints = tf.bitcast(tf.fingerprint(items), tf.int64)
+    keys = tf.stack([item_fingerprints, tf.cast(categories, tf.int64)], axis=1)
+    return tf.bitcast(tf.fingerprint(keys), tf.int64)
+
+
+def parse_item_keys(raw, with_features):
+    """Get the keys of the items of a training record without decoding the images"""
+    items, item_shape, item_dtype = ("features", 2048, tf.float32) if with_features else ("images", [], tf.string)
+    example = tf.io.parse_single_sequence_example(
+        raw, sequence_features={
+            "categories": tf.io.FixedLenSequenceFeature([], tf.int64),
+            items: tf.io.FixedLenSequenceFeature(item_shape, item_dtype)
+        })
+    return fingerprint_items(example[1][items], example[1]["categories"])
+
+
+def get_dataset(filenames, with_features, image_cache=None, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                activation_store=None, image_size=299, skip_records=0):
+    # The skipped records are not parsed
+    raw_dataset = tf.data.TFRecordDataset(filenames).skip(skip_records)
     if with_features:
-        return raw_dataset.map(parse_example_with_features)
+        return raw_dataset.map(parse_example_with_features, num_parallel_calls)
     else:
-        return raw_dataset.map(parse_example_with_images)
+        return raw_dataset.map(lambda raw: parse_example_with_images(raw, image_cache, activation_store, image_size),
+                               num_parallel_calls)
 
 
-def add_random_mask_positions(features, categories):
+def add_random_mask_positions(features, categories, seed=1):
     seq_length = tf.shape(categories)[0]
-    random_position = tf.random.uniform((1,), minval=0, maxval=seq_length, dtype="int32", seed=1)
+    random_position = tf.random.uniform((1,), minval=0, maxval=seq_length, dtype="int32", seed=seed)
     token_positions = tf.expand_dims(random_position, 0)
     return features, categories, token_positions
 
 
-def get_training_dataset(filenames, batch_size, with_features, category_lookup=None):
+def get_training_dataset(filenames, batch_size, with_features, category_lookup=None, image_cache=None,
+                         service_address=None, cache=True, num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                         bucket_boundaries=None, pad_to_bucket_boundary=False, activation_store=None,
+                         image_size=299, service_mode="distributed_epoch", service_workers=None):
     """
     Build training-type dataset
 
@@ -52,26 +139,64 @@ def get_training_dataset(filenames, batch_size, with_features, category_lookup=N
         batch_size: batch size
         with_features: the files contain extracted features
         category_lookup: optional tf.lookup.StaticHashTable for mapping the categories into high-level groups
+        image_cache: optional DecodedImageCache used instead of the in-memory cache when the files contain images
+        service_address: optional address of a tf.data service dispatcher that processes the dataset
+        cache: cache the parsed outfits in memory
+        num_parallel_calls: number of outfits parsed in parallel
+        bucket_boundaries: optional list of outfit lengths, the outfits are batched with outfits of similar lengths
+        pad_to_bucket_boundary: pad the outfits to the bucket boundary minus 1 instead of the longest outfit
+            of the batch, the outfits must be shorter than the last bucket boundary
+        activation_store: optional ActivationStore, the outfits contain activations of the frozen CNN layers
+            instead of the images
+        image_size: width and height of the decoded images
+        service_mode: processing mode of the tf.data service, "distributed_epoch" or "parallel_epochs"
+        service_workers: optional number of the tf.data service workers, used to check the processing mode
 
     Returns: Training-type dataset, each sample contains (inputs, categories, mask_positions)
 
     """
-    outfits = get_dataset(filenames, with_features)
+    if service_address is not None and (image_cache is not None or activation_store is not None):
+        raise RuntimeError("The image cache and the activation store can't be used together with the tf.data service")
 
-    if category_lookup is not None:
-        outfits = outfits.map(lambda inputs, input_categories:
-                              map_training_categories(inputs, input_categories, category_lookup)
-                              )
-
-    outfits = outfits.cache()
+    outfits = get_dataset(filenames, with_features, image_cache, num_parallel_calls, activation_store, image_size)
 
-    outfits = outfits.map(add_random_mask_positions, tf.data.experimental.AUTOTUNE)
-    outfits = outfits.shuffle(10000, 1)
-
-    if with_features:
-        outfits = outfits.padded_batch(batch_size, ([None, 2048], [None], [None, 1]), drop_remainder=True)
+    # With the tf.data service, the categories are mapped by the training process, so the dataset sent to
+    # the workers doesn't capture the lookup table
+    if category_lookup is not None and service_address is None:
+        outfits = outfits.map(lambda inputs, input_categories:
+                              map_training_categories(inputs, input_categories, category_lookup),
+                              num_parallel_calls)
+
+    # The workers of the tf.data service start a new iteration every epoch, so the cache would never be reused
+    if cache and image_cache is None and activation_store is None and service_address is None:
+        outfits = outfits.cache()
+
+    # With parallel_epochs, every tf.data service worker runs this pipeline, so the workers shuffle and mask
+    # the outfits without a fixed seed, else they would all produce the same batches
+    seed = None if service_address is not None and service_mode == "parallel_epochs" else 1
+    outfits = outfits.map(lambda inputs, categories: add_random_mask_positions(inputs, categories, seed),
+                          num_parallel_calls)
+    outfits = outfits.shuffle(10000, seed)
+
+    # Only the outfit length is padded, the shape of the items is kept
+    item_shape = outfits.element_spec[0].shape[1:]
+    padded_shapes = (tf.TensorShape([None]).concatenate(item_shape), [None], [None, 1])
+
+    if bucket_boundaries is not None:
+        outfits = outfits.apply(tf.data.experimental.bucket_by_sequence_length(
+            lambda inputs, categories, mask_positions: tf.shape(categories)[0],
+            bucket_boundaries, [batch_size] * (len(bucket_boundaries) + 1), padded_shapes,
+            pad_to_bucket_boundary=pad_to_bucket_boundary, drop_remainder=True))
     else:
-        outfits = outfits.padded_batch(batch_size, ([None, 299, 299, 3], [None], [None, 1]), drop_remainder=True)
+        outfits = outfits.padded_batch(batch_size, padded_shapes, drop_remainder=True)
+
+    if service_address is not None:
+        outfits = data_service.distribute(outfits, service_address, processing_mode=service_mode,
+                                          shard_count=len(filenames), worker_count=service_workers)
+        if category_lookup is not None:
+            outfits = outfits.map(lambda inputs, categories, mask_positions:
+                                  map_padded_categories(inputs, categories, mask_positions, category_lookup),
+                                  num_parallel_calls)
 
     return outfits\
         .prefetch(tf.data.experimental.AUTOTUNE)
@@ -92,7 +217,7 @@ def parse_fitb_with_features(raw):
            example[0]["target_position"]
 
 
-def parse_fitb_with_images(raw):
+def parse_fitb_with_images(raw, image_cache=None, activation_store=None, image_size=299):
     example = tf.io.parse_single_sequence_example(
         raw, sequence_features={
             "input_categories": tf.io.FixedLenSequenceFeature([], tf.int64),
@@ -104,16 +229,30 @@ def parse_fitb_with_images(raw):
         })
 
     inputs = example[1]["inputs"]
-    inputs = tf.map_fn(decode_img, inputs, dtype=tf.float32)
+    inputs = load_images(inputs, image_cache, activation_store, image_size)
 
     targets = example[1]["targets"]
-    targets = tf.map_fn(decode_img, targets, dtype=tf.float32)
+    targets = load_images(targets, image_cache, activation_store, image_size)
 
     return inputs, example[1]["input_categories"], \
            targets, example[1]["target_categories"], \
            example[0]["target_position"]
 
 
+def parse_fitb_item_keys(raw, with_features):
+    """Get the keys of the input and the target items of a FITB record without decoding the images"""
+    item_shape, item_dtype = (2048, tf.float32) if with_features else ([], tf.string)
+    example = tf.io.parse_single_sequence_example(
+        raw, sequence_features={
+            "input_categories": tf.io.FixedLenSequenceFeature([], tf.int64),
+            "inputs": tf.io.FixedLenSequenceFeature(item_shape, item_dtype),
+            "target_categories": tf.io.FixedLenSequenceFeature([], tf.int64),
+            "targets": tf.io.FixedLenSequenceFeature(item_shape, item_dtype)
+        })
+    return fingerprint_items(example[1]["inputs"], example[1]["input_categories"]), \
+           fingerprint_items(example[1]["targets"], example[1]["target_categories"])
+
+
 def add_mask_mock(inputs, input_categories, targets, target_categories, target_position, true_mask_category=False):
     """
     Adds mock tensor to inputs at the 0th index
@@ -148,7 +287,37 @@ def map_training_categories(inputs, input_categories, category_lookup):
     return inputs, input_categories
 
 
-def get_fitb_dataset(filenames, with_features, category_lookup=None, use_mask_category=False):
+def map_padded_categories(inputs, categories, mask_positions, category_lookup):
+    """Map the categories of a padded batch into high-level groups, the padding category 0 is kept"""
+    categories = tf.where(tf.equal(categories, 0), categories, category_lookup.lookup(categories))
+
+    return inputs, categories, mask_positions
+
+
+def pad_fitb_to_bucket(inputs, input_categories, targets, target_categories, target_position, bucket_lengths):
+    """
+    Pad the inputs of a FITB question to the smallest bucket length that fits the question
+    The questions longer than all the bucket lengths are not padded
+
+    Returns:
+        Example with inputs and input_categories padded with zeros
+    """
+    length = tf.shape(input_categories)[0]
+    lengths = tf.constant(bucket_lengths, dtype=tf.int32)
+    bucket_index = tf.searchsorted(lengths, tf.expand_dims(length, 0), side="left")
+    bucket_length = tf.gather(tf.concat([lengths, tf.expand_dims(length, 0)], axis=0), bucket_index)[0]
+    padding = bucket_length - length
+
+    input_paddings = tf.concat([[[0, padding]], tf.zeros([tf.rank(inputs) - 1, 2], dtype=tf.int32)], axis=0)
+    inputs = tf.pad(inputs, input_paddings)
+    input_categories = tf.pad(input_categories, [[0, padding]])
+
+    return inputs, input_categories, targets, target_categories, target_position
+
+
+def get_fitb_dataset(filenames, with_features, category_lookup=None, use_mask_category=False, image_cache=None,
+                     cache=True, num_parallel_calls=tf.data.experimental.AUTOTUNE, bucket_lengths=None,
+                     activation_store=None, image_size=299, skip_records=0):
     """
     Build FITB dataset
 
@@ -157,23 +326,42 @@ def get_fitb_dataset(filenames, with_features, category_lookup=None, use_mask_ca
         with_features: the files contain extracted features
         category_lookup: optional tf.lookup.StaticHashTable for mapping the categories into high-level groups
         use_mask_category: use true mask category (else category id 1 is used)
+        image_cache: optional DecodedImageCache used instead of the in-memory cache when the files contain images
+        cache: cache the parsed questions in memory
+        num_parallel_calls: number of questions parsed in parallel
+        bucket_lengths: optional sorted list of lengths, the inputs are padded to the smallest length that fits
+        activation_store: optional ActivationStore, the questions contain activations of the frozen CNN layers
+            instead of the images
+        image_size: width and height of the decoded images
+        skip_records: number of records skipped before the parsing
 
     Returns: FITB dataset, each sample contains (inputs, input_categories, targets, target_categories, target_position)
         the mask token is located at position 0
 
     """
-    raw_dataset = tf.data.TFRecordDataset(filenames)
+    raw_dataset = tf.data.TFRecordDataset(filenames).skip(skip_records)
     if with_features:
-        dataset = raw_dataset.map(parse_fitb_with_features)
+        dataset = raw_dataset.map(parse_fitb_with_features, num_parallel_calls)
     else:
-        dataset = raw_dataset.map(parse_fitb_with_images)
+        dataset = raw_dataset.map(lambda raw: parse_fitb_with_images(raw, image_cache, activation_store, image_size),
+                                  num_parallel_calls)
 
     if category_lookup is not None:
         dataset = dataset.map(lambda inputs, input_categories, targets, target_categories, target_position:
                               map_fitb_categories(
                                   inputs, input_categories, targets, target_categories, target_position, category_lookup
-                              ))
+                              ), num_parallel_calls)
 
-    return dataset.map(lambda inputs, input_categories, targets, target_categories, target_position: add_mask_mock(
+    dataset = dataset.map(lambda inputs, input_categories, targets, target_categories, target_position: add_mask_mock(
         inputs, tf.cast(input_categories, dtype=tf.int32), targets, tf.cast(target_categories, dtype=tf.int32),
-        target_position, use_mask_category)).cache()
+        target_position, use_mask_category), num_parallel_calls)
+
+    if bucket_lengths is not None:
+        dataset = dataset.map(lambda inputs, input_categories, targets, target_categories, target_position:
+                              pad_fitb_to_bucket(inputs, input_categories, targets, target_categories,
+                                                 target_position, bucket_lengths), num_parallel_calls)
+
+    if cache and image_cache is None and activation_store is None:
+        dataset = dataset.cache()
+
+    return dataset
@@ -0,0 +1,146 @@
+import argparse
+import json
+import time
+import tensorflow as tf
+import src.models.encoder.fashion_encoder as fashion_enc
+import src.models.encoder.utils as utils
+from src.models.encoder.encoder_main import EncoderTask, PARAMS_MAP
+
+
+def _random_batch(batch_size: int, seq_length: int, categories_count: int, image_size: int = 299):
+    lengths = tf.random.uniform([batch_size], minval=3, maxval=seq_length + 1, dtype=tf.int32)
+    categories = tf.random.uniform([batch_size, seq_length], minval=1, maxval=categories_count, dtype=tf.int32)
+    categories = categories * tf.cast(tf.sequence_mask(lengths, seq_length), tf.int32)
+    images = tf.random.uniform([batch_size, seq_length, image_size, image_size, 3], minval=-1, maxval=1)
+    mask_positions = tf.random.uniform([batch_size, 1, 1], maxval=3, dtype=tf.int32)
+    return images, categories, mask_positions
+
+
+def _peak_memory_mb():
+    if not tf.config.list_physical_devices("GPU"):
+        return None
+    return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2 ** 20
+
+
+def _reset_peak_memory():
+    if tf.config.list_physical_devices("GPU"):
+        tf.config.experimental.reset_memory_stats("GPU:0")
+
+
+class TrainingStepProbe:
+    """Runs training steps of the model with CNN on random outfits"""
+
+    def __init__(self, params):
+        tf.keras.backend.clear_session()
+        self.params = params
+        self.task = EncoderTask(params)
+        self.model = fashion_enc.create_model(params, is_train=True)
+        self.optimizer = tf.optimizers.Adam(params["learning_rate"])
+        self.acc = tf.metrics.CategoricalAccuracy()
+
+        @tf.function
+        def step(inputs):
+            loss, grad = self.task._grad(self.model, inputs, self.acc)
+            self.optimizer.apply_gradients(zip(grad, self.model.trainable_variables))
+            return loss
+
+        self.step = step
+
+    def run(self, batch_size: int, seq_length: int, steps: int):
+        """
+        Run the training steps
+
+        Returns: dict with the measured values or None if the batch doesn't fit into the memory
+
+        """
+        inputs = _random_batch(batch_size, seq_length, self.params["categories_count"], self.params["image_size"])
+        _reset_peak_memory()
+        try:
+            # The first step traces the function
+            self.step(inputs).numpy()
+            start = time.perf_counter()
+            for _ in range(steps):
+                loss = self.step(inputs)
+            loss.numpy()
+        except tf.errors.ResourceExhaustedError:
+            return None
+        elapsed = time.perf_counter() - start
+
+        return {
+            "batch_size": batch_size,
+            "step_time_sec": elapsed / steps,
+            "outfits_per_sec": batch_size * steps / elapsed,
+            "peak_gpu_memory_mb": _peak_memory_mb()
+        }
+
+
+def find_max_batch_size(probe: TrainingStepProbe, seq_length: int, start: int, limit: int):
+    """
+    Find the largest batch size that fits into the memory by doubling the batch size and bisection
+
+    Returns: (largest feasible batch size or 0, its measurement)
+
+    """
+    feasible, feasible_result = 0, None
+    infeasible = limit + 1
+    batch_size = start
+    while batch_size <= limit:
+        result = probe.run(batch_size, seq_length, 1)
+        if result is None:
+            infeasible = batch_size
+            break
+        feasible, feasible_result = batch_size, result
+        batch_size *= 2
+
+    while infeasible - feasible > 1:
+        batch_size = (feasible + infeasible) // 2
+        result = probe.run(batch_size, seq_length, 1)
+        if result is None:
+            infeasible = batch_size
+        else:
+            feasible, feasible_result = batch_size, result
+
+    return feasible, feasible_result
+
+
+def main():
+    """
+    Report the largest feasible batch size and the throughput of training with CNN
+    with and without recomputation of the CNN activations in the backward pass
+
+    The results are printed as JSON
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--param-set", type=str, help="Name of the hyperparameter set", default="PO_BEST")
+    parser.add_argument("--seq-length", type=int, help="Length of the padded outfits", default=8)
+    parser.add_argument("--start-batch-size", type=int, help="First probed batch size", default=4)
+    parser.add_argument("--max-batch-size", type=int, help="Largest probed batch size", default=256)
+    parser.add_argument("--steps", type=int, help="Number of measured steps", default=10)
+    parser.add_argument("--recompute-grad", type=utils.str_to_bool, nargs="+", default=[False, True],
+                        help="Compared settings of the recomputation")
+    parser.add_argument("--output", type=str, help="Path to an output .json file")
+
+    args = parser.parse_args()
+
+    results = []
+    for recompute_grad in args.recompute_grad:
+        params = PARAMS_MAP[args.param_set].copy()
+        params.update({"with_cnn": True, "cnn_recompute_grad": recompute_grad})
+        probe = TrainingStepProbe(params)
+
+        max_batch_size, _ = find_max_batch_size(probe, args.seq_length, args.start_batch_size, args.max_batch_size)
+        result = {"cnn_recompute_grad": recompute_grad, "seq_length": args.seq_length,
+                  "max_batch_size": max_batch_size}
+        measurement = probe.run(max_batch_size, args.seq_length, args.steps) if max_batch_size > 0 else None
+        if measurement is not None:
+            result.update(measurement)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import argparse
+import json
+import time
+import tensorflow as tf
+import src.models.encoder.utils as utils
+
+
+def _diagonal_mask_matrix(categories, dtype):
+    """Reference implementation - the N x N diagonal padding mask matrix that was applied with einsum"""
+    unpacked_categories = tf.reshape(categories, shape=[-1])
+    unpacked_length = tf.shape(unpacked_categories)[0]
+    padding_mask = tf.cast(tf.not_equal(unpacked_categories, 0), dtype=dtype)
+    mask_matrix = tf.zeros(shape=(unpacked_length, unpacked_length), dtype=dtype)
+    return tf.linalg.set_diag(mask_matrix, padding_mask)
+
+
+def matrix_masking(categories, values):
+    mask_matrix = _diagonal_mask_matrix(categories, values.dtype)
+    return tf.einsum("ij,jk->ik", mask_matrix, values)
+
+
+def elementwise_masking(categories, values):
+    mask = utils.compute_padding_mask_from_categories(categories)
+    return tf.where(mask, values, tf.zeros_like(values))
+
+
+def _random_batch(batch_size: int, seq_length: int, dim: int, dtype):
+    lengths = tf.random.uniform([batch_size], minval=3, maxval=seq_length + 1, dtype=tf.int32)
+    categories = tf.random.uniform([batch_size, seq_length], minval=1, maxval=12, dtype=tf.int32)
+    categories = categories * tf.cast(tf.sequence_mask(lengths, seq_length), tf.int32)
+    values = tf.random.normal([batch_size * seq_length, dim], dtype=dtype)
+    return categories, values
+
+
+def _peak_memory_mb():
+    if not tf.config.list_physical_devices("GPU"):
+        return None
+    return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2 ** 20
+
+
+def _reset_peak_memory():
+    if tf.config.list_physical_devices("GPU"):
+        tf.config.experimental.reset_memory_stats("GPU:0")
+
+
+def benchmark(masking_fn, batch_size: int, seq_length: int, dim: int, dtype, steps: int, masks_per_step: int):
+    """
+    Measure forward and backward pass of the masking
+
+    Args:
+        masking_fn: matrix_masking or elementwise_masking
+        batch_size: Number of outfits in a batch
+        seq_length: Length of the padded outfits
+        dim: Dimension of the masked vectors
+        dtype: Dtype of the masked vectors
+        steps: Number of measured steps
+        masks_per_step: Number of masking calls in a step (the model masks CNN outputs and category embeddings)
+
+    Returns: dict with the measured values
+
+    """
+    categories, values = _random_batch(batch_size, seq_length, dim, dtype)
+
+    @tf.function
+    def step(categories, values):
+        with tf.GradientTape() as tape:
+            tape.watch(values)
+            outputs = values
+            for _ in range(masks_per_step):
+                outputs = masking_fn(categories, outputs)
+            loss = tf.reduce_sum(tf.cast(outputs, tf.float32))
+        return tape.gradient(loss, values)
+
+    _reset_peak_memory()
+    # The first call traces the function
+    step(categories, values).numpy()
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        grad = step(categories, values)
+    grad.numpy()
+    elapsed = time.perf_counter() - start
+
+    n = batch_size * seq_length
+    if masking_fn is matrix_masking:
+        mask_bytes = n * n * tf.as_dtype(dtype).size
+    else:
+        mask_bytes = n
+
+    return {
+        "masking": masking_fn.__name__,
+        "batch_size": batch_size,
+        "seq_length": seq_length,
+        "dim": dim,
+        "dtype": tf.as_dtype(dtype).name,
+        "step_time_ms": elapsed / steps * 1000,
+        "mask_bytes": mask_bytes,
+        "peak_gpu_memory_mb": _peak_memory_mb()
+    }
+
+
+def main():
+    """
+    Compare the N x N diagonal mask matrices with elementwise masking of padded items
+
+    The results are printed as JSON
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[96, 256, 512], help="Batch sizes")
+    parser.add_argument("--seq-length", type=int, help="Length of the padded outfits", default=19)
+    parser.add_argument("--dim", type=int, help="Dimension of the masked vectors", default=2048)
+    parser.add_argument("--dtype", type=str, help="Dtype of the masked vectors", default="float32")
+    parser.add_argument("--steps", type=int, help="Number of measured steps", default=50)
+    parser.add_argument("--masks-per-step", type=int, help="Number of masking calls in a step", default=3)
+    parser.add_argument("--output", type=str, help="Path to an output .json file")
+
+    args = parser.parse_args()
+
+    results = []
+    for batch_size in args.batch_size:
+        for masking_fn in [matrix_masking, elementwise_masking]:
+            try:
+                result = benchmark(masking_fn, batch_size, args.seq_length, args.dim, args.dtype, args.steps,
+                                   args.masks_per_step)
+            except tf.errors.ResourceExhaustedError:
+                result = {"masking": masking_fn.__name__, "batch_size": batch_size, "error": "out of memory"}
+            print(json.dumps(result), flush=True)
+            results.append(result)
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
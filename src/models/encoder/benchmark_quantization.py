@@ -0,0 +1,196 @@
+import argparse
+import json
+import numpy as np
+import src.models.encoder.benchmark_retrieval as benchmark_retrieval
+import src.models.encoder.catalog_sampler as catalog_sampler
+import src.models.encoder.quantization as quantization
+import src.models.encoder.retrieval as retrieval
+
+
+def _fitb_accuracy(scores: np.ndarray, target_positions: np.ndarray) -> float:
+    """
+    Fraction of questions where the correct candidate has a higher score than all the other candidates
+
+    The ties count as errors, so equal codes of the quantized candidates don't favor the correct item.
+    """
+    rows = np.arange(len(scores))
+    target_scores = scores[rows, target_positions]
+    other_scores = scores.copy()
+    other_scores[rows, target_positions] = -np.inf
+    return float(np.mean(target_scores > np.max(other_scores, axis=1)))
+
+
+def _fitb_candidates(query_items: np.ndarray, categories: np.ndarray, candidate_count: int,
+                    rng: np.random.Generator):
+    """
+    Sample FITB candidates of the queries, the negatives are other items of the category of the correct item
+
+    Args:
+        query_items: int ndarray of shape [query_count], the correct items of the queries
+        categories: int ndarray of shape [item_count]
+        candidate_count: Number of candidates of a question
+        rng: numpy random Generator
+
+    Returns: (candidate_items, target_positions) int ndarrays of shapes [query_count, candidate_count] and
+        [query_count], the correct item is at a random position
+
+    """
+    category_items = {category: np.flatnonzero(categories == category) for category in np.unique(categories)}
+    candidate_items = np.empty([len(query_items), candidate_count], dtype=np.int64)
+    for i, item in enumerate(query_items):
+        others = category_items[categories[item]]
+        others = others[others != item]
+        if len(others) == 0:
+            raise RuntimeError("The category of item {} has no other items for the FITB negatives".format(item))
+        negatives = rng.choice(others, size=candidate_count - 1, replace=len(others) < candidate_count - 1)
+        candidate_items[i] = np.concatenate([[item], negatives])
+
+    # The correct item is moved from position 0 to a random position
+    target_positions = rng.integers(candidate_count, size=len(query_items))
+    rows = np.arange(len(query_items))
+    candidate_items[rows, 0], candidate_items[rows, target_positions] = \
+        candidate_items[rows, target_positions], candidate_items[rows, 0]
+    return candidate_items, target_positions
+
+
+def _candidate_scores(queries, candidates, metric):
+    """Scores of the candidates of shape [query_count, candidate_count, dim] by the float embeddings"""
+    scores = np.einsum("qd,qcd->qc", queries, candidates)
+    if metric == "distance":
+        scores -= 0.5 * np.sum(np.square(candidates), axis=2)
+    return scores
+
+
+def benchmark_embeddings(embeddings, categories, quantizer, queries, query_items, candidate_items, target_positions,
+                         k, metric):
+    """
+    Measure the memory and the accuracy loss of the quantized embeddings
+
+    Args:
+        embeddings: ndarray of shape [item_count, dim]
+        categories: int ndarray of shape [item_count]
+        quantizer: ScalarQuantizer or ProductQuantizer
+        queries: ndarray of shape [query_count, dim]
+        query_items: int ndarray of shape [query_count], the correct items of the queries
+        candidate_items: int ndarray of shape [query_count, candidate_count], the FITB candidates
+        target_positions: int ndarray of shape [query_count], the positions of the correct items in the candidates
+        k: Number of retrieved items
+        metric: "dotproduct" or "distance"
+
+    Returns: dict with the measured values
+
+    """
+    exact = retrieval.ExactIndex(embeddings, categories, metric)
+    quantized = retrieval.ExactIndex(embeddings, categories, metric, quantizer=quantizer)
+    exact_indices, _ = exact.search(queries, k)
+    quantized_indices, _ = quantized.search(queries, k)
+
+    float_scores = _candidate_scores(queries, embeddings[candidate_items], metric)
+    quantized_scores = np.stack([quantizer.scores(query[np.newaxis], quantized.codes[items], metric)[0]
+                                 for query, items in zip(queries, candidate_items)])
+
+    float_bytes = embeddings.shape[1] * 4
+    return {
+        "quantization": type(quantizer).__name__,
+        "bytes_per_item": quantizer.code_size,
+        "float_bytes_per_item": float_bytes,
+        "compression_ratio": float_bytes / quantizer.code_size,
+        "recall_at_k": retrieval.recall_at_k(quantized_indices, exact_indices),
+        "float_fitb_accuracy": _fitb_accuracy(float_scores, target_positions),
+        "quantized_fitb_accuracy": _fitb_accuracy(quantized_scores, target_positions),
+        "fitb_agreement": float(np.mean(np.argmax(float_scores, axis=1) == np.argmax(quantized_scores, axis=1))),
+        "top1_hit_rate": float(np.mean(quantized_indices[:, 0] == query_items))
+    }
+
+
+def benchmark_features(path: str):
+    """
+    Measure the memory and the reconstruction error of the int8 features of an item table
+
+    Args:
+        path: Path to an item table built by src.data.build_item_table with float features
+
+    Returns: dict with the measured values
+
+    """
+    features = catalog_sampler.CatalogSampler.load_table(path)[0].astype(np.float32)
+    quantizer = quantization.ScalarQuantizer()
+    quantizer.fit(features)
+    reconstructed = quantizer.decode(quantizer.encode(features))
+    error = np.linalg.norm(reconstructed - features, axis=1) / np.maximum(np.linalg.norm(features, axis=1), 1e-12)
+    return {
+        "quantization": "features_int8",
+        "item_count": len(features),
+        "float16_bytes": features.size * 2,
+        "int8_bytes": features.size + quantizer.scale.nbytes,
+        "mean_relative_error": float(error.mean()),
+        "max_relative_error": float(error.max())
+    }
+
+
+def main():
+    """
+    Report the memory savings and the accuracy loss of the quantized item embeddings and features
+
+    The results are printed as JSON
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embeddings", type=str,
+                        help="Path to an .npz file with item embeddings and categories (synthetic items if not set)")
+    parser.add_argument("--item-table", type=str, help="Path to an item table with float features")
+    parser.add_argument("--item-count", type=int, help="Number of synthetic items", default=100000)
+    parser.add_argument("--dim", type=int, help="Dimension of the synthetic embeddings", default=128)
+    parser.add_argument("--category-count", type=int, help="Number of synthetic categories", default=11)
+    parser.add_argument("--cluster-count", type=int, help="Number of clusters of the synthetic embeddings",
+                        default=4096)
+    parser.add_argument("--metric", type=str, help="Similarity of the items", choices=["dotproduct", "distance"],
+                        default="dotproduct")
+    parser.add_argument("--pq-subspace-count", type=int, nargs="+", default=[8, 16, 32],
+                        help="Numbers of subspaces of the product quantization")
+    parser.add_argument("--query-count", type=int, help="Number of queries", default=1000)
+    parser.add_argument("--query-noise", type=float, help="Standard deviation of the noise added to the queries",
+                        default=0.3)
+    parser.add_argument("--candidate-count", type=int, help="Number of candidates of the FITB questions", default=4)
+    parser.add_argument("--k", type=int, help="Number of retrieved items", default=10)
+    parser.add_argument("--seed", type=int, help="Random seed", default=1)
+    parser.add_argument("--output", type=str, help="Path to an output .json file")
+
+    args = parser.parse_args()
+
+    if args.embeddings is not None:
+        with np.load(args.embeddings) as table:
+            embeddings, categories = table["embeddings"].astype(np.float32), table["categories"]
+    else:
+        embeddings, categories = benchmark_retrieval.synthetic_embeddings(
+            args.item_count, args.dim, args.category_count, args.cluster_count, args.seed)
+
+    # The queries are perturbed embeddings of random items, the FITB negatives are other items of the same category
+    rng = np.random.default_rng(args.seed + 1)
+    query_items = rng.integers(len(embeddings), size=args.query_count)
+    queries = embeddings[query_items] + args.query_noise * rng.standard_normal(
+        (args.query_count, embeddings.shape[1]), dtype=np.float32)
+    candidate_items, target_positions = _fitb_candidates(query_items, categories, args.candidate_count, rng)
+
+    quantizers = [quantization.ScalarQuantizer()]
+    quantizers += [quantization.ProductQuantizer(count) for count in args.pq_subspace_count
+                   if embeddings.shape[1] % count == 0]
+
+    results = []
+    for quantizer in quantizers:
+        result = benchmark_embeddings(embeddings, categories, quantizer, queries, query_items, candidate_items,
+                                      target_positions, args.k, args.metric)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if args.item_table is not None:
+        result = benchmark_features(args.item_table)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import itertools
+import json
+import time
+import numpy as np
+import src.models.encoder.retrieval as retrieval
+import src.models.encoder.utils as utils
+
+
+def synthetic_embeddings(item_count: int, dim: int, category_count: int, cluster_count: int, seed: int):
+    """
+    Generate clustered item embeddings with categories
+
+    Args:
+        item_count: Number of items
+        dim: Dimension of the embeddings
+        category_count: Number of categories
+        cluster_count: Number of clusters of the embeddings
+        seed: Random seed
+
+    Returns: (embeddings, categories) ndarrays of shapes [item_count, dim] and [item_count]
+
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((cluster_count, dim), dtype=np.float32)
+    clusters = rng.integers(cluster_count, size=item_count)
+    embeddings = centers[clusters] + 0.3 * rng.standard_normal((item_count, dim), dtype=np.float32)
+    categories = clusters % category_count + 1
+    return embeddings, categories
+
+
+def _queries(embeddings: np.ndarray, categories: np.ndarray, count: int, noise: float, seed: int):
+    """Perturbed embeddings of random items serve as the queries, the items' categories as the masked categories"""
+    rng = np.random.default_rng(seed)
+    items = rng.integers(len(embeddings), size=count)
+    queries = embeddings[items] + noise * rng.standard_normal((count, embeddings.shape[1]), dtype=np.float32)
+    return queries, categories[items]
+
+
+def _latencies_ms(index, queries, k, query_categories, **search_kwargs):
+    """Search the queries one by one, as they arrive in serving"""
+    latencies = []
+    for i in range(len(queries)):
+        categories = query_categories[i:i + 1] if query_categories is not None else None
+        start = time.perf_counter()
+        index.search(queries[i:i + 1], k, categories, **search_kwargs)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.asarray(latencies)
+
+
+def _latency_stats(latencies: np.ndarray) -> dict:
+    return {
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+        "latency_mean_ms": float(latencies.mean())
+    }
+
+
+def main():
+    """
+    Compare recall@k and latency of the IVF index with the exact search
+
+    Every combination of the listed index settings is benchmarked, the results are printed as JSON
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embeddings", type=str,
+                        help="Path to an .npz file with item embeddings and categories (synthetic items if not set)")
+    parser.add_argument("--item-count", type=int, help="Number of synthetic items", default=1000000)
+    parser.add_argument("--dim", type=int, help="Dimension of the synthetic embeddings", default=128)
+    parser.add_argument("--category-count", type=int, help="Number of synthetic categories", default=11)
+    parser.add_argument("--cluster-count", type=int, help="Number of clusters of the synthetic embeddings",
+                        default=4096)
+    parser.add_argument("--metric", type=str, help="Similarity of the items", choices=["dotproduct", "distance"],
+                        default="dotproduct")
+    parser.add_argument("--query-count", type=int, help="Number of queries", default=1000)
+    parser.add_argument("--query-noise", type=float, help="Standard deviation of the noise added to the queries",
+                        default=0.3)
+    parser.add_argument("--k", type=int, help="Number of retrieved items", default=10)
+    parser.add_argument("--within-category", type=utils.str_to_bool, default=True,
+                        help="Search only within the category of the query")
+    parser.add_argument("--list-count", type=int, nargs="+", default=[1024], help="Numbers of IVF clusters")
+    parser.add_argument("--probe-count", type=int, nargs="+", default=[1, 4, 16, 64],
+                        help="Numbers of searched clusters")
+    parser.add_argument("--partition-by-category", type=utils.str_to_bool, nargs="+", default=[False, True],
+                        help="Cluster every category separately")
+    parser.add_argument("--seed", type=int, help="Random seed", default=1)
+    parser.add_argument("--output", type=str, help="Path to an output .json file")
+
+    args = parser.parse_args()
+
+    if args.embeddings is not None:
+        with np.load(args.embeddings) as table:
+            embeddings, categories = table["embeddings"].astype(np.float32), table["categories"]
+    else:
+        embeddings, categories = synthetic_embeddings(args.item_count, args.dim, args.category_count,
+                                                      args.cluster_count, args.seed)
+    queries, query_categories = _queries(embeddings, categories, args.query_count, args.query_noise, args.seed + 1)
+    if not args.within_category:
+        query_categories = None
+
+    exact = retrieval.ExactIndex(embeddings, categories, args.metric)
+    exact_indices, _ = exact.search(queries, args.k, query_categories)
+    result = {"index": "exact", "item_count": len(embeddings), "k": args.k}
+    result.update(_latency_stats(_latencies_ms(exact, queries, args.k, query_categories)))
+    print(json.dumps(result), flush=True)
+    results = [result]
+
+    for list_count, partition in itertools.product(args.list_count, args.partition_by_category):
+        start = time.perf_counter()
+        index = retrieval.IVFIndex(embeddings, categories, args.metric, list_count,
+                                   partition_by_category=partition, seed=args.seed)
+        build_time = time.perf_counter() - start
+
+        for probe_count in args.probe_count:
+            indices, _ = index.search(queries, args.k, query_categories, probe_count)
+            result = {
+                "index": "ivf",
+                "item_count": len(embeddings),
+                "k": args.k,
+                "list_count": list_count,
+                "probe_count": probe_count,
+                "partition_by_category": partition,
+                "build_time_sec": build_time,
+                "recall_at_k": retrieval.recall_at_k(indices, exact_indices)
+            }
+            result.update(_latency_stats(_latencies_ms(index, queries, args.k, query_categories,
+                                                       probe_count=probe_count)))
+            print(json.dumps(result), flush=True)
+            results.append(result)
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import tensorflow as tf
+import src.data.input_pipeline as input_pipeline
+
+
+def item_id(item, category: int) -> int:
+    """
+    Get the 64-bit id of an item under which its embedding is stored
+
+    Args:
+        item: float32 features of shape [2048] or the encoded image bytes as stored in the .tfrecord file
+        category: category of the item in the file (before the mapping into high-level groups)
+
+    Returns: int id of the item
+
+    """
+    items = tf.constant([item]) if isinstance(item, bytes) else tf.constant([np.asarray(item, dtype=np.float32)])
+    return int(input_pipeline.fingerprint_items(items, tf.constant([category]))[0])
+
+
+def _save_atomic(path: Path, save):
+    """Write the file through a temporary file, so an interrupted job never leaves a partially written file"""
+    temporary = path.with_name(path.name + ".tmp")
+    with open(str(temporary), "wb") as file:
+        save(file)
+    os.replace(str(temporary), str(path))
+
+
+class _GrowingArray:
+    """Memory-mapped array of rows whose file is extended by doubling as the rows are appended"""
+
+    def __init__(self, path: Path, width: int, dtype, count: int = 0, initial_capacity: int = 4096):
+        """
+        Open or create the array
+
+        Args:
+            path: Path to the data file
+            width: Number of values in a row
+            dtype: numpy dtype of the values
+            count: Number of valid rows in an existing file, the rows after them are overwritten
+            initial_capacity: Number of rows to allocate space for
+        """
+        self.path = path
+        self.width = width
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self._open(max(initial_capacity, count))
+
+    def _open(self, capacity: int):
+        size = capacity * self.width * self.dtype.itemsize
+        with open(str(self.path), "ab") as data_file:
+            if data_file.tell() < size:
+                data_file.truncate(size)
+        self._capacity = capacity
+        self._data = np.memmap(str(self.path), dtype=self.dtype, mode="r+", shape=(capacity, self.width))
+
+    def append(self, rows: np.ndarray):
+        if self.count + len(rows) > self._capacity:
+            self._data.flush()
+            self._open(max(self._capacity * 2, self.count + len(rows)))
+        self._data[self.count:self.count + len(rows)] = rows
+        self.count += len(rows)
+
+    def flush(self):
+        self._data.flush()
+
+    def close(self):
+        """Flush the rows and truncate the file to the valid rows"""
+        self._data.flush()
+        del self._data
+        with open(str(self.path), "r+b") as data_file:
+            data_file.truncate(self.count * self.width * self.dtype.itemsize)
+
+
+class _ShardWriter:
+    """
+    Writes the embeddings of one input file to a shard
+
+    The shard consists of the item embeddings with their keys and the flattened encoder outputs of the outfits
+    with an index of (record number, first row, length). The progress is saved every checkpoint, a restarted
+    job continues after the last saved record.
+    """
+
+    def __init__(self, output_dir: Path, shard: int, hidden_size: int, dtype):
+        self.state_path = Path(output_dir, "shard-{:05d}.json".format(shard))
+        self.item_keys_path = Path(output_dir, "items-{:05d}.keys.npy".format(shard))
+        self.outfit_index_path = Path(output_dir, "outfits-{:05d}.index.npy".format(shard))
+
+        state = {"records": 0, "outfit_rows": 0, "items": 0, "done": False}
+        item_keys = np.zeros((0,), dtype=np.int64)
+        outfit_index = np.zeros((0, 3), dtype=np.int64)
+        if self.state_path.exists():
+            with open(str(self.state_path)) as state_file:
+                state = json.load(state_file)
+            item_keys = np.load(str(self.item_keys_path))[:state["items"]]
+            outfit_index = np.load(str(self.outfit_index_path))[:state["records"]]
+
+        self.records = state["records"]
+        self.done = state["done"]
+        self._item_keys = list(item_keys)
+        self._seen = set(self._item_keys)
+        self._outfit_index = list(map(tuple, outfit_index))
+        self._items = _GrowingArray(Path(output_dir, "items-{:05d}.bin".format(shard)), hidden_size, dtype,
+                                    state["items"])
+        self._outfits = _GrowingArray(Path(output_dir, "outfits-{:05d}.bin".format(shard)), hidden_size, dtype,
+                                      state["outfit_rows"])
+
+    @property
+    def item_count(self):
+        return len(self._item_keys)
+
+    def write_batch(self, outputs, lengths, items, item_keys):
+        """
+        Append the encoder outputs of a batch of outfits and the item embeddings not written to the shard yet
+
+        Args:
+            outputs: ndarray of shape [row_count, hidden_size], the outputs of the outfits one after another
+            lengths: int ndarray of shape [outfit_count]
+            items: ndarray of shape [item_count, hidden_size]
+            item_keys: int64 ndarray of shape [item_count], the keys from the input pipeline
+        """
+        offsets = self._outfits.count + np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        for offset, length in zip(offsets, lengths):
+            self._outfit_index.append((self.records, int(offset), int(length)))
+            self.records += 1
+        self._outfits.append(outputs)
+
+        # First occurrence of every key of the batch, in the batch order
+        first = np.sort(np.unique(item_keys, return_index=True)[1])
+        new = [i for i, key in zip(first, item_keys[first].tolist()) if key not in self._seen]
+        new_keys = item_keys[new].tolist()
+        self._seen.update(new_keys)
+        self._item_keys.extend(new_keys)
+        self._items.append(items[new])
+
+    def checkpoint(self, done: bool = False):
+        """Save the written embeddings and the progress"""
+        self._items.flush()
+        self._outfits.flush()
+        _save_atomic(self.item_keys_path, lambda file: np.save(file, np.asarray(self._item_keys, dtype=np.int64)))
+        _save_atomic(self.outfit_index_path,
+                     lambda file: np.save(file, np.asarray(self._outfit_index, dtype=np.int64).reshape(-1, 3)))
+        state = {"records": self.records, "outfit_rows": self._outfits.count, "items": self._items.count,
+                 "done": done}
+        _save_atomic(self.state_path, lambda file: file.write(json.dumps(state).encode("utf-8")))
+        self.done = done
+
+    def close(self):
+        self.checkpoint(done=True)
+        self._items.close()
+        self._outfits.close()
+
+
+def get_embed_function(model: tf.keras.Model, schema: str, element_spec):
+    """
+    Get the function computing the encoder outputs and the item embeddings of a batch
+
+    The outfits of the training schema are encoded without masking, the FITB outfits with the mask token at
+    the 0th index. The items of the FITB schema are the items of the outfit (without the blank item) and
+    the candidates. Only the valid (not padded) positions are returned, so the batch is flattened on the device.
+    The item keys are computed by the input pipeline from the raw records, the features of the items stay on the
+    device.
+
+    Args:
+        model: Fashion Encoder created with is_train=False
+        schema: "training" or "fitb"
+        element_spec: element_spec of the records from get_dataset
+
+    Returns: tf.function returning a dict with "outputs", "lengths", "items" and "item_keys"
+
+    """
+    preprocessor = model.get_layer("preprocessor")
+    encoder = model.get_layer("encoder")
+
+    def relax(spec):
+        return tf.TensorSpec([None, None] + spec.shape[1:].as_list(), spec.dtype)
+
+    def encode(inputs, categories, mask_positions):
+        encoder_inputs, targets = preprocessor([inputs, categories, mask_positions], training=False)
+        outputs = encoder([encoder_inputs, categories], training=False)
+        return tf.cast(outputs, tf.float32), tf.cast(targets, tf.float32)
+
+    # The records are followed by their item keys
+    element_spec = tf.nest.flatten(element_spec)
+    if schema == "training":
+        @tf.function(input_signature=[relax(spec) for spec in element_spec])
+        def embed(inputs, categories, keys):
+            valid = tf.not_equal(categories, 0)
+            outputs, targets = encode(inputs, categories, None)
+            return {
+                "outputs": tf.boolean_mask(outputs, valid),
+                "lengths": tf.reduce_sum(tf.cast(valid, tf.int32), axis=1),
+                "items": tf.boolean_mask(targets, valid),
+                "item_keys": tf.boolean_mask(keys, valid)
+            }
+    elif schema == "fitb":
+        @tf.function(input_signature=[relax(spec) for spec in element_spec])
+        def embed(inputs, input_categories, candidates, candidate_categories, input_keys, candidate_keys):
+            valid = tf.not_equal(input_categories, 0)
+            # FITB mask token is placed at 0th index
+            mask_positions = tf.zeros([tf.shape(input_categories)[0], 1, 1], dtype=tf.int32)
+            outputs, targets = encode(inputs, input_categories, mask_positions)
+            _, candidate_targets = encode(candidates, candidate_categories, None)
+
+            # The blank item is not embedded
+            items = tf.logical_and(valid, tf.range(tf.shape(input_categories)[1]) > 0)
+            valid_candidates = tf.not_equal(candidate_categories, 0)
+            return {
+                "outputs": tf.boolean_mask(outputs, valid),
+                "lengths": tf.reduce_sum(tf.cast(valid, tf.int32), axis=1),
+                "items": tf.concat([tf.boolean_mask(targets, items),
+                                    tf.boolean_mask(candidate_targets, valid_candidates)], axis=0),
+                # The keys of the inputs don't include the blank item
+                "item_keys": tf.concat([tf.boolean_mask(input_keys, items[:, 1:]),
+                                        tf.boolean_mask(candidate_keys, valid_candidates)], axis=0)
+            }
+    else:
+        raise RuntimeError("Invalid embedding schema")
+
+    return embed
+
+
+def get_dataset(filename: str, schema: str, with_features: bool, category_lookup=None, use_mask_category=False,
+                image_cache=None, image_size=299, skip_records=0) -> tf.data.Dataset:
+    """
+    Build the pipeline of one input file, the records are kept in the file order
+
+    The keys of the items are fingerprints of the stored features or of the encoded images and the categories
+    in the records, they are parsed from a second read of the file, so the images are not decoded for them.
+    The first skip_records records are skipped before the parsing, so a resumed shard doesn't decode the images
+    of the embedded records.
+
+    Returns: dataset of ((inputs, categories), item_keys) for the training schema or ((inputs, input_categories,
+        targets, target_categories), (input_keys, target_keys)) for the FITB schema
+
+    """
+    if schema == "training":
+        dataset = input_pipeline.get_dataset([filename], with_features, image_cache, image_size=image_size,
+                                             skip_records=skip_records)
+        if category_lookup is not None:
+            dataset = dataset.map(lambda inputs, categories:
+                                  input_pipeline.map_training_categories(inputs, categories, category_lookup),
+                                  tf.data.experimental.AUTOTUNE)
+        dataset = dataset.map(lambda inputs, categories: (inputs, tf.cast(categories, tf.int32)),
+                              tf.data.experimental.AUTOTUNE)
+        keys = tf.data.TFRecordDataset([filename]).skip(skip_records).map(
+            lambda raw: input_pipeline.parse_item_keys(raw, with_features), tf.data.experimental.AUTOTUNE)
+    elif schema == "fitb":
+        dataset = input_pipeline.get_fitb_dataset([filename], with_features, category_lookup, use_mask_category,
+                                                  image_cache, cache=False, image_size=image_size,
+                                                  skip_records=skip_records)
+        dataset = dataset.map(lambda inputs, input_categories, targets, target_categories, target_position:
+                              (inputs, input_categories, targets, target_categories),
+                              tf.data.experimental.AUTOTUNE)
+        keys = tf.data.TFRecordDataset([filename]).skip(skip_records).map(
+            lambda raw: input_pipeline.parse_fitb_item_keys(raw, with_features), tf.data.experimental.AUTOTUNE)
+    else:
+        raise RuntimeError("Invalid embedding schema")
+
+    return tf.data.Dataset.zip((dataset, keys))
+
+
+def _embed_shard(embed, dataset: tf.data.Dataset, writer: _ShardWriter, batch_size: int, checkpoint_every: int):
+    """Run the records of the dataset, which starts after the embedded records, and write them to the shard"""
+    dataset = dataset.padded_batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+    for step, batch in enumerate(dataset, 1):
+        result = {name: tensor.numpy() for name, tensor in embed(*tf.nest.flatten(batch)).items()}
+        writer.write_batch(result["outputs"], result["lengths"], result["items"], result["item_keys"])
+        if step % checkpoint_every == 0:
+            writer.checkpoint()
+    writer.close()
+
+
+def embed_files(model: tf.keras.Model, filenames, output_dir: str, schema: str, batch_size: int = 512,
+                workers: int = 4, checkpoint_every: int = 50, dtype="float16", with_features: bool = True,
+                category_lookup=None, use_mask_category=False, image_cache=None, image_size=299):
+    """
+    Embed the outfits and the items of the .tfrecord files to sharded memory-mapped arrays
+
+    Every input file is written to its own shard by one of the worker threads, the model runs in a tf.function
+    that releases the GIL, so the workers overlap the inference with the parsing and the writing. The files
+    of a shard are:
+        - items-NNNNN.bin: item embeddings of shape [item_count, hidden_size], the distinct items of the shard
+        - items-NNNNN.keys.npy: int64 keys of the items (fingerprints of the stored item and the category)
+        - outfits-NNNNN.bin: encoder outputs of the outfits flattened to shape [row_count, hidden_size]
+        - outfits-NNNNN.index.npy: int64 rows (record number, first row, length) of the outfits
+        - shard-NNNNN.json: progress of the shard
+    The shards and their input files are listed in manifest.json. A restarted job with the same arguments skips
+    the finished shards and continues the others from their last checkpoint.
+
+    Args:
+        model: Fashion Encoder created with is_train=False
+        filenames: Paths to the .tfrecord files
+        output_dir: Output directory
+        schema: "training" or "fitb", the schema of the records
+        batch_size: Number of outfits embedded at once
+        workers: Number of files embedded in parallel
+        checkpoint_every: Number of batches after which the progress of a shard is saved
+        dtype: numpy dtype of the stored embeddings
+        with_features: the files contain extracted features
+        category_lookup: optional tf.lookup.StaticHashTable for mapping the categories into high-level groups
+        use_mask_category: use the true category of the blank FITB item (else category id 1 is used)
+        image_cache: optional DecodedImageCache used when the files contain images
+        image_size: width and height of the decoded images
+
+    Returns: dict with the numbers of the embedded outfits and items
+
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    hidden_size = int(model.outputs[0].shape[-1])
+
+    manifest = {"schema": schema, "files": [str(filename) for filename in filenames], "hidden_size": hidden_size,
+                "dtype": np.dtype(dtype).name}
+    manifest_path = Path(output_dir, "manifest.json")
+    if manifest_path.exists():
+        with open(str(manifest_path)) as manifest_file:
+            if json.load(manifest_file) != manifest:
+                raise RuntimeError("The output directory contains embeddings of other files or with other settings")
+    else:
+        _save_atomic(manifest_path, lambda file: file.write(json.dumps(manifest, indent=2).encode("utf-8")))
+
+    def dataset(shard, skip_records=0):
+        return get_dataset(filenames[shard], schema, with_features, category_lookup, use_mask_category, image_cache,
+                           image_size, skip_records)
+
+    embed = get_embed_function(model, schema, dataset(0).element_spec)
+
+    lock = threading.Lock()
+    totals = {"outfits": 0, "items": 0}
+
+    def run(shard):
+        writer = _ShardWriter(output_dir, shard, hidden_size, dtype)
+        if not writer.done:
+            # The records are in the file order, so the embedded ones are skipped on resume
+            _embed_shard(embed, dataset(shard, writer.records), writer, batch_size, checkpoint_every)
+            print("Embedded {}".format(filenames[shard]), flush=True)
+        with lock:
+            totals["outfits"] += writer.records
+            totals["items"] += writer.item_count
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Propagate the exceptions of the workers
+        for future in [executor.submit(run, shard) for shard in range(len(filenames))]:
+            future.result()
+
+    return totals
+
+
+class EmbeddingReader:
+    """Read-only access to the embeddings written by embed_files"""
+
+    def __init__(self, output_dir: str):
+        self.output_dir = Path(output_dir)
+        with open(str(Path(self.output_dir, "manifest.json"))) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.files = self.manifest["files"]
+        self._dtype = np.dtype(self.manifest["dtype"])
+        self._hidden_size = self.manifest["hidden_size"]
+
+        self._item_index = {}
+        self._outfit_index = []
+        self._items = []
+        self._outfits = []
+        for shard in range(len(self.files)):
+            keys = np.load(str(Path(self.output_dir, "items-{:05d}.keys.npy".format(shard))))
+            for slot, key in enumerate(keys):
+                # The item embeddings don't depend on the outfit, so the first shard with the item is used
+                self._item_index.setdefault(int(key), (shard, slot))
+            self._outfit_index.append(np.load(str(Path(self.output_dir, "outfits-{:05d}.index.npy".format(shard)))))
+            self._items.append(self._open("items-{:05d}.bin".format(shard)))
+            self._outfits.append(self._open("outfits-{:05d}.bin".format(shard)))
+
+    def _open(self, name: str):
+        path = Path(self.output_dir, name)
+        if path.stat().st_size == 0:
+            return np.zeros((0, self._hidden_size), dtype=self._dtype)
+        return np.memmap(str(path), dtype=self._dtype, mode="r").reshape(-1, self._hidden_size)
+
+    def item_keys(self) -> np.ndarray:
+        """Keys of all the distinct items"""
+        return np.fromiter(self._item_index.keys(), dtype=np.int64, count=len(self._item_index))
+
+    def item(self, key: int) -> np.ndarray:
+        """Embedding of the item with the key from item_id"""
+        shard, slot = self._item_index[key]
+        return self._items[shard][slot]
+
+    def outfit(self, file_index: int, record: int) -> np.ndarray:
+        """Encoder outputs of shape [outfit_length, hidden_size] of the record of the input file"""
+        _, offset, length = self._outfit_index[file_index][record]
+        return self._outfits[file_index][offset:offset + length]
@@ -0,0 +1,151 @@
+import numpy as np
+import tensorflow as tf
+import src.models.encoder.item_embeddings as item_embeddings
+
+
+class CatalogSampler(tf.Module):
+    """
+    Sampler of negative items from the whole item catalog
+
+    The items are sampled with probabilities proportional to count^sampling_exponent, where count is the number
+    of occurrences of the item in the training outfits (0 for uniform sampling, 1 for the popularity of the items).
+    The sampling runs by binary search in the cumulative probabilities, so its cost grows only with the logarithm
+    of the catalog size. The items are sorted by categories, so sampling within a category is a search in
+    a sub-range of the cumulative probabilities.
+    """
+
+    def __init__(self, features, categories, counts, sampling_exponent: float = 1.0, categories_count: int = 0,
+                 feature_scale=None, name=None):
+        """
+        Create the sampler
+
+        Args:
+            features: ndarray of shape [item_count, feature_dim]
+            categories: int ndarray of shape [item_count], the categories as seen by the model
+            counts: int ndarray of shape [item_count], occurrences of the items in the training dataset
+            sampling_exponent: the items are sampled with probabilities proportional to count^sampling_exponent
+            categories_count: minimum number of categories
+            feature_scale: optional ndarray of shape [feature_dim], the features are then int8 codes of
+                the ScalarQuantizer with this scale
+            name: Name of the module
+        """
+        super(CatalogSampler, self).__init__(name=name)
+        order = np.argsort(categories, kind="stable")
+        features, categories, counts = features[order], categories[order], counts[order]
+
+        mass = np.power(counts.astype(np.float64), sampling_exponent)
+        probabilities = mass / mass.sum()
+        cumulative = np.cumsum(probabilities)
+
+        # Range of the cumulative probabilities of every category, the empty categories span the whole catalog
+        category_count = max(int(categories.max()) + 1, categories_count)
+        bounds = np.concatenate([[0.], cumulative])
+        lower = bounds[np.searchsorted(categories, np.arange(category_count), side="left")]
+        upper = bounds[np.searchsorted(categories, np.arange(category_count), side="right")]
+        empty = upper <= lower
+        lower[empty], upper[empty] = 0., 1.
+
+        self.item_count = len(categories)
+        self.features = tf.Variable(features, trainable=False, name="features")
+        self.feature_scale = None
+        if feature_scale is not None:
+            self.feature_scale = tf.Variable(feature_scale.astype(np.float32), trainable=False, name="feature_scale")
+        self.categories = tf.Variable(categories.astype(np.int32), trainable=False, name="categories")
+        self.cumulative = tf.Variable(cumulative, trainable=False, name="cumulative")
+        self.log_probabilities = tf.Variable(np.log(probabilities).astype(np.float32), trainable=False,
+                                             name="log_probabilities")
+        self.category_lower = tf.Variable(lower, trainable=False, name="category_lower")
+        self.category_upper = tf.Variable(upper, trainable=False, name="category_upper")
+        self.keys = tf.Variable(self._fingerprint(self.features), trainable=False, name="keys")
+
+    @staticmethod
+    def _fingerprint(stored_features):
+        """64-bit fingerprints of the rows of the features as stored in the table"""
+        return tf.bitcast(tf.fingerprint(stored_features), tf.int64)
+
+    def item_keys(self, features):
+        """
+        Get the keys of items given by their features as fed to the model, the keys match the keys of the table
+
+        Args:
+            features: float tensor of shape [item_count, feature_dim]
+
+        Returns: int64 tensor of shape [item_count]
+
+        """
+        if self.feature_scale is not None:
+            # The int8 tables are quantized from float16 features by src.data.build_item_table
+            scaled = tf.cast(tf.cast(features, tf.float16), tf.float32) / self.feature_scale
+            stored = tf.cast(tf.clip_by_value(tf.round(scaled), -127, 127), tf.int8)
+        else:
+            stored = tf.cast(features, self.features.dtype)
+        return self._fingerprint(stored)
+
+    @staticmethod
+    def load_table(path: str):
+        """
+        Load the item table built by src.data.build_item_table
+
+        Returns: (features, categories, counts, feature_scale), feature_scale is None unless the features are
+            quantized to int8
+
+        """
+        with np.load(path) as table:
+            feature_scale = table["feature_scale"] if "feature_scale" in table.files else None
+            return table["features"], table["categories"], table["counts"], feature_scale
+
+    def sample(self, count: int, categories=None):
+        """
+        Sample items
+
+        Args:
+            count: Number of sampled items (per category)
+            categories: optional int tensor of shape [batch_size], the items are sampled within each of the categories
+
+        Returns: (indices, log_q) int and float tensors of shape [count] or [batch_size, count],
+            log_q is the logarithm of the probability that the item is sampled, the keys of the sampled items
+            are given by tf.gather(keys, indices)
+
+        """
+        if categories is None:
+            lower = tf.zeros([1], dtype=tf.float64)
+            upper = tf.ones([1], dtype=tf.float64)
+            shape = [count]
+        else:
+            categories = tf.cast(categories, tf.int32)
+            lower = tf.gather(self.category_lower, categories)
+            upper = tf.gather(self.category_upper, categories)
+            shape = [tf.shape(categories)[0], count]
+
+        lower = tf.reshape(lower, [-1, 1])
+        upper = tf.reshape(upper, [-1, 1])
+        uniform = tf.random.uniform([tf.shape(lower)[0], count], dtype=tf.float64)
+        values = lower + uniform * (upper - lower)
+
+        indices = tf.searchsorted(self.cumulative, tf.reshape(values, [-1]), side="left")
+        indices = tf.minimum(indices, self.item_count - 1)  # Rounding of the last cumulative probability
+
+        # Probability of the item within the sampled range
+        log_q = tf.gather(self.log_probabilities, indices)
+        log_q = tf.reshape(log_q, [-1, count]) - tf.cast(tf.math.log(upper - lower), tf.float32)
+        return tf.reshape(indices, shape), tf.reshape(log_q, shape)
+
+    def embed(self, preprocessor, indices, training=True):
+        """
+        Embed the sampled items with the preprocessor in one batch
+
+        Args:
+            preprocessor: preprocessor component of the model
+            indices: int tensor of any shape
+            training: whether the preprocessor runs in training mode
+
+        Returns: float tensor of shape indices.shape + [hidden_size]
+
+        """
+        flat_indices = tf.reshape(indices, [-1])
+        features = tf.cast(tf.gather(self.features, flat_indices), tf.float32)
+        if self.feature_scale is not None:
+            features = features * self.feature_scale
+        categories = tf.gather(self.categories, flat_indices)
+        targets = item_embeddings.embed_items(preprocessor, features, categories, training)
+        return tf.reshape(targets, tf.concat([tf.shape(indices), [-1]], axis=0))
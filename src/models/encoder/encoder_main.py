@@ -1,10 +1,22 @@
 import argparse
 import datetime
+import itertools
+import json
 import logging
 import time
 from pathlib import Path
+import numpy as np
 import tensorflow as tf
+import src.data.activation_store as activation_store
+import src.data.image_cache as image_cache
 import src.data.input_pipeline as input_pipeline
+import src.models.encoder.bulk_embedding as bulk_embedding
+import src.models.encoder.catalog_sampler as catalog_sampler
+import src.models.encoder.export as export
+import src.models.encoder.item_embeddings as item_embeddings
+import src.models.encoder.numpy_export as numpy_export
+import src.models.encoder.quantization as quantization
+import src.models.encoder.tflite_export as tflite_export
 import src.models.encoder.fashion_encoder as fashion_enc
 import src.models.encoder.metrics as metrics
 import src.models.encoder.utils as utils
@@ -42,6 +54,128 @@ class EncoderTask:
         """
         self.params = params
         self.model = model
+        self.compile_monitors = {}
+        self._compiled_functions = {}
+        self.memory_bank = None
+        self.catalog_sampler = None
+
+    def _get_compile_monitor(self, name):
+        if name not in self.compile_monitors:
+            self.compile_monitors[name] = utils.CompileCacheMonitor(name)
+        return self.compile_monitors[name]
+
+    def _get_fitb_function(self, model, element_spec, table=None):
+        """
+        Get function that evaluates a batch of FITB questions in a graph, compiled with XLA if jit_compile is set
+
+        Args:
+            model: model for evaluation
+            element_spec: element_spec of the batched FITB dataset
+            table: optional ItemEmbeddingTable, the candidates are then given by indices into the table
+
+        Returns: (function that takes the tensors of one batch, dict of the accuracies updated by the function)
+
+        """
+        key = ("fitb", id(model), id(table))
+        if key not in self._compiled_functions:
+            accuracies = {"dotproduct": tf.metrics.Mean(), "distance": tf.metrics.Mean()}
+            preprocessor = model.get_layer("preprocessor")
+
+            def step(inputs, input_categories, targets, target_categories, target_position):
+                # FITB mask token is placed at 0th index
+                mask_positions = tf.zeros([tf.shape(input_categories)[0], 1, 1], dtype=tf.int32)
+                if table is not None:
+                    embedded_targets = table.gather(targets)
+                else:
+                    _, embedded_targets = preprocessor([targets, target_categories, mask_positions], training=False)
+                outputs = model([inputs, input_categories, mask_positions], training=False)[0]
+
+                dotproduct_correct, distance_correct = metrics.fitb_batch_correct(
+                    outputs[:, 0], embedded_targets, target_categories, target_position)
+                accuracies["dotproduct"].update_state(tf.cast(dotproduct_correct, tf.float32))
+                accuracies["distance"].update_state(tf.cast(distance_correct, tf.float32))
+
+            step = tf.function(step, input_signature=self._relaxed_signature(element_spec),
+                               jit_compile=self.params["jit_compile"])
+
+            self._compiled_functions[key] = (step, accuracies)
+
+        return self._compiled_functions[key]
+
+    def get_inference_function(self, model, element_spec):
+        """
+        Get function that runs the model in inference mode, compiled with XLA if jit_compile is set
+
+        Args:
+            model: model for inference
+            element_spec: element_spec of the training-type dataset
+
+        Returns: function that takes (inputs, input_categories, mask_positions) and returns (outputs, targets)
+
+        """
+        key = ("inference", id(model))
+        if key not in self._compiled_functions:
+            def infer(inputs, input_categories, mask_positions):
+                ret = model([inputs, input_categories, mask_positions], training=False)
+                return ret[0], ret[1]
+
+            if self.params["jit_compile"]:
+                infer = tf.function(infer, input_signature=self._relaxed_signature(element_spec), jit_compile=True)
+
+            self._compiled_functions[key] = infer
+
+        return self._compiled_functions[key]
+
+    def evaluate_fitb(self, model, dataset):
+        """
+        Evaluate the model on the FITB task with both similarity measures
+
+        Args:
+            model: model for evaluation
+            dataset: FITB dataset batched with padded_batch
+
+        Returns: dict with FITB accuracies "dotproduct" and "distance"
+
+        """
+        table = None
+        if self.params["fitb_embedding_table"] and not self.params["with_cnn"]:
+            # The distinct candidates are embedded once, the questions then refer to them by indices
+            table, dataset = self._get_fitb_candidates(dataset)
+            table.compute(model.get_layer("preprocessor"))
+
+        step, accuracies = self._get_fitb_function(model, dataset.element_spec, table)
+        for acc in accuracies.values():
+            acc.reset_states()
+
+        for task in dataset:
+            if self.params["jit_compile"]:
+                self._get_compile_monitor("fitb").update(*task)
+            step(*task)
+        return {name: acc.result() for name, acc in accuracies.items()}
+
+    def _get_fitb_candidates(self, dataset):
+        """
+        Get the table of the distinct FITB candidates and the dataset with the candidates replaced by table indices,
+        the candidates are indexed only once per dataset
+
+        Args:
+            dataset: FITB dataset batched with padded_batch
+
+        Returns: (ItemEmbeddingTable, indexed dataset)
+
+        """
+        key = ("fitb_candidates", id(dataset))
+        if key not in self._compiled_functions:
+            quantizer = quantization.get_quantizer(self.params["embedding_quantization"],
+                                                   self.params["pq_subspace_count"])
+            table, indexed_dataset, lookup = item_embeddings.index_fitb_candidates(dataset, quantizer)
+            print("Indexed " + str(len(table)) + " distinct FITB candidates", flush=True)
+            # The original dataset is kept, so its id isn't reused by another dataset, the lookup table of the
+            # candidate indices is kept for the indexed dataset
+            self._compiled_functions[key] = (table, indexed_dataset, dataset, lookup)
+
+        table, indexed_dataset, _, _ = self._compiled_functions[key]
+        return table, indexed_dataset
 
     def fitb(self, model, dataset):
         """
@@ -49,26 +183,19 @@ class EncoderTask:
 
         Args:
             model: model for evaluation
-            dataset: FITB dataset
+            dataset: FITB dataset batched with padded_batch
 
-        Returns: Reached FITB accuracy
+        Returns: Reached FITB accuracy, the similarity measure is given by the loss function
 
         """
-
+        accuracies = self.evaluate_fitb(model, dataset)
         if self.params["loss"] == "cross":
-            acc = tf.metrics.CategoricalAccuracy()
+            return accuracies["dotproduct"]
         elif self.params["loss"] == "distance":
-            acc = tf.metrics.Accuracy()
+            return accuracies["distance"]
         else:
             raise RuntimeError("Unexpected loss function")
 
-        mask = tf.constant([[[0]]], dtype=tf.int32)  # FITB mask token is placed at 0th index
-        preprocessor = model.get_layer("preprocessor")
-
-        for task in dataset:
-            self.fitb_step(model, preprocessor, task, mask, acc)
-        return acc.result()
-
     def fitb_step(self, model, preprocessor, task, mask_pos, acc=None):
         """
         Evaluate one sample of the FITB task
@@ -136,7 +263,7 @@ class EncoderTask:
         debug_summary_writer = tf.summary.create_file_writer(train_log_dir)
 
         # Prepare datasets
-        train_dataset, valid_dataset, fitb_dataset = self.get_datasets()
+        train_dataset, valid_dataset, fitb_dataset = self.get_datasets(fitb_batch_size=1)
         train_dataset = train_dataset.take(1)
         fitb_dataset = fitb_dataset.take(1)
 
@@ -208,7 +335,8 @@ class EncoderTask:
         ret = model([inputs, input_categories, mask_positions], training=True)
         return ret[0], ret[1]
 
-    def _grad(self, model: tf.keras.Model, inputs, acc=None, stop_targets_gradient=True):
+    def _grad(self, model: tf.keras.Model, inputs, acc=None, stop_targets_gradient=True, optimizer=None,
+              catalog_samples=None, target_keys=None):
         """
         Computes gradient of one training step
 
@@ -222,6 +350,11 @@ class EncoderTask:
                 Third item, mask positions: int tensor with shape [batch_size, 1, 1]
             acc: instance of CategoricalAccuracy (for cross-entropy) or Accuracy (for distance)
             stop_targets_gradient: whether stop target gradient
+            optimizer: optional optimizer, the loss is scaled if it is a LossScaleOptimizer
+            catalog_samples: optional (indices, log_q, hits) from _sample_catalog_items, the catalog negatives are
+                sampled here if they are not given
+            target_keys: optional keys of the masked items from _masked_item_keys for the memory bank, they are
+                computed here if they are not given
 
         Returns: (loss_value, grad)
 
@@ -231,54 +364,283 @@ class EncoderTask:
             outputs = ret[0]
             targets = tf.stop_gradient(ret[1]) if stop_targets_gradient else ret[1]
             if self.params["loss"] == "cross":
+                sampled_targets, sampled_log_q, sampled_hits = None, None, None
+                if self.memory_bank is not None and target_keys is None:
+                    target_keys = self._masked_item_keys(*inputs)
+                if self.catalog_sampler is not None:
+                    if catalog_samples is None:
+                        catalog_samples = self._sample_catalog_items(*inputs)
+                    indices, sampled_log_q, sampled_hits = catalog_samples
+                    sampled_targets = self.catalog_sampler.embed(model.get_layer("preprocessor"), indices)
+                    if stop_targets_gradient:
+                        sampled_targets = tf.stop_gradient(sampled_targets)
                 loss_value = metrics.xentropy_loss(
                     outputs, targets,
-                    inputs[1], inputs[2], acc, categorywise_only=self.params["categorywise_train"])
+                    inputs[1], inputs[2], acc, categorywise_only=self.params["categorywise_train"],
+                    memory_bank=self.memory_bank, sampled_targets=sampled_targets, sampled_log_q=sampled_log_q,
+                    sampled_hits=sampled_hits, target_keys=target_keys)
             elif self.params["loss"] == "distance":
                 loss_value = metrics.distance_loss(
                     outputs, targets, inputs[1], inputs[2], self.params["margin"], acc)
             else:
                 raise RuntimeError("Unexpected loss function")
-            loss_value += tf.add_n(model.losses)  # Add additional losses (e.g. from regularizations)
-        grad = tape.gradient(loss_value, model.trainable_variables)
+            # Add additional losses (e.g. from regularizations)
+            loss_value += tf.add_n([tf.cast(loss, tf.float32) for loss in model.losses])
+
+            if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+                scaled_loss = optimizer.get_scaled_loss(loss_value)
+            else:
+                scaled_loss = loss_value
+        grad = tape.gradient(scaled_loss, model.trainable_variables)
+
+        if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            grad = optimizer.get_unscaled_gradients(grad)
         return loss_value, grad
 
-    def get_datasets(self):
+    @staticmethod
+    def _masked_item_keys(inputs, categories, mask_positions):
+        """
+        Get the keys of the masked items, fingerprints of their inputs and categories
+
+        The fingerprints have no XLA kernel, so with jit_compile they are computed outside the compiled function.
+
+        Returns: int64 tensor of shape [batch_size]
+
+        """
+        mask_indices = metrics.get_mask_indices(categories, mask_positions)
+        items = tf.gather(tf.reshape(inputs, tf.concat([[-1], tf.shape(inputs)[2:]], axis=0)), mask_indices)
+        return input_pipeline.fingerprint_items(tf.reshape(items, [tf.shape(mask_indices)[0], -1]),
+                                                tf.gather(tf.reshape(categories, [-1]), mask_indices))
+
+    def _sample_catalog_items(self, features, categories, mask_positions):
+        """
+        Sample negative items from the catalog
+
+        With categorywise training, the negatives of every outfit are sampled from the category of its masked item.
+        The sampled items with the key of the masked item are marked as accidental hits. The sampling uses ops
+        without XLA kernels (tf.fingerprint, tf.searchsorted), so with jit_compile it runs outside the compiled
+        gradient computation, which only embeds the sampled items.
+
+        Args:
+            features: float tensor with shape [batch_size, seq_length, feature_dim]
+            categories: int tensor with shape [batch_size, seq_length]
+            mask_positions: int tensor with shape [batch_size, 1, 1]
+
+        Returns: (indices, sampled_log_q, sampled_hits), the indices of the sampled items in the catalog table and
+            sampled_log_q and sampled_hits as in metrics.xentropy_loss
+
+        """
+        mask_indices = metrics.get_mask_indices(categories, mask_positions)
+        mask_categories = None
+        if self.params["categorywise_train"]:
+            mask_categories = tf.gather(tf.reshape(categories, [-1]), mask_indices)
+
+        indices, log_q = self.catalog_sampler.sample(self.params["catalog_sample_size"], mask_categories)
+
+        mask_features = tf.gather(tf.reshape(features, [-1, tf.shape(features)[2]]), mask_indices)
+        target_keys = self.catalog_sampler.item_keys(mask_features)
+        sampled_keys = tf.gather(self.catalog_sampler.keys, indices)
+        # The samples shared by the batch are compared with every target
+        sampled_hits = tf.equal(target_keys[:, tf.newaxis], tf.reshape(sampled_keys, [-1, tf.shape(indices)[-1]]))
+
+        return indices, log_q, sampled_hits
+
+    def _get_catalog_sampler(self, lookup):
+        """
+        Load the item table and create the sampler of the catalog negatives
+
+        Args:
+            lookup: optional tf.lookup.StaticHashTable for mapping the categories into high-level groups
+
+        Returns: CatalogSampler
+
+        """
+        if self.params["loss"] != "cross" or self.params["with_cnn"]:
+            raise RuntimeError("The catalog negatives can be used only with the cross-entropy loss and features")
+        if "item_table" not in self.params:
+            raise RuntimeError("The catalog negatives require an item table")
+
+        features, categories, counts, feature_scale = catalog_sampler.CatalogSampler.load_table(
+            self.params["item_table"])
+        if lookup is not None:
+            categories = lookup.lookup(tf.constant(categories, dtype=tf.int64)).numpy()
+        return catalog_sampler.CatalogSampler(features, categories, counts, self.params["catalog_sampling_exponent"],
+                                              self.params["categories_count"], feature_scale)
+
+    def get_category_lookup(self):
+        """
+        Get the lookup table for category groups
+
+        Returns: tf.lookup.StaticHashTable or None if the categories are not grouped
+
+        """
+        if not self.params["with_category_grouping"]:
+            return None
+        if "category_file" in self.params:
+            return utils.build_po_category_lookup_table(self.params["category_file"])
+        return utils.build_mp_category_lookup_table()
+
+    @staticmethod
+    def _relaxed_signature(element_spec):
+        """
+        Get input signature with unknown batch size and sequence length
+
+        Args:
+            element_spec: element_spec of the training or FITB dataset
+
+        Returns: tuple of tf.TensorSpec
+
+        """
+        return tuple(tf.TensorSpec([None] * min(spec.shape.rank, 2) + spec.shape[2:].as_list(), spec.dtype)
+                     for spec in element_spec)
+
+    def _get_train_function(self, model: tf.keras.Model, optimizer, acc, loss_metrics, element_spec,
+                            stop_targets_gradient):
+        """
+        Build a function that performs training steps
+
+        The training step is compiled into a graph (unless graph_train is disabled) with the relaxed input signature,
+        so the outfits of different lengths don't cause retracing. With jit_compile, the forward and backward pass
+        is compiled with XLA.
+
+        Args:
+            model: model to train
+            optimizer: optimizer that applies the gradients
+            acc: instance of CategoricalAccuracy (for cross-entropy) or Accuracy (for distance)
+            loss_metrics: list of tf.keras.metrics.Mean that are updated with the loss values
+            element_spec: element_spec of the training dataset
+            stop_targets_gradient: whether stop target gradient
+
+        Returns: function that takes an iterator of the training dataset, performs up to steps_per_execution steps
+            and returns the number of performed steps
+
+        """
+        steps_per_execution = self.params["steps_per_execution"]
+
+        def compute_grad(inputs, input_categories, mask_positions, catalog_samples=None, target_keys=None):
+            return self._grad(model, (inputs, input_categories, mask_positions), acc, stop_targets_gradient,
+                              optimizer, catalog_samples, target_keys)
+
+        if self.params["jit_compile"]:
+            compute_grad = tf.function(compute_grad, jit_compile=True)
+
+        def step(inputs, input_categories, mask_positions):
+            if self.params["jit_compile"]:
+                self._get_compile_monitor("train").update(inputs, input_categories, mask_positions)
+            # The catalog negatives and the keys of the memory bank are computed outside the XLA computation
+            catalog_samples = None
+            target_keys = None
+            if self.catalog_sampler is not None:
+                catalog_samples = self._sample_catalog_items(inputs, input_categories, mask_positions)
+            if self.memory_bank is not None:
+                target_keys = self._masked_item_keys(inputs, input_categories, mask_positions)
+            loss_value, grads = compute_grad(inputs, input_categories, mask_positions, catalog_samples, target_keys)
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+            for metric in loss_metrics:
+                metric(loss_value)
+
+        if not self.params["graph_train"]:
+            def eager_train_function(iterator):
+                performed = 0
+                for sample in itertools.islice(iterator, steps_per_execution):
+                    step(*sample)
+                    performed += 1
+                return performed
+
+            return eager_train_function
+
+        graph_step = tf.function(step, input_signature=self._relaxed_signature(element_spec))
+
+        @tf.function
+        def train_function(iterator):
+            performed = tf.constant(0)
+            for _ in tf.range(steps_per_execution):
+                sample = iterator.get_next_as_optional()
+                if not sample.has_value():
+                    break
+                graph_step(*sample.get_value())
+                performed += 1
+            return performed
+
+        return train_function
+
+    def get_datasets(self, fitb_batch_size=None):
         """
         Get training, validation and test input pipelines
 
+        Args:
+            fitb_batch_size: number of FITB questions in a batch (fitb_batch_size parameter by default)
+
         Returns: (train_dataset, valid_dataset, test_dataset) instances of tf.data.Dataset
 
         """
         # Optionally build a lookup table for category groups
-        lookup = None
-        if self.params["with_category_grouping"]:
-            if "category_file" in self.params:
-                lookup = utils.build_po_category_lookup_table(self.params["category_file"])
-            else:
-                lookup = utils.build_mp_category_lookup_table()
+        lookup = self.get_category_lookup()
+
+        # The FITB questions and candidate sets are padded to the longest ones in the batch
+        if fitb_batch_size is None:
+            fitb_batch_size = self.params["fitb_batch_size"]
+
+        # Optionally cache the decoded images or the activations of the frozen CNN layers on the disk
+        cache = None
+        store = None
+        if self.params["with_cnn"] and "activation_cache_dir" in self.params:
+            trunk, _ = fashion_enc.split_cnn(fashion_enc.build_cnn(self.params["image_size"]))
+            store = activation_store.ActivationStore(self.params["activation_cache_dir"], trunk,
+                                                     self.params["activation_dtype"])
+        elif self.params["with_cnn"] and "image_cache_dir" in self.params:
+            cache = image_cache.DecodedImageCache(self.params["image_cache_dir"], self.params["image_size"])
+
+        # Optionally move the processing of the training dataset to the tf.data service
+        service_address = self.params["data_service_address"] if "data_service_address" in self.params else None
+
+        # With XLA, the outfits are padded to a few lengths, so the compiled programs are reused
+        bucket_lengths = None
+        bucket_boundaries = None
+        if self.params["jit_compile"]:
+            bucket_lengths = self.params["length_buckets"]
+            bucket_boundaries = [length + 1 for length in bucket_lengths]
 
         # Build training dataset
         train_dataset = input_pipeline.get_training_dataset(self.params["train_files"],
                                                             self.params["batch_size"],
-                                                            not self.params["with_cnn"], lookup)
+                                                            not self.params["with_cnn"], lookup, cache,
+                                                            service_address, bucket_boundaries=bucket_boundaries,
+                                                            pad_to_bucket_boundary=bucket_boundaries is not None,
+                                                            activation_store=store,
+                                                            image_size=self.params["image_size"],
+                                                            service_mode=self.params["data_service_mode"],
+                                                            service_workers=self.params.get("data_service_workers"))
 
         # Build validation dataset based on the validation mode
         if self.params["valid_mode"] == "masking":
             valid_dataset = input_pipeline.get_training_dataset(self.params["valid_files"],
-                                                                2, not self.params["with_cnn"], lookup).cache()
+                                                                2, not self.params["with_cnn"], lookup, cache,
+                                                                bucket_boundaries=bucket_boundaries,
+                                                                pad_to_bucket_boundary=bucket_boundaries is not None,
+                                                                activation_store=store,
+                                                                image_size=self.params["image_size"])
+            if cache is None and store is None:
+                valid_dataset = valid_dataset.cache()
         else:
             valid_dataset = input_pipeline.get_fitb_dataset([self.params["valid_files"]], not self.params["with_cnn"],
-                                                            lookup, self.params["use_mask_category"]).batch(1)
+                                                            lookup, self.params["use_mask_category"], cache,
+                                                            bucket_lengths=bucket_lengths,
+                                                            activation_store=store,
+                                                            image_size=self.params["image_size"]
+                                                            ).padded_batch(fitb_batch_size)
 
         # Build test dataset
         test_dataset = input_pipeline.get_fitb_dataset([self.params["test_files"]], not self.params["with_cnn"],
-                                                       lookup, self.params["use_mask_category"]).batch(1)
+                                                       lookup, self.params["use_mask_category"], cache,
+                                                       bucket_lengths=bucket_lengths,
+                                                       activation_store=store,
+                                                       image_size=self.params["image_size"]
+                                                       ).padded_batch(fitb_batch_size)
 
         return train_dataset, valid_dataset, test_dataset
 
-    @staticmethod
-    def _validate_masking(model, valid_dataset):
+    def _validate_masking(self, model, valid_dataset):
         """
         Validate the model using masking validation task (same as training)
 
@@ -289,15 +651,184 @@ class EncoderTask:
         Returns: Validation accuracy
 
         """
+        infer = self.get_inference_function(model, valid_dataset.element_spec)
+
         # Validation loop
         valid_acc = tf.metrics.CategoricalAccuracy()
         for sample in valid_dataset:
-            ret = model([sample[0], sample[1], sample[2]], training=False)
-            outputs = ret[0]
-            targets = ret[1]
+            if self.params["jit_compile"]:
+                self._get_compile_monitor("inference").update(sample[0], sample[1], sample[2])
+            outputs, targets = infer(sample[0], sample[1], sample[2])
             metrics.xentropy_loss(outputs, targets, sample[1], sample[2], valid_acc)
         return valid_acc.result()
 
+    def export(self):
+        """
+        Export the model restored from the checkpoint or the saved weights for serving
+
+        The model is saved either as a SavedModel or as NumPy weights for src.models.encoder.numpy_runtime.
+        The NumPy runtime is compared with the model on the FITB test set, the differences and the latencies
+        are written to parity.json.
+        """
+        if "export_dir" not in self.params:
+            raise RuntimeError("The export requires an export directory")
+        if self.params["with_cnn"] and "activation_cache_dir" in self.params:
+            raise RuntimeError("The model with cached CNN activations can't be exported, export it without the cache")
+
+        if self.params["export_format"] == "savedmodel":
+            model = fashion_enc.create_model(self.params, is_train=False)
+            self._restore_for_inference(model)
+            export.export_model(model, self.params["export_dir"], self.params)
+        elif self.params["export_format"] == "numpy":
+            # The NumPy runtime computes in float32, so the model is compared in float32 too
+            model = fashion_enc.create_model(dict(self.params, dtype="float32"), is_train=False)
+            self._restore_for_inference(model)
+            Path(self.params["export_dir"]).mkdir(parents=True, exist_ok=True)
+            runtime = numpy_export.export_weights(model, str(Path(self.params["export_dir"], "weights.npz")),
+                                                  self.params)
+
+            _, _, test_dataset = self.get_datasets()
+            parity = numpy_export.check_parity(model, runtime, test_dataset)
+            print(json.dumps(parity), flush=True)
+            with open(Path(self.params["export_dir"], "parity.json"), "w") as parity_file:
+                json.dump(parity, parity_file, indent=2)
+            if max(parity["max_output_difference"], parity["max_target_difference"]) > self.params["parity_tolerance"]:
+                raise RuntimeError("The outputs of the NumPy runtime differ from the model by more than {}"
+                                   .format(self.params["parity_tolerance"]))
+        else:
+            raise RuntimeError("Invalid export format")
+        print("Exported the model to {}".format(self.params["export_dir"]), flush=True)
+
+    def embed(self):
+        """
+        Embed the outfits and the items of the embedding files with the restored model
+
+        The encoder outputs and the item embeddings are written to sharded memory-mapped arrays in the embedding
+        directory, an interrupted job continues from its last checkpoint when started again.
+        """
+        if "embed_dir" not in self.params or "embed_files" not in self.params:
+            raise RuntimeError("The embedding requires embedding files and an embedding directory")
+        if self.params["with_cnn"] and "activation_cache_dir" in self.params:
+            raise RuntimeError("The model with cached CNN activations can't embed images, embed them without the cache")
+
+        model = fashion_enc.create_model(self.params, is_train=False)
+        self._restore_for_inference(model)
+
+        cache = None
+        if self.params["with_cnn"] and "image_cache_dir" in self.params:
+            cache = image_cache.DecodedImageCache(self.params["image_cache_dir"], self.params["image_size"])
+
+        totals = bulk_embedding.embed_files(model, self.params["embed_files"], self.params["embed_dir"],
+                                            self.params["embed_schema"], self.params["embed_batch_size"],
+                                            self.params["embed_workers"], self.params["embed_checkpoint_every"],
+                                            self.params["embed_dtype"], not self.params["with_cnn"],
+                                            self.get_category_lookup(), self.params["use_mask_category"], cache,
+                                            self.params["image_size"])
+        print("Embedded {} outfits and {} items to {}".format(totals["outfits"], totals["items"],
+                                                              self.params["embed_dir"]), flush=True)
+
+    def quantize(self):
+        """
+        Convert the restored model to float32 and int8 TFLite models and compare them on the FITB test set
+
+        The int8 models are calibrated on outfits from the training dataset. The TFLite models and a report with
+        the accuracies and the latencies are written to the TFLite directory.
+        """
+        if "tflite_dir" not in self.params:
+            raise RuntimeError("The quantization requires a TFLite directory")
+        if self.params["with_cnn"] and "activation_cache_dir" in self.params:
+            raise RuntimeError("The model with cached CNN activations can't be converted, convert it without the cache")
+
+        # The variables are float32 in every precision, so the checkpoints of the mixed-precision models can be used
+        model = fashion_enc.create_model(dict(self.params, dtype="float32"), is_train=False)
+        self._restore_for_inference(model)
+
+        seq_length = self.params["tflite_seq_length"]
+        candidate_count = self.params["tflite_candidate_count"]
+        functions = tflite_export.build_inference_functions(model, seq_length, candidate_count)
+
+        train_dataset, _, test_dataset = self.get_datasets(fitb_batch_size=1)
+        outfits = self._calibration_outfits(train_dataset, seq_length, self.params["calibration_outfits"])
+        items = [(inputs[:candidate_count], categories[:candidate_count]) for inputs, categories in outfits]
+        calibration_data = {
+            "complete_outfit": lambda: ([inputs[np.newaxis], categories[np.newaxis]] for inputs, categories in outfits),
+            "embed_items": lambda: ([inputs, categories] for inputs, categories in items)
+        }
+        questions = [tuple(tensor[0].numpy() for tensor in task) for task in test_dataset]
+        metric = "dotproduct" if self.params["loss"] == "cross" else "distance"
+
+        Path(self.params["tflite_dir"]).mkdir(parents=True, exist_ok=True)
+        report = {}
+        for precision in ["float32", "int8"]:
+            runners = {}
+            size = 0
+            for name, function in functions.items():
+                representative_dataset = calibration_data[name] if precision == "int8" else None
+                content = tflite_export.convert(function, model, representative_dataset)
+                with open(Path(self.params["tflite_dir"], "{}_{}.tflite".format(name, precision)), "wb") as f:
+                    f.write(content)
+                runners[name] = tflite_export.TFLiteRunner(content)
+                size += len(content)
+
+            report[precision] = tflite_export.evaluate_fitb(runners["complete_outfit"], runners["embed_items"],
+                                                            questions, seq_length, candidate_count, metric)
+            report[precision]["size_bytes"] = size
+
+        report["accuracy_delta"] = report["int8"]["accuracy"] - report["float32"]["accuracy"]
+        report["speedup"] = report["float32"]["latency_ms"] / max(report["int8"]["latency_ms"], 1e-9)
+        print(json.dumps(report), flush=True)
+        with open(Path(self.params["tflite_dir"], "report.json"), "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    @staticmethod
+    def _calibration_outfits(dataset, seq_length, count):
+        """
+        Take outfits from the training dataset padded to seq_length, the longer outfits are skipped
+
+        Returns: list of (inputs, categories) ndarrays
+
+        """
+        outfits = []
+        for inputs, categories, _ in dataset:
+            for outfit_inputs, outfit_categories in zip(inputs.numpy(), categories.numpy()):
+                length = np.count_nonzero(outfit_categories)
+                padded = tflite_export.pad(outfit_inputs[:length], outfit_categories[:length].astype(np.int32),
+                                           seq_length)
+                if padded is not None:
+                    outfits.append(padded)
+                if len(outfits) >= count:
+                    return outfits
+        return outfits
+
+    def _restore_for_inference(self, model):
+        """
+        Restore the weights of the model from the saved weights or from the latest checkpoint
+
+        Args:
+            model: model created with is_train=False
+        """
+        if "with_weights" in self.params:
+            model.get_layer("preprocessor").load_weights(filepath=self.params["with_weights"] + "preprocessor.h5"
+                                                         , by_name=True)
+            model.get_layer("encoder").load_weights(filepath=self.params["with_weights"] + "encoder.h5"
+                                                    , by_name=True)
+            print("Restored weights from {}".format(self.params["with_weights"]), flush=True)
+        elif "checkpoint_dir" in self.params:
+            ckpt = tf.train.Checkpoint(model=model)
+            latest_checkpoint = tf.train.latest_checkpoint(self.params["checkpoint_dir"])
+            if latest_checkpoint is None:
+                raise RuntimeError("No checkpoint found in " + self.params["checkpoint_dir"])
+            # The optimizer state of the training checkpoint is not needed, but every variable of the model
+            # must be restored, otherwise e.g. the CNN would silently keep its initial weights
+            status = ckpt.restore(latest_checkpoint).expect_partial()
+            try:
+                status.assert_existing_objects_matched()
+            except AssertionError as error:
+                raise RuntimeError("The checkpoint doesn't match the model: {}".format(error))
+            print("Restored from {}".format(latest_checkpoint), flush=True)
+        else:
+            raise RuntimeError("The inference requires a checkpoint directory or saved weights")
+
     def get_model(self, training):
         """
         Get model from constructor or create a new one using given hyperparameters
@@ -330,6 +861,9 @@ class EncoderTask:
 
         num_epochs = self.params["epoch_count"]
         optimizer = tf.optimizers.Adam(self.params["learning_rate"])
+        if self.params["dtype"] == "float16":
+            # Scale the loss to prevent the underflow of float16 gradients
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
 
         # Prepare logging
         current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -342,6 +876,16 @@ class EncoderTask:
         model = self.get_model(True)
         test_model = fashion_enc.create_model(model.get_layer("encoder").params, False)
 
+        # Optionally keep the targets of the previous steps as additional negatives
+        if self.params["memory_bank_size"] > 0:
+            if self.params["loss"] != "cross":
+                raise RuntimeError("The memory bank can be used only with the cross-entropy loss")
+            self.memory_bank = metrics.NegativeMemoryBank(self.params["memory_bank_size"], self.params["hidden_size"])
+
+        # Optionally sample additional negatives from the whole item catalog
+        if self.params["catalog_sample_size"] > 0:
+            self.catalog_sampler = self._get_catalog_sampler(self.get_category_lookup())
+
         # Threshold of valid acc when target gradient is not stopped
         max_valid = 0
 
@@ -371,36 +915,45 @@ class EncoderTask:
         else:
             early_stopping_monitor = None
 
+        if self.params["loss"] == "cross":
+            acc = tf.metrics.CategoricalAccuracy()
+        elif self.params["loss"] == "distance":
+            acc = tf.metrics.Accuracy()
+        else:
+            raise RuntimeError("Unexpected loss function")
+        epoch_loss_avg = tf.keras.metrics.Mean('epoch_loss')
+        train_loss = tf.keras.metrics.Mean('train_loss', dtype=tf.float32)
+
+        # Training functions for stopped and not stopped target gradient
+        train_functions = {}
+
         for epoch in range(1, num_epochs + 1):
-            epoch_loss_avg = tf.keras.metrics.Mean('epoch_loss')
-            train_loss = tf.keras.metrics.Mean('train_loss', dtype=tf.float32)
-            if self.params["loss"] == "cross":
-                acc = tf.metrics.CategoricalAccuracy()
-            elif self.params["loss"] == "distance":
-                acc = tf.metrics.Accuracy()
+            for metric in [acc, epoch_loss_avg, train_loss]:
+                metric.reset_states()
+
+            if self.params["target_gradient_from"] == -1:
+                stop_targets_gradient = False
             else:
-                raise RuntimeError("Unexpected loss function")
+                stop_targets_gradient = max_valid < self.params["target_gradient_from"]
 
-            # Training loop
-            for sample in train_dataset:
-                batch_number += 1
+            if stop_targets_gradient not in train_functions:
+                train_functions[stop_targets_gradient] = self._get_train_function(
+                    model, optimizer, acc, [epoch_loss_avg, train_loss], train_dataset.element_spec,
+                    stop_targets_gradient)
+            train_function = train_functions[stop_targets_gradient]
 
+            # Training loop
+            iterator = iter(train_dataset)
+            while True:
                 # Optimize the model
-                if self.params["target_gradient_from"] == -1:
-                    loss_value, grads = self._grad(model, sample, acc, stop_targets_gradient=False)
-                elif max_valid < self.params["target_gradient_from"]:
-                    loss_value, grads = self._grad(model, sample, acc)
-                else:
-                    loss_value, grads = self._grad(model, sample, acc, stop_targets_gradient=False)
+                steps = int(train_function(iterator))
+                if steps == 0:
+                    break
 
-                optimizer.apply_gradients(zip(grads, model.trainable_variables))
-
-                ckpt.step.assign_add(1)
+                batch_number += steps
+                ckpt.step.assign_add(steps)
 
                 # Track progress
-                epoch_loss_avg(loss_value)  # Add current batch loss
-                train_loss(loss_value)
-
                 with train_summary_writer.as_default():
                     tf.summary.scalar('loss', train_loss.result(), step=batch_number)
                     tf.summary.scalar('batch_acc', acc.result(), step=batch_number)
@@ -412,6 +965,13 @@ class EncoderTask:
             print("Epoch {:03d}: Loss: {:.3f}, Acc: {:.3f}".format(epoch, epoch_loss_avg.result(),
                                                                    acc.result()))
 
+            for name, monitor in self.compile_monitors.items():
+                result = monitor.result()
+                print("Epoch {:03d}: XLA compile cache of {}: {} hits, {} misses".format(
+                    epoch, name, result["hits"], result["misses"]))
+                with train_summary_writer.as_default():
+                    tf.summary.scalar('compile_cache_misses_' + name, result["misses"], step=epoch)
+
             # Validation step
             if epoch % 2 == 0:
                 weights = model.get_weights()
@@ -468,21 +1028,77 @@ def main():
     parser.add_argument("--batch-size", type=int, help="Batch size")
     parser.add_argument("--filter-size", type=int, help="Filter size")
     parser.add_argument("--epoch-count", type=int, help="Number of epochs")
-    parser.add_argument("--mode", type=str, help="Type of action", choices=["train", "debug"])
+    parser.add_argument("--mode", type=str, help="Type of action",
+                        choices=["train", "debug", "export", "quantize", "embed"])
     parser.add_argument("--hidden-size", type=int, help="Hidden size")
     parser.add_argument("--num-heads", type=int, help="Number of heads")
     parser.add_argument("--num-hidden-layers", type=int, help="Number of hidden layers")
     parser.add_argument("--checkpoint-dir", type=str, help="Checkpoint directory")
     parser.add_argument("--with-weights", type=str, help="Path to the directory with saved weights")
+    parser.add_argument("--export-dir", type=str, help="Output directory of the exported model (export mode only)")
+    parser.add_argument("--export-format", type=str, help="Format of the exported model",
+                        choices=["savedmodel", "numpy"])
+    parser.add_argument("--parity-tolerance", type=float,
+                        help="Maximal difference between the NumPy runtime and the model")
+    parser.add_argument("--embed-files", type=str, nargs="+",
+                        help="Paths to the embedded dataset files (embed mode only)")
+    parser.add_argument("--embed-dir", type=str, help="Output directory of the embeddings (embed mode only)")
+    parser.add_argument("--embed-schema", type=str, help="Schema of the embedded dataset files",
+                        choices=["training", "fitb"])
+    parser.add_argument("--embed-batch-size", type=int, help="Number of outfits embedded at once")
+    parser.add_argument("--embed-workers", type=int, help="Number of files embedded in parallel")
+    parser.add_argument("--embed-checkpoint-every", type=int,
+                        help="Number of batches after which the progress of the embedding is saved")
+    parser.add_argument("--embed-dtype", type=str, help="Data type of the stored embeddings",
+                        choices=["float16", "float32"])
+    parser.add_argument("--tflite-dir", type=str, help="Output directory of the TFLite models (quantize mode only)")
+    parser.add_argument("--calibration-outfits", type=int, help="Number of outfits for the int8 calibration")
+    parser.add_argument("--tflite-seq-length", type=int, help="Static length of the outfits of the TFLite models")
+    parser.add_argument("--tflite-candidate-count", type=int,
+                        help="Static number of the candidates of the TFLite models")
     parser.add_argument("--masking-mode", type=str, help="Mode of sequence masking",
                         choices=["single-token", "category-masking"])
     parser.add_argument("--valid-mode", type=str, help="Validation mode",
                         choices=["fitb", "masking"])
     parser.add_argument("--learning-rate", type=float, help="Optimizer's learning rate")
+    parser.add_argument("--fitb-batch-size", type=int, help="Number of FITB questions evaluated in one batch")
+    parser.add_argument("--fitb-embedding-table", type=utils.str_to_bool,
+                        help="Embed the distinct FITB candidates once per evaluation (features only)")
+    parser.add_argument("--embedding-quantization", type=str, choices=["none", "int8", "pq"],
+                        help="Quantization of the embedding table of the FITB candidates")
+    parser.add_argument("--pq-subspace-count", type=int, help="Number of subspaces of the product quantization")
     parser.add_argument("--valid-batch-size", type=int,
                         help="Batch size of validation dataset (by default the same as batch size)")
     parser.add_argument("--with-cnn", help="Use CNN to extract features from images", type=utils.str_to_bool, nargs='?',
                         const=True)
+    parser.add_argument("--image-size", type=int, help="Width and height of the input images of the CNN")
+    parser.add_argument("--image-cache-dir", type=str,
+                        help="Directory of the on-disk cache of decoded images (used only with CNN)")
+    parser.add_argument("--activation-cache-dir", type=str,
+                        help="Directory of the on-disk store of the frozen CNN layer activations, only the top CNN "
+                             "layers are run during training (used only with CNN)")
+    parser.add_argument("--activation-dtype", type=str, help="Dtype of the stored activations",
+                        choices=["float16", "float32"])
+    parser.add_argument("--cnn-recompute-grad", help="Recompute the CNN activations in the backward pass to save "
+                                                     "memory (used only with CNN)",
+                        type=utils.str_to_bool, nargs='?', const=True)
+    parser.add_argument("--data-service-address", type=str,
+                        help="Address of a tf.data service dispatcher that processes the training dataset, "
+                             "e.g. grpc://localhost:5050")
+    parser.add_argument("--data-service-mode", type=str, help="Processing mode of the tf.data service",
+                        choices=["distributed_epoch", "parallel_epochs"])
+    parser.add_argument("--data-service-workers", type=int,
+                        help="Number of the tf.data service workers, used to check the processing mode")
+    parser.add_argument("--graph-train", help="Compile the training step into a graph",
+                        type=utils.str_to_bool, nargs='?', const=True)
+    parser.add_argument("--steps-per-execution", type=int, help="Number of training steps per call of the compiled "
+                                                                "training function")
+    parser.add_argument("--jit-compile", help="Compile the training step, FITB step and inference with XLA",
+                        type=utils.str_to_bool, nargs='?', const=True)
+    parser.add_argument("--length-buckets", type=int, nargs="+",
+                        help="Lengths the outfits are padded to when compiling with XLA")
+    parser.add_argument("--dtype", type=str, help="Compute dtype of the model, the weights are kept in float32",
+                        choices=["float32", "bfloat16", "float16"])
     parser.add_argument("--category-embedding", help="Apply learned category embedding to image feature vectors",
                         type=utils.str_to_bool, nargs='?', const=True)
     parser.add_argument("--categories-count", type=int, help="Number of categories")
@@ -508,6 +1124,13 @@ def main():
                         type=utils.str_to_bool)
     parser.add_argument("--loss", type=str, help="Loss function", choices=["cross", "distance"])
     parser.add_argument("--margin", type=float, help="Margin of distance loss function")
+    parser.add_argument("--item-table", type=str, help="Path to the item table built by src.data.build_item_table")
+    parser.add_argument("--catalog-sample-size", type=int, help="Number of negatives sampled from the item table "
+                                                                "(per outfit with categorywise training, 0 to disable)")
+    parser.add_argument("--catalog-sampling-exponent", type=float,
+                        help="The negatives are sampled with probabilities proportional to count^exponent")
+    parser.add_argument("--memory-bank-size", type=int, help="Number of targets from the previous steps used as "
+                                                             "additional negatives (0 to disable)")
     parser.add_argument("--param-set", type=str, help="Name of the hyperparameter set to use as base", default="BASE")
     parser.add_argument("--category-attention", help="Compute keys and queries from categories",
                         type=utils.str_to_bool, nargs='?', const=True)
@@ -542,6 +1165,12 @@ def main():
         task.train()
     elif params["mode"] == "debug":
         task.debug()
+    elif params["mode"] == "export":
+        task.export()
+    elif params["mode"] == "quantize":
+        task.quantize()
+    elif params["mode"] == "embed":
+        task.embed()
     else:
         print("Invalid mode")
 
@@ -0,0 +1,86 @@
+import json
+from pathlib import Path
+import tensorflow as tf
+import src.models.encoder.item_embeddings as item_embeddings
+import src.models.encoder.retrieval as retrieval
+
+SIGNATURES = ["embed_items", "complete_outfit", "score_candidates"]
+
+
+class ServingModule(tf.Module):
+    """
+    Inference functions of the Fashion Encoder exported to a SavedModel
+
+    The functions have input signatures with unknown batch and outfit sizes, so they are traced only once.
+    The model runs in inference mode, so the exported graphs contain no dropout or other training-only ops.
+    """
+
+    def __init__(self, model: tf.keras.Model, name=None):
+        """
+        Create the functions
+
+        Args:
+            model: Fashion Encoder created with is_train=False
+            name: Name of the module
+        """
+        super(ServingModule, self).__init__(name=name)
+        self.model = model
+        self.preprocessor = model.get_layer("preprocessor")
+
+        # Shape and dtype of one item (features or image) as expected by the model
+        input_spec = model.inputs[0]
+        item_shape = input_spec.shape[2:].as_list()
+        items = tf.TensorSpec([None] + item_shape, input_spec.dtype, name="items")
+        outfits = tf.TensorSpec([None, None] + item_shape, input_spec.dtype, name="inputs")
+        categories = tf.TensorSpec([None, None], tf.int32, name="categories")
+
+        self.embed_items = tf.function(self._embed_items, input_signature=[
+            items, tf.TensorSpec([None], tf.int32, name="categories")])
+        self.complete_outfit = tf.function(self._complete_outfit, input_signature=[
+            outfits, categories, tf.TensorSpec([None, None, 1], tf.int32, name="mask_positions")])
+        self.score_candidates = tf.function(self._score_candidates, input_signature=[
+            outfits, categories, tf.TensorSpec([None, 1, 1], tf.int32, name="mask_positions"),
+            tf.TensorSpec([None, None] + item_shape, input_spec.dtype, name="candidates"),
+            tf.TensorSpec([None, None], tf.int32, name="candidate_categories")])
+
+    def _embed_items(self, items, categories):
+        embeddings = item_embeddings.embed_items(self.preprocessor, items, categories)
+        return {"embeddings": tf.cast(embeddings, tf.float32)}
+
+    def _complete_outfit(self, inputs, categories, mask_positions):
+        predictions = retrieval.masked_outputs(self.model, inputs, categories, mask_positions)
+        shape = tf.concat([tf.shape(mask_positions)[:2], [-1]], axis=0)
+        return {"predictions": tf.reshape(predictions, shape)}
+
+    def _score_candidates(self, inputs, categories, mask_positions, candidates, candidate_categories):
+        predictions = retrieval.masked_outputs(self.model, inputs, categories, mask_positions)
+
+        # The candidates of all the outfits are embedded at once
+        flat_candidates = tf.reshape(candidates, tf.concat([[-1], tf.shape(candidates)[2:]], axis=0))
+        embedded = item_embeddings.embed_items(self.preprocessor, flat_candidates,
+                                               tf.reshape(candidate_categories, [-1]))
+        embedded = tf.reshape(tf.cast(embedded, tf.float32), tf.concat([tf.shape(candidate_categories), [-1]], axis=0))
+
+        products = tf.einsum("bh,bch->bc", predictions, embedded)
+        squared_distances = tf.reduce_sum(tf.square(predictions), axis=-1, keepdims=True) \
+            + tf.reduce_sum(tf.square(embedded), axis=-1) - 2 * products
+        return {"dotproduct": products, "distance": tf.sqrt(tf.maximum(squared_distances, 0.))}
+
+
+def export_model(model: tf.keras.Model, export_dir: str, params: dict = None):
+    """
+    Save the model as a SavedModel with the signatures embed_items, complete_outfit and score_candidates
+
+    Args:
+        model: Fashion Encoder created with is_train=False
+        export_dir: Path to the output directory
+        params: optional hyperparameters saved to params.json next to the SavedModel
+    """
+    module = ServingModule(model)
+    signatures = {name: getattr(module, name) for name in SIGNATURES}
+    tf.saved_model.save(module, export_dir, signatures=signatures)
+
+    if params is not None:
+        serializable = {k: v for k, v in params.items() if isinstance(v, (str, int, float, bool, list, type(None)))}
+        with open(Path(export_dir, "params.json"), "w") as params_file:
+            json.dump(serializable, params_file, indent=2)
@@ -22,11 +22,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import re
+
 import tensorflow as tf
 
 import src.models.encoder.layers as layers
 import src.models.encoder.utils as utils
 
+# Number of the first InceptionV3 layers that are not fine-tuned
+FROZEN_CNN_LAYERS = 249
+
 
 def create_model(params, is_train):
     """Creates a Fashion Encoder model.
@@ -35,13 +40,19 @@ def create_model(params, is_train):
         params: hyperparameter object defining layer sizes, dropout values, etc.
         is_train: boolean, whether in training mode or not.
     """
+    set_precision_policy(params["dtype"])
+
     with tf.name_scope("model"):
 
         categories = tf.keras.layers.Input((None,), dtype="int32", name="categories")
         mask_positions = tf.keras.layers.Input((None, 1), dtype="int32", name="mask_positions")
 
-        if params["with_cnn"]:
-            inputs = tf.keras.layers.Input((None, 299, 299, 3), dtype="float32", name="inputs")
+        if params["with_cnn"] and "activation_cache_dir" in params:
+            # Activations of the frozen CNN layers, the shape is given by the CNN extractor
+            inputs = tf.keras.layers.Input((None, None, None, None), dtype=params["activation_dtype"], name="inputs")
+        elif params["with_cnn"]:
+            inputs = tf.keras.layers.Input((None, params["image_size"], params["image_size"], 3), dtype="float32",
+                                           name="inputs")
         else:
             inputs = tf.keras.layers.Input((None, params["feature_dim"]), dtype="float32", name="inputs")
 
@@ -56,6 +67,69 @@ def create_model(params, is_train):
         return tf.keras.Model([inputs, categories, mask_positions], [ret, training_targets])
 
 
+def set_precision_policy(dtype):
+    """Sets the global Keras policy for the layers created afterwards.
+
+    The variables are kept in float32 and the computations run in dtype, except for the layer normalizations
+    and the losses, which always use float32.
+
+    Args:
+        dtype: one of "float32", "bfloat16" (for CPUs with native bfloat16) and "float16" (for GPUs)
+    """
+    if dtype == "float32":
+        policy = "float32"
+    elif dtype in ("bfloat16", "float16"):
+        policy = "mixed_" + dtype
+    else:
+        raise RuntimeError("Unexpected dtype")
+    tf.keras.mixed_precision.set_global_policy(policy)
+
+
+def build_cnn(image_size=299):
+    """Creates the InceptionV3 feature extractor with ImageNet weights.
+
+    Args:
+        image_size: width and height of the input images, at least 75
+    """
+    return tf.keras.applications.inception_v3.InceptionV3(weights='imagenet', include_top=False, pooling='avg',
+                                                          input_shape=(image_size, image_size, 3))
+
+
+def split_cnn(cnn_model):
+    """Splits the CNN at the boundary of the frozen layers.
+
+    Args:
+        cnn_model: model created by build_cnn
+
+    Returns:
+        (trunk, top) where trunk maps the images to the activations of the last frozen layer
+        and top maps these activations to the visual features. Both share the layers with cnn_model.
+    """
+    boundary = cnn_model.layers[FROZEN_CNN_LAYERS - 1].output
+    trunk = tf.keras.Model(cnn_model.input, boundary, name="cnn_trunk")
+    top = tf.keras.Model(boundary, cnn_model.output, name="cnn_top")
+    return trunk, top
+
+
+def split_cnn_blocks(cnn_model):
+    """Splits the fine-tuned layers of the CNN into the Inception blocks.
+
+    Args:
+        cnn_model: model created by build_cnn
+
+    Returns:
+        List of models that share the layers with cnn_model. The first one takes the activations of the last frozen
+        layer, the last one returns the visual features.
+    """
+    block_ends = [layer.output for layer in cnn_model.layers[FROZEN_CNN_LAYERS:]
+                  if re.fullmatch(r"mixed\d+", layer.name)]
+    # The pooling is a part of the last block
+    block_ends[-1] = cnn_model.output
+    block_starts = [cnn_model.layers[FROZEN_CNN_LAYERS - 1].output] + block_ends[:-1]
+    return [tf.keras.Model(start, end, name="cnn_block_{}".format(i))
+            for i, (start, end) in enumerate(zip(block_starts, block_ends))]
+
+
 class FashionPreprocessorV2(tf.keras.Model):
     """Preprocessor component of the Fashion Encoder"""
 
@@ -157,15 +231,61 @@ class CNNExtractor(tf.keras.Model):
         """
         super(CNNExtractor, self).__init__(name=name)
         self.params = params
-        self.cnn_model = tf.keras.applications.inception_v3.InceptionV3(  # type: tf.keras.models.Model
-            weights='imagenet',
-            include_top=False,
-            pooling='avg')
-        for layer in self.cnn_model.layers[:249]:
+        cnn_model = build_cnn(params["image_size"])
+        for layer in cnn_model.layers[:FROZEN_CNN_LAYERS]:
             layer.trainable = False
-        for layer in self.cnn_model.layers[249:]:
+        for layer in cnn_model.layers[FROZEN_CNN_LAYERS:]:
             layer.trainable = True
 
+        # The full CNN is always tracked, so the checkpoints have the same layout with and without
+        # the activation cache
+        self.cnn_model = cnn_model  # type: tf.keras.models.Model
+        trunk, top = split_cnn(cnn_model)
+        if "activation_cache_dir" in params:
+            # The inputs are the precomputed activations of the frozen layers, only the top layers are run.
+            # The top shares the layers with the CNN and is kept in a closure, so it is not tracked twice
+            self._run_cnn = self._build_cnn_function(top)
+            self.item_shape = tuple(top.input_shape[1:])
+            trunk = None
+        else:
+            self._run_cnn = self._build_cnn_function(cnn_model)
+            self.item_shape = tuple(cnn_model.input_shape[1:])
+
+        if params["cnn_recompute_grad"]:
+            self._recomputed_cnn = self._build_recomputed_cnn(trunk, split_cnn_blocks(cnn_model))
+
+    @staticmethod
+    def _build_cnn_function(model):
+        """Wraps the model in a function, which is not tracked as an attribute of the extractor"""
+        def run(inputs):
+            return model(inputs)
+
+        return run
+
+    @staticmethod
+    def _build_recomputed_cnn(trunk, blocks):
+        """Builds a function that runs the CNN and recomputes the activations of the blocks in the backward pass.
+
+        Only the inputs of the fine-tuned blocks are kept for the backward pass instead of all their activations.
+        The frozen trunk has no trainable weights, so its activations are not kept anyway.
+        The function is not an attribute of the model, so the blocks don't appear twice in the saved weights.
+        The batch normalizations of the blocks run in inference mode: the recomputation runs outside the Keras
+        training context and would update the moving statistics once more, so both passes use the moving
+        statistics, which are not updated.
+        """
+        def inference_block(block):
+            return lambda inputs: block(inputs, training=False)
+
+        recomputed_blocks = [tf.recompute_grad(inference_block(block)) for block in blocks]
+
+        def run(inputs):
+            outputs = inputs if trunk is None else trunk(inputs)
+            for block in recomputed_blocks:
+                outputs = block(outputs)
+            return outputs
+
+        return run
+
     def get_config(self):
         return {
             "params": self.params,
@@ -178,6 +298,7 @@ class CNNExtractor(tf.keras.Model):
         Args:
             inputs: input tensor list of size 3
             First item, inputs: float tensor with shape [batch_size, input_length, image_width, image_height, 3]
+                or [batch_size, input_length] + activation shape of the frozen layers
             Second item, categories: int tensor with shape [batch_size, seq_length].
             Third item, mask positions: int tensor with shape [batch_size, 1, 1]
         """
@@ -190,13 +311,20 @@ class CNNExtractor(tf.keras.Model):
         batch_size = tf.shape(inputs)[0]
         seq_length = tf.shape(inputs)[1]
 
-        # Reduce the dimensions and get the CNN embeddings
-        inputs = tf.reshape(inputs, shape=(-1, 299, 299, 3))
-        cnn_outputs = self.cnn_model(inputs)
+        # Reduce the dimensions and get the CNN embeddings of the not padded images only
+        inputs = tf.reshape(inputs, shape=(-1,) + self.item_shape)
+        flat_categories = tf.reshape(categories, shape=[-1])
+        item_indices = tf.where(tf.not_equal(flat_categories, 0))
+        images = tf.gather_nd(inputs, item_indices)
+        if self.params["cnn_recompute_grad"]:
+            cnn_outputs = self._recomputed_cnn(images)
+        else:
+            cnn_outputs = self._run_cnn(images)
 
-        # Set the padded inputs to zeros
-        mask_matrix = utils.compute_padding_mask_from_categories(categories)
-        cnn_outputs = tf.einsum("ij,jk->ik", mask_matrix, cnn_outputs)
+        # Place the embeddings back, the padded inputs are set to zeros
+        cnn_outputs = tf.scatter_nd(item_indices, cnn_outputs,
+                                    shape=tf.stack([tf.shape(flat_categories, out_type=tf.int64)[0],
+                                                    self.params["feature_dim"]]))
 
         if self.params["mode"] == "debug":
             logger.debug("CNN outputs")
@@ -253,7 +381,7 @@ class FashionEncoder(tf.keras.Model):
                 logger.debug("Transformer inputs")
                 logger.debug(inputs)
 
-            attention_bias = utils.get_padding_bias(categories, 0)
+            attention_bias = utils.get_padding_bias(categories, 0, self.params["dtype"])
 
             if "category_attention" in self.params and self.params["category_attention"]:
                 one_hot_categories = tf.one_hot(categories, self.params["categories_count"])
@@ -309,7 +437,7 @@ class PrePostProcessingWrapper(tf.keras.layers.Layer):
         self.postprocess_dropout = params["layer_postprocess_dropout"]
 
     def build(self, input_shape):
-        # Create normalization layer
+        # Create normalization layer, the normalization is computed in float32 for numeric stability
         self.layer_norm = tf.keras.layers.LayerNormalization(
             epsilon=1e-6, dtype="float32")
         super(PrePostProcessingWrapper, self).build(input_shape)
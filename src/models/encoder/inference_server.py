@@ -0,0 +1,275 @@
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import tensorflow as tf
+
+
+class _Request:
+    """Outfit-completion or candidate-scoring request waiting in the queue of the batcher"""
+
+    def __init__(self, kind: str, items: np.ndarray, categories: np.ndarray, candidates: np.ndarray = None,
+                 candidate_categories: np.ndarray = None):
+        self.kind = kind
+        self.items = items
+        self.categories = categories
+        self.candidates = candidates
+        self.candidate_categories = candidate_categories
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+
+class ServingStats:
+    """Latencies, batch sizes and queue depth of the server, updated by the worker thread"""
+
+    def __init__(self, window: int = 10000):
+        """
+        Args:
+            window: Number of the latest requests the latency percentiles are computed from
+        """
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self._batch_sizes = collections.Counter()
+        self._request_count = 0
+        self._error_count = 0
+
+    def record_batch(self, latencies_ms, failed: bool = False):
+        with self._lock:
+            self._latencies.extend(latencies_ms)
+            self._batch_sizes[len(latencies_ms)] += 1
+            self._request_count += len(latencies_ms)
+            if failed:
+                self._error_count += len(latencies_ms)
+
+    def snapshot(self, queue_depth: int) -> dict:
+        with self._lock:
+            latencies = np.asarray(self._latencies)
+            return {
+                "requests": self._request_count,
+                "errors": self._error_count,
+                "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "batch_size_histogram": {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                "queue_depth": queue_depth
+            }
+
+
+class DynamicBatcher:
+    """
+    Runs the exported model in a dedicated worker thread on batches of the concurrent requests
+
+    The worker takes the first waiting request and collects the requests arriving within max_latency_ms
+    (up to max_batch_size), the outfits and the candidates of the batch are padded to the longest ones.
+    """
+
+    def __init__(self, export_dir: str, max_batch_size: int = 64, max_latency_ms: float = 5.0):
+        """
+        Load the SavedModel exported by the export mode of src.models.encoder.encoder_main
+
+        Args:
+            export_dir: Path to the SavedModel
+            max_batch_size: Maximum number of requests in a batch
+            max_latency_ms: Maximum time the first request of a batch waits for other requests
+        """
+        self._model = tf.saved_model.load(export_dir)
+        self._complete = self._model.signatures["complete_outfit"]
+        self._score = self._model.signatures["score_candidates"]
+        inputs_spec = self._complete.structured_input_signature[1]["inputs"]
+        self.item_shape = tuple(inputs_spec.shape[2:].as_list())
+        self.item_dtype = inputs_spec.dtype.as_numpy_dtype
+
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.stats = ServingStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, request: _Request) -> Future:
+        self._queue.put(request)
+        return request.future
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first: _Request):
+        """Collect the requests arriving within the latency window, None stops the worker"""
+        batch = [first]
+        deadline = first.arrival + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stopped = self._collect(first)
+            for kind in ("complete", "score"):
+                requests = [request for request in batch if request.kind == kind]
+                if requests:
+                    self._process(kind, requests)
+
+    def _pad_outfits(self, requests):
+        """Pad the outfits to the longest one, the mask token is placed at 0th index as in the FITB task"""
+        length = max(len(request.categories) for request in requests)
+        inputs = np.zeros((len(requests), length) + self.item_shape, dtype=self.item_dtype)
+        categories = np.zeros((len(requests), length), dtype=np.int32)
+        for i, request in enumerate(requests):
+            inputs[i, :len(request.items)] = request.items
+            categories[i, :len(request.categories)] = request.categories
+        mask_positions = np.zeros((len(requests), 1, 1), dtype=np.int32)
+        return inputs, categories, mask_positions
+
+    def _process(self, kind: str, requests):
+        failed = False
+        try:
+            inputs, categories, mask_positions = self._pad_outfits(requests)
+            if kind == "complete":
+                predictions = self._complete(inputs=tf.constant(inputs), categories=tf.constant(categories),
+                                             mask_positions=tf.constant(mask_positions))["predictions"].numpy()
+                results = [{"prediction": predictions[i, 0].tolist()} for i in range(len(requests))]
+            else:
+                count = max(len(request.candidate_categories) for request in requests)
+                candidates = np.zeros((len(requests), count) + self.item_shape, dtype=self.item_dtype)
+                candidate_categories = np.zeros((len(requests), count), dtype=np.int32)
+                for i, request in enumerate(requests):
+                    candidates[i, :len(request.candidates)] = request.candidates
+                    candidate_categories[i, :len(request.candidate_categories)] = request.candidate_categories
+                scores = self._score(inputs=tf.constant(inputs), categories=tf.constant(categories),
+                                     mask_positions=tf.constant(mask_positions), candidates=tf.constant(candidates),
+                                     candidate_categories=tf.constant(candidate_categories))
+                dotproduct, distance = scores["dotproduct"].numpy(), scores["distance"].numpy()
+                results = [{"dotproduct": dotproduct[i, :len(request.candidate_categories)].tolist(),
+                            "distance": distance[i, :len(request.candidate_categories)].tolist()}
+                           for i, request in enumerate(requests)]
+            for request, result in zip(requests, results):
+                request.future.set_result(result)
+        except Exception as error:
+            failed = True
+            for request in requests:
+                request.future.set_exception(error)
+
+        now = time.perf_counter()
+        self.stats.record_batch([(now - request.arrival) * 1000 for request in requests], failed)
+
+    def parse_request(self, kind: str, body: dict) -> _Request:
+        """
+        Create the request from the JSON body
+
+        The outfit is given by "items" and "categories", the blank item is added at 0th index with the category
+        "mask_category" (1 if not given). The scoring requests contain also "candidates" and "candidate_categories".
+        """
+        items = np.asarray(body["items"], dtype=self.item_dtype).reshape((-1,) + self.item_shape)
+        categories = np.asarray(body["categories"], dtype=np.int32)
+        if len(items) != len(categories):
+            raise ValueError("The number of items and categories differ")
+
+        placeholder = np.ones((1,) + self.item_shape, dtype=self.item_dtype)
+        items = np.concatenate([placeholder, items], axis=0)
+        categories = np.concatenate([[body.get("mask_category", 1)], categories]).astype(np.int32)
+
+        if kind == "complete":
+            return _Request(kind, items, categories)
+
+        candidates = np.asarray(body["candidates"], dtype=self.item_dtype).reshape((-1,) + self.item_shape)
+        candidate_categories = np.asarray(body["candidate_categories"], dtype=np.int32)
+        if len(candidates) != len(candidate_categories):
+            raise ValueError("The number of candidates and candidate categories differ")
+        if len(candidates) == 0:
+            raise ValueError("The request has no candidates")
+        return _Request(kind, items, categories, candidates, candidate_categories)
+
+
+def create_handler(batcher: DynamicBatcher, request_timeout: float = 30.0):
+    """
+    Create the request handler of the HTTP server
+
+    The handler serves POST /complete, POST /score and GET /metrics
+    """
+
+    class InferenceHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, content: dict):
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._send_json(200, batcher.stats.snapshot(batcher.queue_depth()))
+            else:
+                self._send_json(404, {"error": "Unknown path"})
+
+        def do_POST(self):
+            kinds = {"/complete": "complete", "/score": "score"}
+            if self.path not in kinds:
+                self._send_json(404, {"error": "Unknown path"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = batcher.parse_request(kinds[self.path], json.loads(self.rfile.read(length)))
+            except (ValueError, KeyError, TypeError) as error:
+                self._send_json(400, {"error": str(error)})
+                return
+            try:
+                self._send_json(200, batcher.submit(request).result(timeout=request_timeout))
+            except Exception as error:
+                self._send_json(500, {"error": str(error)})
+
+        def log_message(self, format, *args):
+            # The requests are reported by the metrics, not logged one by one
+            pass
+
+    return InferenceHandler
+
+
+def main():
+    """
+    Serve the exported model over HTTP on localhost with dynamic batching of the requests
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export-dir", type=str, help="Path to the exported SavedModel", required=True)
+    parser.add_argument("--host", type=str, help="Host of the server", default="localhost")
+    parser.add_argument("--port", type=int, help="Port of the server", default=8500)
+    parser.add_argument("--max-batch-size", type=int, help="Maximum number of requests in a batch", default=64)
+    parser.add_argument("--max-latency-ms", type=float, help="Maximum time a request waits for other requests",
+                        default=5.0)
+    parser.add_argument("--request-timeout", type=float, help="Timeout of a request in seconds", default=30.0)
+
+    args = parser.parse_args()
+
+    batcher = DynamicBatcher(args.export_dir, args.max_batch_size, args.max_latency_ms)
+    server = ThreadingHTTPServer((args.host, args.port), create_handler(batcher, args.request_timeout))
+    print("Serving at http://{}:{}".format(args.host, args.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import numpy as np
+import tensorflow as tf
+import src.data.input_pipeline as input_pipeline
+
+
+def embed_items(preprocessor, features, categories, training=False):
+    """
+    Embed items with the preprocessor in one batch, as the training targets (without masking)
+
+    Args:
+        preprocessor: preprocessor component of the model
+        features: float tensor of shape [item_count, feature_dim]
+        categories: int tensor of shape [item_count]
+        training: whether the preprocessor runs in training mode
+
+    Returns: float tensor of shape [item_count, hidden_size]
+
+    """
+    # The items form one outfit, only the embedded targets are used
+    mask_positions = tf.zeros([1, 1, 1], dtype=tf.int32)
+    _, targets = preprocessor([features[tf.newaxis], categories[tf.newaxis], mask_positions], training=training)
+    return targets[0]
+
+
+class ItemEmbeddingTable:
+    """
+    Embeddings of the catalog items computed by the preprocessor
+
+    The embeddings are computed in bulk once per checkpoint, the evaluation and scoring then gather the embeddings
+    by item indices instead of running the preprocessor on the same items again. With a quantizer, only the codes
+    of the embeddings are kept and the gathered embeddings are decoded.
+    """
+
+    def __init__(self, features: np.ndarray, categories: np.ndarray, path: str = None, batch_size: int = 4096,
+                 quantizer=None):
+        """
+        Create the table, the embeddings are computed by compute
+
+        Args:
+            features: ndarray of shape [item_count, feature_dim]
+            categories: int ndarray of shape [item_count]
+            path: optional path of a file the embeddings are memory-mapped to (kept in memory if None)
+            batch_size: Number of items embedded at once
+            quantizer: optional quantizer from src.models.encoder.quantization
+        """
+        self.features = features
+        self.categories = categories.astype(np.int32)
+        self.path = path
+        self.batch_size = batch_size
+        self.quantizer = quantizer
+        self.embeddings = None
+        self.codes = None
+        self._variable = None
+        self._embed_functions = {}
+
+    def __len__(self):
+        return len(self.categories)
+
+    def _get_embed_function(self, preprocessor):
+        if id(preprocessor) not in self._embed_functions:
+            self._embed_functions[id(preprocessor)] = tf.function(
+                lambda features, categories: embed_items(preprocessor, features, categories),
+                input_signature=[tf.TensorSpec([None, self.features.shape[1]], tf.float32),
+                                 tf.TensorSpec([None], tf.int32)])
+        return self._embed_functions[id(preprocessor)]
+
+    def compute(self, preprocessor):
+        """
+        Embed all the items with the current weights of the preprocessor
+
+        Args:
+            preprocessor: preprocessor component of the model
+        """
+        embed = self._get_embed_function(preprocessor)
+        embeddings = None
+        for start in range(0, len(self), self.batch_size):
+            batch = embed(tf.constant(self.features[start:start + self.batch_size], dtype=tf.float32),
+                          tf.constant(self.categories[start:start + self.batch_size])).numpy()
+            if embeddings is None:
+                shape = (len(self), batch.shape[1])
+                if self.path is not None:
+                    embeddings = np.memmap(self.path, dtype=np.float32, mode="w+", shape=shape)
+                else:
+                    embeddings = np.empty(shape, dtype=np.float32)
+            embeddings[start:start + len(batch)] = batch
+
+        if self.path is not None:
+            embeddings.flush()
+
+        if self.quantizer is not None:
+            # The quantizer is fitted to the embeddings of every checkpoint
+            self.quantizer.fit(embeddings)
+            self.codes = self.quantizer.encode(embeddings)
+            stored = self.codes
+        else:
+            self.embeddings = embeddings
+            stored = embeddings
+
+        if self._variable is None:
+            self._variable = tf.Variable(stored, trainable=False, name="item_embeddings")
+        else:
+            self._variable.assign(stored)
+
+    def gather(self, indices):
+        """
+        Get embeddings of the items
+
+        Args:
+            indices: int tensor of any shape
+
+        Returns: float tensor of shape indices.shape + [hidden_size]
+
+        """
+        if self.quantizer is not None:
+            return self.quantizer.decode_tensor(tf.gather(self._variable, indices))
+        return tf.gather(self._variable, indices)
+
+    def score(self, predictions, indices):
+        """
+        Score items by the dot product with the predictions
+
+        Args:
+            predictions: float tensor of shape [batch_size, hidden_size]
+            indices: int tensor of shape [batch_size, candidate_count]
+
+        Returns: float tensor of shape [batch_size, candidate_count]
+
+        """
+        return tf.einsum("bh,bch->bc", tf.cast(predictions, tf.float32), self.gather(indices))
+
+
+def _candidate_keys(targets, target_categories):
+    """Get the int64 keys of the FITB candidates of shape [batch_size, candidate_count]"""
+    flat_targets = tf.reshape(targets, [-1, tf.shape(targets)[-1]])
+    keys = input_pipeline.fingerprint_items(flat_targets, tf.reshape(target_categories, [-1]))
+    return tf.reshape(keys, tf.shape(target_categories))
+
+
+def index_fitb_candidates(dataset: tf.data.Dataset, quantizer=None):
+    """
+    Replace the candidates of FITB questions by indices into a table of the distinct candidates
+
+    The distinct candidates are collected in one pass over the dataset by their fingerprints, the returned dataset
+    maps the candidates to the indices by a lookup table of the fingerprints in the pipeline of the given dataset.
+
+    Args:
+        dataset: FITB dataset with features batched with padded_batch
+        quantizer: optional quantizer of the embeddings of the table
+
+    Returns: (ItemEmbeddingTable, dataset with elements
+        (inputs, input_categories, candidate_indices, target_categories, target_position), lookup table of the
+        indices used by the dataset, which must be kept as long as the dataset is used)
+
+    """
+    def valid_candidates(inputs, input_categories, targets, target_categories, target_position):
+        valid = tf.not_equal(target_categories, 0)
+        return tf.boolean_mask(_candidate_keys(targets, target_categories), valid), \
+               tf.boolean_mask(targets, valid), tf.boolean_mask(target_categories, valid)
+
+    seen = set()
+    keys = []
+    features = []
+    categories = []
+    for batch_keys, batch_features, batch_categories in dataset.map(valid_candidates):
+        batch_keys = batch_keys.numpy()
+        # First occurrence of every key of the batch, in the batch order
+        first = np.sort(np.unique(batch_keys, return_index=True)[1])
+        new = [i for i, key in zip(first, batch_keys[first].tolist()) if key not in seen]
+        seen.update(batch_keys[new].tolist())
+        keys.append(batch_keys[new])
+        features.append(batch_features.numpy()[new])
+        categories.append(batch_categories.numpy()[new])
+
+    keys = np.concatenate(keys)
+    lookup = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(tf.constant(keys, dtype=tf.int64),
+                                            tf.range(len(keys), dtype=tf.int32)), 0)
+
+    def index_candidates(inputs, input_categories, targets, target_categories, target_position):
+        # The padded candidates get index 0, they are masked by their category
+        candidate_indices = tf.where(tf.not_equal(target_categories, 0),
+                                     lookup.lookup(_candidate_keys(targets, target_categories)), 0)
+        return inputs, input_categories, candidate_indices, target_categories, target_position
+
+    indexed_dataset = dataset.map(index_candidates, tf.data.experimental.AUTOTUNE)
+
+    table = ItemEmbeddingTable(np.concatenate(features), np.concatenate(categories), quantizer=quantizer)
+    return table, indexed_dataset, lookup
@@ -169,7 +169,7 @@ class CategoryAdder(tf.keras.layers.Layer):
 
             # Optionally replace mask category embedding with zero tensor
             if not self.params["with_mask_category_embedding"] and mask_positions is not None:
-                zero_tensor = tf.zeros(shape=(self.params["category_dim"],))
+                zero_tensor = tf.zeros(shape=(self.params["category_dim"],), dtype=embedded_categories.dtype)
                 embedded_categories = utils.place_tensor_on_positions(embedded_categories, zero_tensor, mask_positions)
 
             if self.params["mode"] == "debug":
@@ -216,7 +216,7 @@ class CategoryMultiplier(tf.keras.layers.Layer):
 
             # Replace mask category embedding with ones tensor
             if not self.params["with_mask_category_embedding"] and mask_positions is not None:
-                ones_tensor = tf.ones(shape=(self.params["category_dim"],))
+                ones_tensor = tf.ones(shape=(self.params["category_dim"],), dtype=embedded_categories.dtype)
                 embedded_categories = utils.place_tensor_on_positions(embedded_categories, ones_tensor, mask_positions)
 
             if self.params["mode"] == "debug":
@@ -267,15 +267,14 @@ class CategoryConcater(tf.keras.layers.Layer):
 
             flat_categories = tf.reshape(categories, shape=(-1, 1))
 
-            mask_matrix = utils.compute_padding_mask_from_categories(categories)
-
             batch_size = tf.shape(inputs)[0]
             seq_length = tf.shape(inputs)[1]
 
             embedded_categories = self.category_embedding(flat_categories)
             embedded_categories = tf.squeeze(embedded_categories, axis=1)
             # Apply mask so the category embedding is zero at padded positions
-            embedded_categories = tf.einsum("ij,jk->ik", mask_matrix, embedded_categories)
+            mask = utils.compute_padding_mask_from_categories(categories)
+            embedded_categories = tf.where(mask, embedded_categories, tf.zeros_like(embedded_categories))
             embedded_categories = tf.reshape(embedded_categories,
                                              shape=(batch_size, seq_length, self.params["category_dim"]))
 
@@ -429,8 +428,9 @@ class SelfAttention(Attention):
             query_input, categories, query_input, bias, training, cache, decode_loop_step)
 
 class Dense3D(tf.keras.layers.Layer):
-    """A Dense Layer using 3D kernel with tf.einsum implementation.
-    Implementation from Tensorflow Official Models - NOT MODIFIED
+    """A Dense Layer using 3D kernel.
+    Implementation from Tensorflow Official Models - the einsums are replaced by equivalent matrix multiplications
+    of the reshaped kernel, which the TFLite converter can quantize to int8
 
     Attributes:
       num_attention_heads: An integer, number of attention heads for each
@@ -551,10 +551,17 @@ class Dense3D(tf.keras.layers.Layer):
             kernel = self.kernel
             bias = self.bias
 
+        # Matrix multiplication of the inputs flattened to [batch_size * sequence_length, input_size]
+        batch_shape = tf.shape(inputs)[:2]
         if self.output_projection:
-            ret = tf.einsum("abcd,cde->abe", inputs, kernel)
+            flat_inputs = tf.reshape(inputs, [-1, self.num_attention_heads * self.size_per_head])
+            flat_kernel = tf.reshape(kernel, [self.num_attention_heads * self.size_per_head, self.hidden_size])
+            ret = tf.reshape(tf.matmul(flat_inputs, flat_kernel), tf.concat([batch_shape, [self.hidden_size]], 0))
         else:
-            ret = tf.einsum("abc,cde->abde", inputs, kernel)
+            flat_inputs = tf.reshape(inputs, [-1, self.last_dim])
+            flat_kernel = tf.reshape(kernel, [self.last_dim, self.hidden_size])
+            ret = tf.reshape(tf.matmul(flat_inputs, flat_kernel),
+                             tf.concat([batch_shape, [self.num_attention_heads, self.size_per_head]], 0))
         if self.use_bias:
             ret += bias
         if self.activation is not None:
@@ -1,7 +1,8 @@
 import tensorflow as tf
 
 _NEG_INF_FP32 = -1e9
-_INF_FP32 = 1e9
+# Smallest squared distance, the gradient of the square root is not defined at zero
+_MIN_SQUARED_DISTANCE = 1e-12
 
 
 def _get_mask_positions_weights(mask_positions, categories):
@@ -26,10 +27,79 @@ def _get_mask_positions_weights(mask_positions, categories):
     return weights
 
 
+def get_mask_indices(categories, mask_positions):
+    """
+    Get indices of the masked items in the flattened batch
+
+    Args:
+        categories: int tensor with shape [batch_size, seq_length]
+        mask_positions: int tensor with shape [batch_size, 1, 1]
+
+    Returns: int tensor of shape [batch_size] with indices into [batch_size * seq_length]
+
+    """
+    seq_length = tf.shape(categories)[1]
+    return tf.range(tf.shape(mask_positions)[0]) * seq_length + tf.reshape(mask_positions, [-1])
+
+
+class NegativeMemoryBank(tf.Module):
+    """
+    FIFO queue of the target embeddings from the previous training steps
+
+    The embeddings are used as additional negatives of the cross-entropy loss, so the number of negatives doesn't
+    depend on the batch size. The targets of the masked items are enqueued with their categories and keys after
+    every step, the slots that were not written yet have category 0 and are ignored. The stored copies of the masked
+    item of a prediction are recognized by the key and ignored too. No gradient flows to the stored embeddings.
+    """
+
+    def __init__(self, size: int, hidden_size: int, name=None):
+        """
+        Create an empty memory bank
+
+        Args:
+            size: Number of stored embeddings
+            hidden_size: Dimension of the embeddings
+            name: Name of the module
+        """
+        super(NegativeMemoryBank, self).__init__(name=name)
+        self.size = size
+        self.embeddings = tf.Variable(tf.zeros([size, hidden_size]), trainable=False, name="embeddings")
+        self.categories = tf.Variable(tf.zeros([size], dtype=tf.int32), trainable=False, name="categories")
+        self.keys = tf.Variable(tf.zeros([size], dtype=tf.int64), trainable=False, name="keys")
+        self.position = tf.Variable(0, trainable=False, name="position")
+
+    def enqueue(self, embeddings, categories, keys=None):
+        """
+        Replace the oldest embeddings
+
+        Args:
+            embeddings: float tensor of shape [count, hidden_size]
+            categories: int tensor of shape [count]
+            keys: optional int64 tensor of shape [count], the keys of the items (zeros if not given)
+        """
+        if keys is None:
+            keys = tf.zeros(tf.shape(categories), dtype=tf.int64)
+        count = tf.minimum(tf.shape(embeddings)[0], self.size)
+        embeddings = tf.stop_gradient(embeddings[-count:])
+        categories = categories[-count:]
+        keys = keys[-count:]
+
+        indices = tf.math.floormod(self.position + tf.range(count), self.size)[:, tf.newaxis]
+        self.embeddings.scatter_nd_update(indices, embeddings)
+        self.categories.scatter_nd_update(indices, categories)
+        self.keys.scatter_nd_update(indices, keys)
+        self.position.assign(tf.math.floormod(self.position + count, self.size))
+
+
 def xentropy_loss(y_pred, y_true, categories, mask_positions,
                   acc: tf.keras.metrics.CategoricalAccuracy = None,
                   debug: bool = False,
-                  categorywise_only: bool = False):
+                  categorywise_only: bool = False,
+                  memory_bank: NegativeMemoryBank = None,
+                  sampled_targets=None,
+                  sampled_log_q=None,
+                  sampled_hits=None,
+                  target_keys=None):
     """
     Computes cross-entropy loss from the predictions
     
@@ -41,15 +111,23 @@ def xentropy_loss(y_pred, y_true, categories, mask_positions,
         acc: CategoricalAccuracy
         debug: Enable debug mode
         categorywise_only: Compute loss only from the products of same categories
-
-    Returns: Mean cross-entropy loss of the predictions
+        memory_bank: optional NegativeMemoryBank with additional negatives, the masked targets are enqueued into it
+        sampled_targets: optional negatives sampled from the item catalog, float tensor of shape
+            [sample_count, hidden_size] shared by all predictions or [batch_size, sample_count, hidden_size]
+        sampled_log_q: log probabilities of sampling the negatives, float tensor of shape [sample_count]
+            or [batch_size, sample_count], used for the log-Q correction of the sampled logits
+        sampled_hits: optional bool tensor of shape [batch_size, sample_count], true where the sampled negative
+            is the masked item itself, these accidental hits are removed from the logits
+        target_keys: optional int64 tensor of shape [batch_size], the keys of the masked items, the entries of
+            the memory bank with the key of the masked item are removed from the logits and the keys are enqueued
+
+    Returns: Mean cross-entropy loss of the predictions, the loss is always computed in float32
 
     """
     logger = tf.get_logger()
 
-    # Compute loss only from mask token
-    weights = _get_mask_positions_weights(mask_positions,categories)
-    weights_sum = tf.reduce_sum(weights)
+    y_pred = tf.cast(y_pred, tf.float32)
+    y_true = tf.cast(y_true, tf.float32)
 
     # Reshape to [batch_size * seq_length, hidden_size]
     hidden_size = y_pred.shape[2]
@@ -57,14 +135,18 @@ def xentropy_loss(y_pred, y_true, categories, mask_positions,
     true_batch = tf.reshape(y_true, [-1, hidden_size])
     item_count = tf.shape(true_batch)[0]
 
-    # Dot product of every prediction with all labels
-    logits = tf.matmul(pred_batch, true_batch, transpose_b=True)
+    # Compute loss only from mask token, gather the predictions at the mask positions [batch_size, hidden_size]
+    mask_indices = get_mask_indices(categories, mask_positions)
+    predictions = tf.gather(pred_batch, mask_indices)
+    flat_categories = tf.reshape(categories, [-1])
+    pred_categories = tf.gather(flat_categories, mask_indices)
+
+    # Dot product of every prediction with all labels [batch_size, batch_size * seq_length]
+    logits = tf.matmul(predictions, true_batch, transpose_b=True)
 
     # Compute logits only within categories
     if categorywise_only:
-        flat_categories = tf.reshape(categories, [-1])
-        cat_mask = tf.equal(flat_categories[:, tf.newaxis], flat_categories[tf.newaxis, :])
-        cat_mask = tf.logical_not(cat_mask)
+        cat_mask = tf.not_equal(pred_categories[:, tf.newaxis], flat_categories[tf.newaxis, :])
         cat_mask = tf.cast(cat_mask, dtype="float32")
         cat_bias = cat_mask * _NEG_INF_FP32  # -inf on cells when categories don't match
         logits = tf.add(logits, cat_bias)
@@ -73,29 +155,67 @@ def xentropy_loss(y_pred, y_true, categories, mask_positions,
             logger.debug(cat_bias)
 
     if debug:
-        logger.debug("Loss weights")
-        logger.debug(weights)
+        logger.debug("Mask indices")
+        logger.debug(mask_indices)
         logger.debug("Item Count")
         logger.debug(item_count)
         logger.debug("Logits")
         logger.debug(logits)
 
-    # One-hot labels (indentity matrix)
-    labels = tf.eye(item_count, item_count)
+    # Append the logits of the negatives from the previous steps
+    if memory_bank is not None:
+        bank_logits = tf.matmul(predictions, memory_bank.embeddings, transpose_b=True)  # [batch_size, bank_size]
+        bank_mask = tf.equal(memory_bank.categories, 0)[tf.newaxis, :]  # Empty slots
+        if categorywise_only:
+            bank_mask = tf.logical_or(bank_mask, tf.not_equal(tf.cast(pred_categories, tf.int32)[:, tf.newaxis],
+                                                              memory_bank.categories[tf.newaxis, :]))
+        if target_keys is not None:
+            # Earlier copies of the masked item are not negatives
+            bank_mask = tf.logical_or(bank_mask, tf.equal(target_keys[:, tf.newaxis], memory_bank.keys[tf.newaxis, :]))
+        bank_logits = tf.add(bank_logits, tf.cast(bank_mask, dtype="float32") * _NEG_INF_FP32)
+        logits = tf.concat([logits, bank_logits], axis=1)
+
+        if debug:
+            logger.debug("Memory bank logits")
+            logger.debug(bank_logits)
+
+    # Append the logits of the negatives sampled from the catalog
+    if sampled_targets is not None:
+        sampled_targets = tf.cast(sampled_targets, tf.float32)
+        if sampled_targets.shape.rank == 2:
+            sampled_logits = tf.matmul(predictions, sampled_targets, transpose_b=True)
+        else:
+            sampled_logits = tf.einsum("bh,bkh->bk", predictions, sampled_targets)
+
+        # Log-Q correction, the sampled logits estimate the logits of the whole catalog
+        sample_count = tf.cast(tf.shape(sampled_logits)[1], tf.float32)
+        sampled_logits -= sampled_log_q + tf.math.log(sample_count)
+        if sampled_hits is not None:
+            sampled_logits += tf.cast(sampled_hits, tf.float32) * _NEG_INF_FP32
+        logits = tf.concat([logits, sampled_logits], axis=1)
+
+        if debug:
+            logger.debug("Sampled logits")
+            logger.debug(sampled_logits)
+
+    # One-hot labels, 1 on the position of the masked item
+    labels = tf.one_hot(mask_indices, tf.shape(logits)[1])
 
     if acc is not None:
-        acc(labels, logits, sample_weight=weights)
+        acc(labels, logits)
 
     # Compute cross entropy on the masked positions
     cross_entropy = tf.nn.softmax_cross_entropy_with_logits(labels=labels, logits=logits)
-    cross_entropy = tf.tensordot(cross_entropy, weights, 1)
 
     if debug:
         logger.debug("Cross Entropy")
         logger.debug(cross_entropy)
 
+    if memory_bank is not None:
+        memory_bank.enqueue(tf.gather(true_batch, mask_indices), tf.cast(pred_categories, tf.int32), target_keys)
+
     # Return the mean of the losses
-    return tf.reduce_sum(cross_entropy) / weights_sum
+    return tf.reduce_mean(cross_entropy)
 
 
 def fitb_dotproduct_acc(y_pred, y_true, pred_positions, target_position, pred_categories,
@@ -118,6 +238,9 @@ def fitb_dotproduct_acc(y_pred, y_true, pred_positions, target_position, pred_ca
     """
     logger = tf.get_logger()
 
+    y_pred = tf.cast(y_pred, tf.float32)
+    y_true = tf.cast(y_true, tf.float32)
+
     weights = _get_mask_positions_weights(pred_positions, pred_categories)
 
     if debug:
@@ -156,6 +279,44 @@ def fitb_dotproduct_acc(y_pred, y_true, pred_positions, target_position, pred_ca
     return logits
 
 
+def fitb_batch_correct(y_pred, y_true, target_categories, target_position):
+    """
+    Evaluate a batch of FITB questions with dot-product and Euclidean distance similarity
+
+    Args:
+        y_pred: predictions at the mask positions, float tensor of shape [batch_size, hidden_size]
+        y_true: candidates embedded with the preprocessor, float tensor of shape
+            [batch_size, candidates_count, hidden_size]
+        target_categories: categories of the candidates, int tensor of shape [batch_size, candidates_count],
+            the padded candidates have category 0 and are never chosen
+        target_position: positions of the correct candidates, int tensor of shape [batch_size]
+
+    Returns: (dotproduct_correct, distance_correct) bool tensors of shape [batch_size]
+
+    """
+    y_pred = tf.cast(y_pred, tf.float32)
+    y_true = tf.cast(y_true, tf.float32)
+    target_position = tf.cast(target_position, tf.int32)
+    candidate_mask = tf.not_equal(target_categories, 0)
+
+    products = tf.einsum("bh,bch->bc", y_pred, y_true)
+
+    # The most similar candidate by dot product
+    logits = tf.where(candidate_mask, products, _NEG_INF_FP32)
+    dotproduct_correct = tf.equal(tf.argmax(logits, axis=-1, output_type=tf.int32), target_position)
+
+    # The closest candidate, the squared distances keep the order of the distances
+    squared = tf.reduce_sum(tf.square(y_pred), axis=-1, keepdims=True) \
+        + tf.reduce_sum(tf.square(y_true), axis=-1) - 2 * products
+    squared = tf.where(candidate_mask, squared, tf.float32.max)
+    dist_to_pos = tf.gather(squared, target_position, batch_dims=1)
+    is_target = tf.equal(tf.range(tf.shape(squared)[1])[tf.newaxis, :], target_position[:, tf.newaxis])
+    dist_to_neg = tf.reduce_min(tf.where(is_target, tf.float32.max, squared), axis=-1)
+    distance_correct = tf.less_equal(dist_to_pos, dist_to_neg)
+
+    return dotproduct_correct, distance_correct
+
+
 def get_distances(a, b):
     """
     Compute distances between vectors a and b
@@ -167,17 +328,17 @@ def get_distances(a, b):
     Returns: Euclidean distances to from of vectors a to b. Tensor of shape [a_count, b_count]
 
     """
-    # Create tiles of shape [a_count, b_count, hidden_size]
-    a = tf.expand_dims(a, 1)
-    b = tf.expand_dims(b, 0)
-    a = tf.tile(a, [1, b.shape[1], 1])
-    b = tf.tile(b, [a.shape[0], 1, 1])
+    # d(a,b)^2 = |a|^2 + |b|^2 - 2ab, computed without the [a_count, b_count, hidden_size] differences
+    a_squared = tf.reduce_sum(tf.square(a), axis=-1, keepdims=True)  # [a_count, 1]
+    b_squared = tf.reduce_sum(tf.square(b), axis=-1)[tf.newaxis, :]  # [1, b_count]
+    squared = a_squared + b_squared - 2 * tf.matmul(a, b, transpose_b=True)
 
-    sub = a - b  # d(a,b) = |a-b|
-    return tf.math.reduce_euclidean_norm(sub, axis=-1)
+    # The rounding errors may cause small negative values
+    squared = tf.maximum(squared, _MIN_SQUARED_DISTANCE)
+    return tf.sqrt(squared)
 
 
-def get_distances_to_targets(y_pred, y_true, pred_positions, target_positions, debug=False):
+def get_distances_to_targets(y_pred, y_true, pred_positions, target_positions, debug=False, target_mask=None):
     """
     Compute distances to the correct targets and distances to the closest incorrect candidates
 
@@ -188,12 +349,17 @@ def get_distances_to_targets(y_pred, y_true, pred_positions, target_positions, d
         pred_positions: positions of the predictions, int tensor of shape [batch_size, 1, 1]
         target_positions: positions of the correct items, int tensor of shape [batch_size, 1, 1]
         debug: enable debug mode
+        target_mask: optional bool tensor of shape [batch_size, true_seq_length], the targets with False
+            (e.g. padding) are never the closest negatives
 
     Returns: Pair (distances to positives, distances to negatives), both float tensors of shape [batch_size,]
 
     """
     logger = tf.get_logger()
 
+    y_pred = tf.cast(y_pred, tf.float32)
+    y_true = tf.cast(y_true, tf.float32)
+
     r = tf.range(0, limit=tf.shape(pred_positions)[0])
     r = tf.reshape(r, shape=[tf.shape(r)[0], -1, 1])
     # indices of predictions [batch_size, 2]
@@ -202,16 +368,20 @@ def get_distances_to_targets(y_pred, y_true, pred_positions, target_positions, d
 
     targets = tf.reshape(y_true, [-1, y_true.shape[-1]])
     dist = get_distances(predictions, targets)
-    dist = tf.reshape(dist, (dist.shape[0], y_true.shape[0], -1))  # [batch_size, batch_size, seq_length]
+    dist = tf.reshape(dist, (tf.shape(dist)[0], tf.shape(y_true)[0], -1))  # [batch_size, batch_size, seq_length]
 
     # indices of correct targets [batch_size, 2]
     target_indices = tf.squeeze(tf.concat([r, target_positions], axis=-1), axis=[1])
     dist_to_pos = tf.gather_nd(dist, target_indices, 1)  # [batch_size,]
 
+    # Replace distances to masked targets with max float, so they don't affect min aggregation
+    if target_mask is not None:
+        dist = tf.where(target_mask[tf.newaxis, :, :], dist, tf.float32.max)
+
     # Replace distances with true targets with max float, so they don't affect min aggregation
     r = tf.squeeze(r, axis=[1])
     target_indices = tf.concat([r, target_indices], axis=-1)  # [batch_size, 3]
-    updates = tf.repeat(tf.constant(tf.float32.max, shape=1), target_indices.shape[0])
+    updates = tf.repeat(tf.constant(tf.float32.max, shape=1), tf.shape(target_indices)[0])
     dist_to_neg = tf.tensor_scatter_nd_update(dist, target_indices, updates)
     dist_to_neg = tf.math.reduce_min(dist_to_neg, axis=[-2, -1])  # [batch_size,]
 
@@ -272,27 +442,27 @@ def distance_loss(y_pred, y_true, categories, mask_positions, margin,
         acc: instance of tf.metrics.Accuracy
         debug: enable debug mode
 
-    Returns: Float value of the distance loss function
+    Returns: Float value of the distance loss function, the loss is always computed in float32
 
     """
     logger = tf.get_logger()
 
-    # Replace padding with max vectors
-    padding_indices = tf.where(tf.math.equal(categories, tf.zeros_like(categories)))
-    max_tensor = tf.repeat(tf.constant(_INF_FP32), [y_true.shape[-1]])
-    max_tensor = tf.expand_dims(max_tensor, 0)
-    max_tensor = tf.tile(max_tensor, [padding_indices.shape[0], 1])
-    y_true = tf.tensor_scatter_nd_update(y_true, padding_indices, max_tensor)
+    y_pred = tf.cast(y_pred, tf.float32)
+    y_true = tf.cast(y_true, tf.float32)
+
+    # Padding is never a negative item
+    padding_mask = tf.not_equal(categories, 0)
 
     # Get distances to correct items and aggregated distances to negative items, both of shapes [batch_size,]
-    dist_to_pos, dist_to_neg = get_distances_to_targets(y_pred, y_true, mask_positions, mask_positions, debug)
+    dist_to_pos, dist_to_neg = get_distances_to_targets(y_pred, y_true, mask_positions, mask_positions, debug,
+                                                        padding_mask)
 
     if acc is not None:
         _update_distance_accuracy(acc, dist_to_pos, dist_to_neg, debug)
 
     # Repeat the margin for every outfit of the batch
     margin = tf.constant(margin)
-    margin = tf.repeat(margin, dist_to_pos.shape[0])  # [batch_size,]
+    margin = tf.repeat(margin, tf.shape(dist_to_pos)[0])  # [batch_size,]
 
     # Compute the loss function
     loss = dist_to_pos - dist_to_neg + margin
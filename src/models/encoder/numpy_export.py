@@ -0,0 +1,225 @@
+import argparse
+import itertools
+import json
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+import src.models.encoder.fashion_encoder as fashion_enc
+import src.models.encoder.numpy_runtime as numpy_runtime
+import src.models.encoder.params as model_params
+
+# Hyperparameters that affect the inference of the model, saved with the weights
+CONFIG_KEYS = ["hidden_size", "num_heads", "num_hidden_layers", "filter_size", "feature_dim", "categories_count",
+               "category_dim", "category_embedding", "category_merge", "with_mask_category_embedding",
+               "masking_mode", "all_mask_category", "category_attention"]
+
+
+def collect_weights(model: tf.keras.Model) -> dict:
+    """
+    Get the weights of the preprocessor and the encoder needed for the inference
+
+    Args:
+        model: Fashion Encoder with precomputed features (without CNN)
+
+    Returns: dict of float32 ndarrays named by the layers of the model
+
+    """
+    preprocessor = model.get_layer("preprocessor")
+    encoder_stack = model.get_layer("encoder").encoder_stack
+
+    def value(variable):
+        return variable.numpy().astype(np.float32)
+
+    weights = {
+        "input_dense/kernel": value(preprocessor.input_dense.layer.kernel),
+        "input_dense/bias": value(preprocessor.input_dense.layer.bias),
+        "mask_tokens": value(preprocessor.masking_layer.tokens_embedding.embeddings),
+        "output_norm/gamma": value(encoder_stack.output_normalization.gamma),
+        "output_norm/beta": value(encoder_stack.output_normalization.beta)
+    }
+
+    if preprocessor.params["category_embedding"]:
+        category_layer = preprocessor.category_embedding
+        weights["category_embedding"] = value(category_layer.category_embedding.embeddings)
+        if hasattr(category_layer, "mask_category"):
+            weights["mask_category"] = value(category_layer.mask_category.embeddings)
+
+    for n, (attention_wrapper, ffn_wrapper) in enumerate(encoder_stack.layers):
+        prefix = "layer_{}/".format(n)
+        attention = attention_wrapper.layer
+        weights[prefix + "attention/query"] = value(attention.query_dense_layer.kernel)
+        weights[prefix + "attention/key"] = value(attention.key_dense_layer.kernel)
+        weights[prefix + "attention/value"] = value(attention.value_dense_layer.kernel)
+        weights[prefix + "attention/output_transform"] = value(attention.output_dense_layer.kernel)
+        weights[prefix + "attention/layer_norm/gamma"] = value(attention_wrapper.layer_norm.gamma)
+        weights[prefix + "attention/layer_norm/beta"] = value(attention_wrapper.layer_norm.beta)
+
+        ffn = ffn_wrapper.layer
+        weights[prefix + "ffn/filter/kernel"] = value(ffn.filter_dense_layer.kernel)
+        weights[prefix + "ffn/filter/bias"] = value(ffn.filter_dense_layer.bias)
+        weights[prefix + "ffn/output/kernel"] = value(ffn.output_dense_layer.kernel)
+        weights[prefix + "ffn/output/bias"] = value(ffn.output_dense_layer.bias)
+        weights[prefix + "ffn/layer_norm/gamma"] = value(ffn_wrapper.layer_norm.gamma)
+        weights[prefix + "ffn/layer_norm/beta"] = value(ffn_wrapper.layer_norm.beta)
+
+    return weights
+
+
+def export_weights(model: tf.keras.Model, path: str, params: dict):
+    """
+    Save the weights and the inference hyperparameters to an .npz file loaded by NumpyFashionEncoder.load
+
+    Args:
+        model: Fashion Encoder with precomputed features (without CNN), restored from a checkpoint
+        path: Path to the output .npz file
+        params: hyperparameters of the model
+
+    Returns: NumpyFashionEncoder with the exported weights
+
+    """
+    if params["with_cnn"]:
+        raise RuntimeError("The NumPy runtime supports only the models with precomputed features")
+
+    config = {key: params.get(key, False) for key in CONFIG_KEYS}
+    weights = collect_weights(model)
+    np.savez(path, config=np.asarray(json.dumps(config)), **weights)
+    return numpy_runtime.NumpyFashionEncoder(weights, config)
+
+
+def check_parity(model: tf.keras.Model, runtime: numpy_runtime.NumpyFashionEncoder, dataset,
+                 max_batches: int = 10) -> dict:
+    """
+    Compare the NumPy runtime with the model in inference mode on FITB batches
+
+    Args:
+        model: Fashion Encoder
+        runtime: NumpyFashionEncoder with the weights of the model
+        dataset: FITB dataset batched with padded_batch
+        max_batches: Number of the compared batches
+
+    Returns: dict with the maximal absolute differences of the outputs and the targets and the mean latencies
+        of a batch in milliseconds
+
+    """
+    output_difference = 0.
+    target_difference = 0.
+    tf_elapsed = 0.
+    numpy_elapsed = 0.
+    batches = 0
+    for inputs, input_categories, _, _, _ in dataset.take(max_batches):
+        # FITB mask token is placed at 0th index
+        mask_positions = tf.zeros([tf.shape(input_categories)[0], 1, 1], dtype=tf.int32)
+
+        start = time.perf_counter()
+        outputs, targets = model([inputs, input_categories, mask_positions], training=False)
+        outputs, targets = outputs.numpy(), targets.numpy()
+        tf_elapsed += time.perf_counter() - start
+
+        start = time.perf_counter()
+        numpy_outputs, numpy_targets = runtime(inputs.numpy(), input_categories.numpy(), mask_positions.numpy())
+        numpy_elapsed += time.perf_counter() - start
+
+        # The padded positions are not compared, their outputs are not used
+        valid = input_categories.numpy() != 0
+        output_difference = max(output_difference,
+                                float(np.max(np.abs(outputs - numpy_outputs)[valid], initial=0.)))
+        target_difference = max(target_difference,
+                                float(np.max(np.abs(targets - numpy_targets)[valid], initial=0.)))
+        batches += 1
+
+    return {
+        "batches": batches,
+        "max_output_difference": output_difference,
+        "max_target_difference": target_difference,
+        "tf_latency_ms": tf_elapsed / max(batches, 1) * 1000,
+        "numpy_latency_ms": numpy_elapsed / max(batches, 1) * 1000
+    }
+
+
+def _random_inputs(params: dict, batch_size: int, seq_length: int, rng: np.random.Generator):
+    """Random outfits of different lengths with one masked item each"""
+    lengths = rng.integers(2, seq_length + 1, size=batch_size)
+    valid = np.arange(seq_length) < lengths[:, np.newaxis]
+    inputs = rng.normal(size=[batch_size, seq_length, params["feature_dim"]]).astype(np.float32)
+    categories = rng.integers(1, params["categories_count"], size=[batch_size, seq_length]) * valid
+    mask_positions = rng.integers(0, lengths)[:, np.newaxis, np.newaxis]
+    return inputs, categories.astype(np.int32), mask_positions.astype(np.int32)
+
+
+def check_random_model(params: dict, seed: int = 1, batch_size: int = 4, seq_length: int = 6) -> dict:
+    """
+    Compare the NumPy runtime with a randomly initialized model
+
+    Every variable of the model is set to random values (including the biases and the layer normalizations),
+    so a weight exported under a wrong name or a runtime constant that differs from the model shows as
+    a difference of the outputs.
+
+    Args:
+        params: hyperparameters of the model without CNN
+        seed: Random seed of the weights and the inputs
+        batch_size: Number of the compared outfits
+        seq_length: Padded length of the outfits
+
+    Returns: dict with the maximal absolute differences of the outputs and the targets
+
+    """
+    rng = np.random.default_rng(seed)
+    model = fashion_enc.create_model(params, is_train=False)
+    for variable in model.weights:
+        variable.assign(rng.normal(scale=0.5, size=variable.shape).astype(variable.dtype.as_numpy_dtype))
+
+    config = {key: params.get(key, False) for key in CONFIG_KEYS}
+    runtime = numpy_runtime.NumpyFashionEncoder(collect_weights(model), config)
+
+    inputs, categories, mask_positions = _random_inputs(params, batch_size, seq_length, rng)
+    outputs, targets = model([inputs, categories, mask_positions], training=False)
+    numpy_outputs, numpy_targets = runtime(inputs, categories, mask_positions)
+
+    valid = categories != 0
+    return {
+        "max_output_difference": float(np.max(np.abs(outputs.numpy() - numpy_outputs)[valid])),
+        "max_target_difference": float(np.max(np.abs(targets.numpy() - numpy_targets)[valid]))
+    }
+
+
+def main():
+    """
+    Check the NumPy runtime against small random models for the supported combinations of the hyperparameters
+
+    The results are printed as JSON, the exit code is 1 if any difference exceeds the tolerance
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tolerance", type=float, help="Maximal absolute difference of the outputs", default=1e-3)
+    parser.add_argument("--seed", type=int, help="Random seed of the weights and the inputs", default=1)
+    args = parser.parse_args()
+
+    failed = False
+    for merge, masking_mode, category_attention, mask_category in itertools.product(
+            ["add", "multiply", "concat"], ["single-token", "category-masking"], [False, True], [True, False]):
+        params = {
+            **model_params.BASE,
+            "feature_dim": 12,
+            "hidden_size": 16,
+            "num_heads": 4,
+            "filter_size": 24,
+            "categories_count": 7,
+            "category_dim": 8 if merge == "concat" else 16,
+            "category_merge": merge,
+            "masking_mode": masking_mode,
+            "category_attention": category_attention,
+            "with_mask_category_embedding": mask_category
+        }
+        result = check_random_model(params, args.seed)
+        result["config"] = {"category_merge": merge, "masking_mode": masking_mode,
+                            "category_attention": category_attention, "with_mask_category_embedding": mask_category}
+        result["passed"] = max(result["max_output_difference"], result["max_target_difference"]) <= args.tolerance
+        failed = failed or not result["passed"]
+        print(json.dumps(result), flush=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import json
+import numpy as np
+
+# Keep in sync with src.models.encoder.utils, the runtime must not import TensorFlow
+_NEG_INF_FP32 = -1e9
+_LAYER_NORM_EPSILON = 1e-6
+
+
+def _layer_norm(x, gamma, beta):
+    mean = np.mean(x, axis=-1, keepdims=True)
+    variance = np.mean(np.square(x - mean), axis=-1, keepdims=True)
+    return (x - mean) / np.sqrt(variance + _LAYER_NORM_EPSILON) * gamma + beta
+
+
+def _softmax(x):
+    x = x - np.max(x, axis=-1, keepdims=True)
+    e = np.exp(x)
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+def _leaky_relu(x, alpha=0.2):
+    return np.where(x > 0, x, alpha * x)
+
+
+def _place_on_positions(values, updates, mask_positions):
+    """
+    Replace the vectors of values at mask_positions
+
+    Args:
+        values: ndarray of shape [batch_size, seq_length, dim]
+        updates: ndarray of shape [dim] or [batch_size, mask_count, dim]
+        mask_positions: int ndarray of shape [batch_size, mask_count, 1]
+    """
+    values = values.copy()
+    rows = np.arange(len(values))[:, np.newaxis]
+    values[rows, mask_positions[:, :, 0]] = updates
+    return values
+
+
+class NumpyFashionEncoder:
+    """
+    Inference of the Fashion Encoder with NumPy only
+
+    The weights are exported by src.models.encoder.numpy_export. The forward pass follows the preprocessor and
+    the encoder of src.models.encoder.fashion_encoder in inference mode (without dropout), all the items of a batch
+    are processed at once in float32.
+    """
+
+    def __init__(self, weights: dict, config: dict):
+        """
+        Args:
+            weights: dict of ndarrays named as by numpy_export
+            config: hyperparameters of the model that affect the inference
+        """
+        self.weights = {name: np.asarray(value, dtype=np.float32) for name, value in weights.items()}
+        self.config = config
+
+    @classmethod
+    def load(cls, path: str):
+        """Load the runtime from the .npz file written by numpy_export"""
+        with np.load(path) as archive:
+            config = json.loads(str(archive["config"]))
+            weights = {name: archive[name] for name in archive.files if name != "config"}
+        return cls(weights, config)
+
+    def _embed_categories(self, inputs, categories, mask_positions):
+        """Merge the inputs with the category embedding as the category layers of the preprocessor"""
+        merge = self.config["category_merge"]
+        embedded = self.weights["category_embedding"][categories]
+
+        # The padded items get the neutral embedding of the merge
+        padding = "ones" if merge == "multiply" else "zeros"
+        neutral = np.ones_like if padding == "ones" else np.zeros_like
+        embedded = np.where((categories != 0)[..., np.newaxis], embedded, neutral(embedded))
+
+        if not self.config["with_mask_category_embedding"] and mask_positions is not None:
+            if merge == "concat":
+                mask_category = self.weights["mask_category"][0]
+            else:
+                mask_category = neutral(embedded[0, 0])
+            embedded = _place_on_positions(embedded, mask_category, mask_positions)
+
+        if merge == "add":
+            return inputs + embedded
+        elif merge == "multiply":
+            return inputs * embedded
+        else:
+            return np.concatenate([inputs, embedded], axis=-1)
+
+    def preprocess(self, inputs, categories, mask_positions=None):
+        """
+        Project the items into the embedding space and place the mask tokens
+
+        Args:
+            inputs: float ndarray of shape [batch_size, seq_length, feature_dim]
+            categories: int ndarray of shape [batch_size, seq_length]
+            mask_positions: optional int ndarray of shape [batch_size, mask_count, 1]
+
+        Returns: (masked_inputs, targets) ndarrays of shape [batch_size, seq_length, hidden_size]
+
+        """
+        inputs = np.asarray(inputs, dtype=np.float32)
+        categories = np.asarray(categories, dtype=np.int64)
+
+        targets = _leaky_relu(inputs @ self.weights["input_dense/kernel"] + self.weights["input_dense/bias"])
+        masked_inputs = targets
+
+        if mask_positions is not None:
+            mask_positions = np.asarray(mask_positions, dtype=np.int64)
+            tokens = self.weights["mask_tokens"]
+            if self.config["masking_mode"] == "single-token":
+                updates = tokens[0]
+            else:
+                updates = tokens[np.take_along_axis(categories, mask_positions[:, :, 0], axis=1)]
+            masked_inputs = _place_on_positions(masked_inputs, updates, mask_positions)
+
+        if self.config["category_embedding"]:
+            targets = self._embed_categories(targets, categories, None)
+            if self.config.get("all_mask_category") and mask_positions is not None:
+                # Set all the categories of the outfit to the one of the masked item
+                mask_categories = np.take_along_axis(categories, mask_positions[:, 0], axis=1)
+                mask_categories = np.broadcast_to(mask_categories, categories.shape)
+                masked_inputs = self._embed_categories(masked_inputs, mask_categories, mask_positions)
+            else:
+                masked_inputs = self._embed_categories(masked_inputs, categories, mask_positions)
+
+        return masked_inputs, targets
+
+    def _attention(self, x, one_hot_categories, bias, prefix):
+        num_heads = self.config["num_heads"]
+        size_per_head = self.config["hidden_size"] // num_heads
+        batch_size, seq_length = x.shape[:2]
+
+        def project(values, name):
+            kernel = self.weights[prefix + name].reshape([values.shape[-1], -1])
+            return (values @ kernel).reshape([batch_size, seq_length, num_heads, size_per_head])
+
+        source = one_hot_categories if one_hot_categories is not None else x
+        query = project(source, "query") * size_per_head ** -0.5
+        key = project(source, "key")
+        value = project(x, "value")
+
+        # [batch_size, num_heads, seq_length, seq_length]
+        logits = np.einsum("bfnh,btnh->bnft", query, key) + bias
+        weights = _softmax(logits)
+        attention = np.einsum("bnft,btnh->bfnh", weights, value)
+
+        output_kernel = self.weights[prefix + "output_transform"].reshape([num_heads * size_per_head, -1])
+        return attention.reshape([batch_size, seq_length, -1]) @ output_kernel
+
+    def _feed_forward(self, x, prefix):
+        hidden = np.maximum(x @ self.weights[prefix + "filter/kernel"] + self.weights[prefix + "filter/bias"], 0)
+        return hidden @ self.weights[prefix + "output/kernel"] + self.weights[prefix + "output/bias"]
+
+    def encode(self, embedded, categories):
+        """
+        Run the encoder stack
+
+        Args:
+            embedded: float ndarray of shape [batch_size, seq_length, hidden_size]
+            categories: int ndarray of shape [batch_size, seq_length]
+
+        Returns: ndarray of shape [batch_size, seq_length, hidden_size]
+
+        """
+        categories = np.asarray(categories, dtype=np.int64)
+        bias = np.where(categories == 0, _NEG_INF_FP32, 0.).astype(np.float32)[:, np.newaxis, np.newaxis, :]
+
+        one_hot_categories = None
+        if self.config.get("category_attention"):
+            one_hot_categories = np.eye(self.config["categories_count"], dtype=np.float32)[categories]
+
+        x = embedded
+        for n in range(self.config["num_hidden_layers"]):
+            prefix = "layer_{}/".format(n)
+            y = _layer_norm(x, self.weights[prefix + "attention/layer_norm/gamma"],
+                            self.weights[prefix + "attention/layer_norm/beta"])
+            x = x + self._attention(y, one_hot_categories, bias, prefix + "attention/")
+            y = _layer_norm(x, self.weights[prefix + "ffn/layer_norm/gamma"],
+                            self.weights[prefix + "ffn/layer_norm/beta"])
+            x = x + self._feed_forward(y, prefix + "ffn/")
+
+        return _layer_norm(x, self.weights["output_norm/gamma"], self.weights["output_norm/beta"])
+
+    def __call__(self, inputs, categories, mask_positions):
+        """
+        Run the model as the Keras model in inference mode
+
+        Returns: (outputs, targets) ndarrays of shape [batch_size, seq_length, hidden_size]
+
+        """
+        masked_inputs, targets = self.preprocess(inputs, categories, mask_positions)
+        return self.encode(masked_inputs, categories), targets
+
+    def embed_items(self, features, categories):
+        """
+        Embed the items as the training targets
+
+        Args:
+            features: float ndarray of shape [item_count, feature_dim]
+            categories: int ndarray of shape [item_count]
+
+        Returns: ndarray of shape [item_count, hidden_size]
+
+        """
+        _, targets = self.preprocess(np.asarray(features)[np.newaxis], np.asarray(categories)[np.newaxis])
+        return targets[0]
+
+    def complete_outfit(self, inputs, categories, mask_positions):
+        """
+        Get the predictions of the masked items
+
+        Returns: ndarray of shape [batch_size, mask_count, hidden_size]
+
+        """
+        outputs, _ = self(inputs, categories, mask_positions)
+        rows = np.arange(len(outputs))[:, np.newaxis]
+        return outputs[rows, np.asarray(mask_positions)[:, :, 0]]
@@ -25,14 +25,39 @@ BASE = {
     "early_stop_warmup": 25,
     "early_stop": True,
     "with_cnn": False,
+    "image_size": 299,
+    "activation_dtype": "float16",
+    "data_service_mode": "distributed_epoch",
+    "cnn_recompute_grad": False,
     "target_gradient_from": 0,
     "loss": "cross",
+    "memory_bank_size": 0,
+    "catalog_sample_size": 0,
+    "catalog_sampling_exponent": 1.0,
     "valid_mode": "fitb",
+    "fitb_batch_size": 64,
+    "fitb_embedding_table": True,
+    "embedding_quantization": "none",
+    "pq_subspace_count": 16,
+    "calibration_outfits": 200,
+    "tflite_seq_length": 20,
+    "tflite_candidate_count": 4,
+    "export_format": "savedmodel",
+    "parity_tolerance": 1e-3,
+    "embed_schema": "training",
+    "embed_batch_size": 512,
+    "embed_workers": 4,
+    "embed_checkpoint_every": 50,
+    "embed_dtype": "float16",
     "dense_regularization": 0,
     "enc_regularization": 0,
     "emb_dropout": 0,
     "i_dense_dropout": 0.1,
     "category_attention": False,
+    "graph_train": True,
+    "steps_per_execution": 1,
+    "jit_compile": False,
+    "length_buckets": [4, 8, 12, 19],
     "mode": "train"
 }
 
@@ -0,0 +1,184 @@
+import numpy as np
+import tensorflow as tf
+import src.models.encoder.retrieval as retrieval
+
+
+def _assign_variable(variable, value: np.ndarray, name: str):
+    """
+    Create the variable or assign the value to it
+
+    The graphs decoding the codes read the variable, so the traced functions decode with the latest fit
+    """
+    if variable is None:
+        return tf.Variable(value, trainable=False, name=name)
+    variable.assign(value)
+    return variable
+
+
+class ScalarQuantizer:
+    """
+    Quantization of every dimension of the vectors to int8
+
+    Every dimension has its own symmetric scale given by its largest absolute value, a vector is stored in one byte
+    per dimension.
+    """
+
+    def __init__(self):
+        self.scale = None
+        self._scale_variable = None
+
+    @property
+    def code_size(self) -> int:
+        """Number of bytes of one encoded vector"""
+        return len(self.scale)
+
+    def fit(self, vectors: np.ndarray):
+        """Compute the scales of the dimensions"""
+        scale = np.max(np.abs(vectors), axis=0).astype(np.float32) / 127
+        scale[scale == 0] = 1
+        self.scale = scale
+        self._scale_variable = _assign_variable(self._scale_variable, scale, "quantizer_scale")
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """Encode the vectors of shape [count, dim] to int8 codes of shape [count, dim]"""
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Decode the codes of shape [count, dim] to float32 vectors of shape [count, dim]"""
+        return codes.astype(np.float32) * self.scale
+
+    def decode_tensor(self, codes):
+        """Decode the codes in a graph, codes is an int8 tensor of shape [..., dim]"""
+        return tf.cast(codes, tf.float32) * self._scale_variable
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray, metric: str = "dotproduct") -> np.ndarray:
+        """
+        Score the encoded items by asymmetric distance computation, the queries are not quantized
+
+        Args:
+            queries: ndarray of shape [query_count, dim]
+            codes: codes of shape [item_count, dim]
+            metric: "dotproduct" or "distance" (the scores are then q.x - |x|^2 / 2)
+
+        Returns: ndarray of shape [query_count, item_count]
+
+        """
+        # The scale is applied to the queries, so the codes are not decoded
+        scores = (queries * self.scale) @ codes.T.astype(np.float32)
+        if metric == "distance":
+            scores -= 0.5 * np.sum(np.square(self.decode(codes)), axis=1)
+        return scores
+
+
+class ProductQuantizer:
+    """
+    Product quantization of the vectors
+
+    The vectors are split into subspace_count subvectors and every subvector is replaced by the index of the closest
+    of the 256 centroids of its subspace, a vector is stored in subspace_count bytes. The dot products of a query
+    with the centroids are computed once per query, the score of an item is then a sum of subspace_count looked-up
+    values (asymmetric distance computation).
+    """
+
+    def __init__(self, subspace_count: int, iterations: int = 10, sample_size: int = 100000, seed: int = 1):
+        """
+        Create the quantizer, the centroids are computed by fit
+
+        Args:
+            subspace_count: Number of subspaces, must divide the dimension of the vectors
+            iterations: Number of k-means iterations
+            sample_size: Number of vectors the k-means is trained on
+            seed: Random seed of the k-means
+        """
+        self.subspace_count = subspace_count
+        self.iterations = iterations
+        self.sample_size = sample_size
+        self.seed = seed
+        self.codebooks = None
+        self._codebooks_variable = None
+
+    @property
+    def code_size(self) -> int:
+        """Number of bytes of one encoded vector"""
+        return self.subspace_count
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        """Reshape the vectors of shape [count, dim] to subvectors of shape [count, subspace_count, subspace_dim]"""
+        return np.asarray(vectors, dtype=np.float32).reshape([len(vectors), self.subspace_count, -1])
+
+    def fit(self, vectors: np.ndarray):
+        """Compute the centroids of every subspace by k-means"""
+        if vectors.shape[1] % self.subspace_count != 0:
+            raise RuntimeError("The number of PQ subspaces must divide the dimension of the vectors")
+        rng = np.random.default_rng(self.seed)
+        subvectors = self._split(vectors)
+        codebooks = np.zeros([self.subspace_count, 256, subvectors.shape[2]], dtype=np.float32)
+        for m in range(self.subspace_count):
+            centroids = retrieval.kmeans(subvectors[:, m], 256, self.iterations, self.sample_size, rng)
+            # Repeated centroids fill the codebook if there are fewer than 256 vectors
+            codebooks[m] = centroids[np.arange(256) % len(centroids)]
+        self.codebooks = codebooks
+        # Flattened to [subspace_count * 256, subspace_dim] for the decoding in a graph
+        self._codebooks_variable = _assign_variable(self._codebooks_variable,
+                                                    codebooks.reshape([-1, codebooks.shape[2]]), "pq_codebooks")
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """Encode the vectors of shape [count, dim] to uint8 codes of shape [count, subspace_count]"""
+        subvectors = self._split(vectors)
+        codes = np.empty([len(vectors), self.subspace_count], dtype=np.uint8)
+        for m in range(self.subspace_count):
+            codes[:, m] = retrieval.assign_clusters(subvectors[:, m], self.codebooks[m])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Decode the codes of shape [count, subspace_count] to float32 vectors of shape [count, dim]"""
+        subvectors = self.codebooks[np.arange(self.subspace_count), codes.astype(np.int64)]
+        return subvectors.reshape([len(codes), -1])
+
+    def decode_tensor(self, codes):
+        """Decode the codes in a graph, codes is an uint8 tensor of shape [..., subspace_count]"""
+        indices = tf.cast(codes, tf.int32) + tf.range(self.subspace_count) * 256
+        subvectors = tf.gather(self._codebooks_variable, indices)
+        return tf.reshape(subvectors, tf.concat([tf.shape(codes)[:-1], [-1]], axis=0))
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray, metric: str = "dotproduct") -> np.ndarray:
+        """
+        Score the encoded items by asymmetric distance computation, the queries are not quantized
+
+        Args:
+            queries: ndarray of shape [query_count, dim]
+            codes: codes of shape [item_count, subspace_count]
+            metric: "dotproduct" or "distance" (the scores are then q.x - |x|^2 / 2)
+
+        Returns: ndarray of shape [query_count, item_count]
+
+        """
+        # Score of every centroid for every query, the scores of the items are sums of the looked-up values
+        tables = np.einsum("qmd,mkd->qmk", self._split(queries), self.codebooks)
+        if metric == "distance":
+            tables -= 0.5 * np.sum(np.square(self.codebooks), axis=2)
+        scores = np.zeros([len(queries), len(codes)], dtype=np.float32)
+        for m in range(self.subspace_count):
+            scores += tables[:, m, codes[:, m]]
+        return scores
+
+
+def get_quantizer(quantization: str, subspace_count: int = 16):
+    """
+    Create the quantizer of the item embeddings
+
+    Args:
+        quantization: "none", "int8" or "pq"
+        subspace_count: Number of subspaces of the product quantization
+
+    Returns: ScalarQuantizer, ProductQuantizer or None
+
+    """
+    if quantization == "none":
+        return None
+    elif quantization == "int8":
+        return ScalarQuantizer()
+    elif quantization == "pq":
+        return ProductQuantizer(subspace_count)
+    else:
+        raise RuntimeError("Unexpected quantization " + quantization)
@@ -0,0 +1,348 @@
+import numpy as np
+import tensorflow as tf
+
+
+def _top_k(scores: np.ndarray, k: int):
+    """
+    Get the k highest scores of every row sorted in descending order
+
+    Args:
+        scores: ndarray of shape [query_count, item_count]
+        k: Number of returned scores
+
+    Returns: (positions, scores) ndarrays of shape [query_count, min(k, item_count)]
+
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros([scores.shape[0], 0], dtype=np.int64), np.zeros([scores.shape[0], 0], dtype=scores.dtype)
+    positions = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, positions, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(positions, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def _item_bias(embeddings: np.ndarray, metric: str) -> np.ndarray:
+    """
+    Get the term subtracted from the dot products, so the scores rank the items by the metric
+
+    The negative squared distance |q - x|^2 differs from 2 * (q.x - |x|^2 / 2) only by the term |q|^2, which is
+    constant for a query, so the distance search is a dot-product search with a bias.
+    """
+    if metric == "dotproduct":
+        return np.zeros(len(embeddings), dtype=np.float32)
+    elif metric == "distance":
+        return 0.5 * np.sum(np.square(embeddings, dtype=np.float32), axis=1)
+    else:
+        raise RuntimeError("Unexpected metric " + metric)
+
+
+def _finalize(indices: np.ndarray, scores: np.ndarray, k: int):
+    """Pad the results to k items, the missing items have index -1 and score -inf"""
+    valid = np.isfinite(scores)
+    indices = np.where(valid, indices, -1)
+    scores = np.where(valid, scores, -np.inf)
+    if indices.shape[1] < k:
+        padding = k - indices.shape[1]
+        indices = np.pad(indices, [(0, 0), (0, padding)], constant_values=-1)
+        scores = np.pad(scores, [(0, 0), (0, padding)], constant_values=-np.inf)
+    return indices, scores.astype(np.float32)
+
+
+def masked_outputs(model, inputs, input_categories, mask_positions):
+    """
+    Get the outputs of the encoder at the mask positions, which are used as the retrieval queries
+
+    Args:
+        model: Fashion Encoder model
+        inputs: features or images of the outfits
+        input_categories: int tensor of shape [batch_size, seq_length]
+        mask_positions: int tensor of shape [batch_size, mask_count, 1]
+
+    Returns: float32 tensor of shape [batch_size * mask_count, hidden_size]
+
+    """
+    outputs = model([inputs, input_categories, mask_positions], training=False)[0]
+    queries = tf.gather_nd(outputs, mask_positions, batch_dims=1)
+    return tf.reshape(tf.cast(queries, tf.float32), [-1, tf.shape(outputs)[-1]])
+
+
+class ExactIndex:
+    """
+    Exact search of the items with the highest scores
+
+    The items are scored by a matrix multiplication in blocks, so the memory of the scores doesn't grow with the size
+    of the catalog. Only the best k items of the processed blocks are kept.
+    """
+
+    def __init__(self, embeddings: np.ndarray, categories: np.ndarray = None, metric: str = "dotproduct",
+                 block_size: int = 65536, quantizer=None):
+        """
+        Create the index
+
+        Args:
+            embeddings: ndarray of shape [item_count, hidden_size], the items embedded by the preprocessor
+            categories: optional int ndarray of shape [item_count], required for the search within categories
+            metric: "dotproduct" or "distance"
+            block_size: Number of items scored at once
+            quantizer: optional quantizer from src.models.encoder.quantization, the index then stores only the codes
+                of the embeddings and scores them by asymmetric distance computation
+        """
+        self.categories = categories
+        self.metric = metric
+        self.block_size = block_size
+        self.quantizer = quantizer
+        if quantizer is not None:
+            quantizer.fit(embeddings)
+            self.codes = quantizer.encode(embeddings)
+        else:
+            self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            self.bias = _item_bias(self.embeddings, metric)
+
+    def __len__(self):
+        return len(self.codes) if self.quantizer is not None else len(self.embeddings)
+
+    def _block_scores(self, queries: np.ndarray, start: int, end: int) -> np.ndarray:
+        if self.quantizer is not None:
+            return self.quantizer.scores(queries, self.codes[start:end], self.metric)
+        return queries @ self.embeddings[start:end].T - self.bias[start:end]
+
+    def search(self, queries: np.ndarray, k: int, categories: np.ndarray = None):
+        """
+        Find the k items with the highest scores for every query
+
+        Args:
+            queries: ndarray of shape [query_count, hidden_size]
+            k: Number of returned items
+            categories: optional int ndarray of shape [query_count], the items are then searched only within
+                the category of the query
+
+        Returns: (indices, scores) ndarrays of shape [query_count, k] sorted by the scores, the missing items have
+            index -1
+
+        """
+        if categories is not None and self.categories is None:
+            raise RuntimeError("The search within categories requires the categories of the items")
+        queries = np.asarray(queries, dtype=np.float32)
+        best_indices = np.zeros([len(queries), 0], dtype=np.int64)
+        best_scores = np.zeros([len(queries), 0], dtype=np.float32)
+
+        for start in range(0, len(self), self.block_size):
+            end = min(start + self.block_size, len(self))
+            scores = self._block_scores(queries, start, end)
+            if categories is not None:
+                scores[categories[:, np.newaxis] != self.categories[np.newaxis, start:end]] = -np.inf
+
+            indices = np.concatenate([best_indices, np.broadcast_to(np.arange(start, end), scores.shape)], axis=1)
+            positions, best_scores = _top_k(np.concatenate([best_scores, scores], axis=1), k)
+            best_indices = np.take_along_axis(indices, positions, axis=1)
+
+        return _finalize(best_indices, best_scores, k)
+
+
+class _InvertedLists:
+    """Items of one partition of the IVFIndex clustered by k-means, the items of a list are stored contiguously"""
+
+    def __init__(self, embeddings: np.ndarray, item_ids: np.ndarray, item_categories: np.ndarray, metric: str,
+                 list_count: int, iterations: int, sample_size: int, rng):
+        centroids = kmeans(embeddings, list_count, iterations, sample_size, rng)
+        assignment = assign_clusters(embeddings, centroids)
+        order = np.argsort(assignment, kind="stable")
+
+        self.centroids = centroids
+        self.centroid_bias = _item_bias(centroids, metric)
+        self.offsets = np.searchsorted(assignment[order], np.arange(len(centroids) + 1))
+        self.embeddings = embeddings[order]
+        self.bias = _item_bias(self.embeddings, metric)
+        self.item_ids = item_ids[order]
+        self.categories = item_categories[order] if item_categories is not None else None
+
+    def search(self, queries: np.ndarray, k: int, probe_count: int, categories: np.ndarray = None):
+        """
+        Find the k items with the highest scores in the probed lists of every query
+
+        The lists are scanned one by one, every list is scored against all the queries that probe it at once.
+
+        Args:
+            queries: ndarray of shape [query_count, hidden_size]
+            k: Number of returned items
+            probe_count: Number of searched lists
+            categories: optional int ndarray of shape [query_count], the items of other categories are skipped
+
+        Returns: (item_ids, scores) ndarrays of shape [query_count, k], the missing items have score -inf
+
+        """
+        centroid_scores = queries @ self.centroids.T - self.centroid_bias
+        lists, _ = _top_k(centroid_scores, probe_count)
+
+        best_positions = np.zeros([len(queries), k], dtype=np.int64)
+        best_scores = np.full([len(queries), k], -np.inf, dtype=np.float32)
+
+        # Queries grouped by the probed lists
+        probed_lists = lists.ravel()
+        probing_queries = np.repeat(np.arange(len(queries)), lists.shape[1])
+        order = np.argsort(probed_lists, kind="stable")
+        probed_lists, probing_queries = probed_lists[order], probing_queries[order]
+        starts = np.flatnonzero(np.diff(probed_lists, prepend=-1))
+
+        for list_index, rows in zip(probed_lists[starts], np.split(probing_queries, starts[1:])):
+            start, end = self.offsets[list_index], self.offsets[list_index + 1]
+            if start == end:
+                continue
+            scores = queries[rows] @ self.embeddings[start:end].T - self.bias[start:end]
+            if categories is not None:
+                scores[categories[rows, np.newaxis] != self.categories[np.newaxis, start:end]] = -np.inf
+
+            positions = np.concatenate([best_positions[rows], np.broadcast_to(np.arange(start, end), scores.shape)],
+                                       axis=1)
+            top, best_scores[rows] = _top_k(np.concatenate([best_scores[rows], scores], axis=1), k)
+            best_positions[rows] = np.take_along_axis(positions, top, axis=1)
+
+        return self.item_ids[best_positions], best_scores
+
+
+def assign_clusters(embeddings: np.ndarray, centroids: np.ndarray, block_size: int = 65536) -> np.ndarray:
+    """Assign the vectors to the closest centroids"""
+    bias = _item_bias(centroids, "distance")
+    assignment = np.empty(len(embeddings), dtype=np.int64)
+    for start in range(0, len(embeddings), block_size):
+        scores = embeddings[start:start + block_size] @ centroids.T - bias
+        assignment[start:start + block_size] = np.argmax(scores, axis=1)
+    return assignment
+
+
+def kmeans(embeddings: np.ndarray, cluster_count: int, iterations: int, sample_size: int, rng) -> np.ndarray:
+    """
+    Cluster the vectors with k-means trained on a sample
+
+    Returns: ndarray of shape [min(cluster_count, item_count), hidden_size] with the centroids
+
+    """
+    cluster_count = min(cluster_count, len(embeddings))
+    sample = embeddings[rng.choice(len(embeddings), size=min(sample_size, len(embeddings)), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=cluster_count, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = assign_clusters(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        sizes = np.bincount(assignment, minlength=cluster_count)
+
+        # The empty clusters are moved to random vectors
+        empty = sizes == 0
+        centroids[~empty] = sums[~empty] / sizes[~empty, np.newaxis]
+        centroids[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Approximate search of the items with the highest scores by an inverted file index (IVF)
+
+    The items are clustered by k-means and only the items of the probe_count clusters with the highest scores of their
+    centroids are scored. With partitioning by categories, every category has its own clusters, so the search within
+    the category of the query scores only the items of that category.
+    """
+
+    def __init__(self, embeddings: np.ndarray, categories: np.ndarray = None, metric: str = "dotproduct",
+                 list_count: int = 1024, probe_count: int = 16, partition_by_category: bool = False,
+                 iterations: int = 10, sample_size: int = 100000, seed: int = 1):
+        """
+        Build the index
+
+        Args:
+            embeddings: ndarray of shape [item_count, hidden_size], the items embedded by the preprocessor
+            categories: optional int ndarray of shape [item_count], required for the search within categories
+            metric: "dotproduct" or "distance"
+            list_count: Number of clusters, split among the categories by their sizes with partitioning
+            probe_count: Number of clusters searched for a query
+            partition_by_category: whether every category is clustered separately
+            iterations: Number of k-means iterations
+            sample_size: Number of vectors the k-means is trained on (per partition)
+            seed: Random seed of the k-means
+        """
+        if partition_by_category and categories is None:
+            raise RuntimeError("The partitioning by categories requires the categories of the items")
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        self.item_count = len(embeddings)
+        self.categories = categories
+        self.probe_count = probe_count
+        self.partitions = {}
+
+        if partition_by_category:
+            for category in np.unique(categories):
+                item_ids = np.flatnonzero(categories == category)
+                category_lists = max(1, int(round(list_count * len(item_ids) / len(embeddings))))
+                self.partitions[int(category)] = _InvertedLists(embeddings[item_ids], item_ids, None, metric,
+                                                                category_lists, iterations, sample_size, rng)
+        else:
+            self.partitions[None] = _InvertedLists(embeddings, np.arange(len(embeddings)), categories, metric,
+                                                   list_count, iterations, sample_size, rng)
+
+    def __len__(self):
+        return self.item_count
+
+    def search(self, queries: np.ndarray, k: int, categories: np.ndarray = None, probe_count: int = None):
+        """
+        Find approximately the k items with the highest scores for every query
+
+        Args:
+            queries: ndarray of shape [query_count, hidden_size]
+            k: Number of returned items
+            categories: optional int ndarray of shape [query_count], the items are then searched only within
+                the category of the query
+            probe_count: Number of searched clusters (probe_count of the index by default)
+
+        Returns: (indices, scores) ndarrays of shape [query_count, k] sorted by the scores, the missing items have
+            index -1
+
+        """
+        if categories is not None and self.categories is None:
+            raise RuntimeError("The search within categories requires the categories of the items")
+        queries = np.asarray(queries, dtype=np.float32)
+        probe_count = probe_count or self.probe_count
+        partitioned = None not in self.partitions
+
+        if partitioned and categories is not None:
+            # The queries of a category search its partition together
+            indices = np.full([len(queries), k], -1, dtype=np.int64)
+            scores = np.full([len(queries), k], -np.inf, dtype=np.float32)
+            for category in np.unique(categories):
+                lists = self.partitions.get(int(category))
+                if lists is None:
+                    continue
+                rows = np.flatnonzero(categories == category)
+                indices[rows], scores[rows] = lists.search(queries[rows], k, probe_count)
+        elif partitioned:
+            # Without the category of the query, every partition is searched
+            results = [lists.search(queries, k, probe_count) for lists in self.partitions.values()]
+            best, scores = _top_k(np.concatenate([result[1] for result in results], axis=1), k)
+            indices = np.take_along_axis(np.concatenate([result[0] for result in results], axis=1), best, axis=1)
+        else:
+            # The items of other categories are skipped in the probed clusters, so they may leave fewer than k items
+            indices, scores = self.partitions[None].search(queries, k, probe_count, categories)
+
+        return _finalize(indices, scores, k)
+
+
+def recall_at_k(approximate: np.ndarray, exact: np.ndarray) -> float:
+    """
+    Get the fraction of the exact top-k items found by the approximate search
+
+    Args:
+        approximate: int ndarray of shape [query_count, k] with the found indices
+        exact: int ndarray of shape [query_count, k] with the indices found by the exact search
+
+    Returns: recall@k averaged over the queries
+
+    """
+    hits = 0
+    total = 0
+    for found, expected in zip(approximate, exact):
+        expected = expected[expected >= 0]
+        hits += len(np.intersect1d(found[found >= 0], expected))
+        total += len(expected)
+    return hits / total if total > 0 else 1.0
@@ -0,0 +1,140 @@
+import time
+import numpy as np
+import tensorflow as tf
+import src.models.encoder.item_embeddings as item_embeddings
+import src.models.encoder.retrieval as retrieval
+
+
+def build_inference_functions(model: tf.keras.Model, seq_length: int, candidate_count: int):
+    """
+    Create the functions converted to TFLite, the TFLite models have static shapes
+
+    Args:
+        model: Fashion Encoder created with is_train=False
+        seq_length: Length of the outfits including the blank item, shorter outfits are padded
+        candidate_count: Number of embedded items, fewer items are padded
+
+    Returns: dict with functions "complete_outfit" (inputs, categories) -> prediction at the 0th index and
+        "embed_items" (items, categories) -> embeddings
+
+    """
+    item_shape = model.inputs[0].shape[2:].as_list()
+    dtype = model.inputs[0].dtype
+    preprocessor = model.get_layer("preprocessor")
+
+    @tf.function(input_signature=[tf.TensorSpec([1, seq_length] + item_shape, dtype, name="inputs"),
+                                  tf.TensorSpec([1, seq_length], tf.int32, name="categories")])
+    def complete_outfit(inputs, categories):
+        # FITB mask token is placed at 0th index
+        mask_positions = tf.zeros([1, 1, 1], dtype=tf.int32)
+        return retrieval.masked_outputs(model, inputs, categories, mask_positions)
+
+    @tf.function(input_signature=[tf.TensorSpec([candidate_count] + item_shape, dtype, name="items"),
+                                  tf.TensorSpec([candidate_count], tf.int32, name="categories")])
+    def embed_items(items, categories):
+        return tf.cast(item_embeddings.embed_items(preprocessor, items, categories), tf.float32)
+
+    return {"complete_outfit": complete_outfit, "embed_items": embed_items}
+
+
+def convert(function, model: tf.keras.Model, representative_dataset=None) -> bytes:
+    """
+    Convert the function to a TFLite model
+
+    Args:
+        function: tf.function with an input signature from build_inference_functions
+        model: model whose variables are used by the function
+        representative_dataset: optional callable returning an iterable of input lists, the weights and
+            the activations are then quantized to int8 (the ops without int8 kernels stay in float32)
+
+    Returns: serialized TFLite model
+
+    """
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([function.get_concrete_function()], model)
+    if representative_dataset is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+    return converter.convert()
+
+
+class TFLiteRunner:
+    """Runs a TFLite model with a single output"""
+
+    def __init__(self, model_content: bytes, num_threads: int = None):
+        self.interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._inputs = [detail["index"] for detail in self.interpreter.get_input_details()]
+        self._output = self.interpreter.get_output_details()[0]["index"]
+
+    def __call__(self, *inputs):
+        # The inputs are ordered by the input signature
+        for index, value in zip(self._inputs, inputs):
+            self.interpreter.set_tensor(index, value)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output)
+
+
+def pad(values: np.ndarray, categories: np.ndarray, length: int):
+    """
+    Pad the items to the static length of the TFLite model, the padded items have category 0
+
+    Returns: (values, categories) or None if there are more than length items
+
+    """
+    if len(categories) > length:
+        return None
+    padding = length - len(categories)
+    values = np.pad(values, [(0, padding)] + [(0, 0)] * (values.ndim - 1))
+    categories = np.pad(categories, [(0, padding)])
+    return values, categories
+
+
+def fitb_correct(prediction: np.ndarray, candidates: np.ndarray, candidate_categories: np.ndarray,
+                 target_position: int, metric: str) -> bool:
+    """Whether the correct candidate is the most similar one to the prediction, the padded candidates are ignored"""
+    if metric == "dotproduct":
+        scores = candidates @ prediction
+    else:
+        scores = -np.linalg.norm(candidates - prediction, axis=-1)
+    scores = np.where(candidate_categories != 0, scores, -np.inf)
+    return int(np.argmax(scores)) == target_position
+
+
+def evaluate_fitb(complete_outfit, embed_items, questions, seq_length: int, candidate_count: int, metric: str):
+    """
+    Evaluate the FITB task with the inference functions
+
+    Args:
+        complete_outfit: callable (inputs, categories) -> prediction, e.g. TFLiteRunner
+        embed_items: callable (items, categories) -> embeddings
+        questions: iterable of FITB questions (inputs, input_categories, targets, target_categories,
+            target_position) as ndarrays without the batch dimension
+        seq_length: Static length of the outfits
+        candidate_count: Static number of the candidates
+        metric: "dotproduct" or "distance"
+
+    Returns: dict with the accuracy, the mean latency per question in milliseconds and the number of questions
+
+    """
+    correct = 0
+    count = 0
+    elapsed = 0.
+    for inputs, input_categories, targets, target_categories, target_position in questions:
+        outfit = pad(inputs, input_categories, seq_length)
+        candidates = pad(targets, target_categories, candidate_count)
+        if outfit is None or candidates is None:
+            continue
+
+        start = time.perf_counter()
+        prediction = complete_outfit(outfit[0][np.newaxis], outfit[1][np.newaxis].astype(np.int32))
+        embedded = embed_items(candidates[0], candidates[1].astype(np.int32))
+        elapsed += time.perf_counter() - start
+
+        correct += fitb_correct(np.reshape(prediction, [-1]), embedded, candidates[1], int(target_position), metric)
+        count += 1
+
+    return {
+        "accuracy": correct / count if count > 0 else 0.,
+        "latency_ms": elapsed / count * 1000 if count > 0 else 0.,
+        "questions": count
+    }
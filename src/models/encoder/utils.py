@@ -3,6 +3,25 @@ import csv
 import tensorflow as tf
 
 _NEG_INF_FP32 = -1e9
+_NEG_INF_FP16 = tf.float16.min
+
+# High-level category groups of Maryland Polyvore
+MP_CATEGORY_GROUPS = {
+    "top": [11, 15, 17, 18, 19, 21, 343, 104, 236, 247, 252, 272, 273, 275, 286, 309, 342, 4454, 4495, 4496, 4497,
+            4498, 341],
+    "bottom": [7, 8, 9, 10, 27, 28, 29, 237, 238, 239, 240, 241, 253, 254, 255, 278, 279, 280, 287, 288,
+               310, 4458, 4459],
+    "shoes": [41, 42, 43, 46, 47, 48, 49, 50, 261, 262, 263, 264, 265, 266, 267, 268, 291, 292, 293, 294, 295, 296,
+              297, 298, 4464, 4465, 4522],
+    "accessories": [35, 36, 37, 38, 39, 40, 51, 52, 53, 55, 56, 57, 58, 59, 105, 231, 258, 259, 260, 270,
+                    290, 299, 300, 301, 302, 303, 304, 306, 4428, 4426, 4447, 4461, 4462, 4463, 4468, 4470, 4472,
+                    4473, 4474, 4520, 4521, ],
+    "jewelry": [60, 61, 62, 64, 65, 67, 106, 107, 305, 307, 4466, 4467, 4523, 4524, 4525, ],
+    "other-wearable": [2, 31, 33, 68, 69, 71, 85, 108, 245, 246, 248, 249, 251, 257, 271, 282, 283, 284, 285,
+                       4460, 4517, 4518, 1605, 1606],
+    "full": [3, 4, 5, 6, 30, 75, 243, 244, 250, 281, 4516],
+    "outerwear": [23, 24, 25, 26, 256, 276, 277, 289, 4455, 4456, 4457, ]
+}
 
 
 def build_po_category_lookup_table(categories_file_path: str) -> tf.lookup.StaticHashTable:
@@ -37,22 +56,7 @@ def build_mp_category_lookup_table() -> tf.lookup.StaticHashTable:
     Returns: tf.lookup.StaticHashTable
 
     """
-    categories = {
-        "top": [11, 15, 17, 18, 19, 21, 343, 104, 236, 247, 252, 272, 273, 275, 286, 309, 342, 4454, 4495, 4496, 4497,
-                4498, 341],
-        "bottom": [7, 8, 9, 10, 27, 28, 29, 237, 238, 239, 240, 241, 253, 254, 255, 278, 279, 280, 287, 288,
-                   310, 4458, 4459],
-        "shoes": [41, 42, 43, 46, 47, 48, 49, 50, 261, 262, 263, 264, 265, 266, 267, 268, 291, 292, 293, 294, 295, 296,
-                  297, 298, 4464, 4465, 4522],
-        "accessories": [35, 36, 37, 38, 39, 40, 51, 52, 53, 55, 56, 57, 58, 59, 105, 231, 258, 259, 260, 270,
-                        290, 299, 300, 301, 302, 303, 304, 306, 4428, 4426, 4447, 4461, 4462, 4463, 4468, 4470, 4472,
-                        4473, 4474, 4520, 4521, ],
-        "jewelry": [60, 61, 62, 64, 65, 67, 106, 107, 305, 307, 4466, 4467, 4523, 4524, 4525, ],
-        "other-wearable": [2, 31, 33, 68, 69, 71, 85, 108, 245, 246, 248, 249, 251, 257, 271, 282, 283, 284, 285,
-                           4460, 4517, 4518, 1605, 1606],
-        "full": [3, 4, 5, 6, 30, 75, 243, 244, 250, 281, 4516],
-        "outerwear": [23, 24, 25, 26, 256, 276, 277, 289, 4455, 4456, 4457, ]
-    }
+    categories = MP_CATEGORY_GROUPS
 
     keys = []
     values = []
@@ -70,25 +74,21 @@ def build_mp_category_lookup_table() -> tf.lookup.StaticHashTable:
 
 def compute_padding_mask_from_categories(categories):
     """
-    Get padding mask matrix
+    Get padding mask of the flattened items
+
+    The mask is meant to be applied with tf.where to tensors of shape [batch_size*sequence_length, dim]
 
     Args:
         categories: Tensor of shape [batch_size, sequence_length],
 
     Returns:
-        Matrix of shape [batch_size*sequence_length, batch_size*sequence_length] with zeroes except for diagonal.
-            There's 0 on the diagonal if the corresponding item should be masked
-            There's 1 on the diagonal if the corresponding item should not be masked
+        Bool tensor of shape [batch_size*sequence_length, 1]
+            False if the corresponding item should be masked
+            True if the corresponding item should not be masked
     """
-    # Compute padding mask
-    unpacked_categories = tf.reshape(categories, shape=[-1])
-    unpacked_length = tf.shape(unpacked_categories)[0]
-    padding_mask = tf.equal(unpacked_categories, 0)
+    unpacked_categories = tf.reshape(categories, shape=[-1, 1])
     # Category 0 is considered as masked - category embedding is not applied
-    padding_mask = tf.math.logical_not(padding_mask)
-    padding_mask = tf.cast(padding_mask, dtype="float32")
-    mask_matrix = tf.zeros(shape=(unpacked_length, unpacked_length))
-    return tf.linalg.set_diag(mask_matrix, padding_mask)
+    return tf.not_equal(unpacked_categories, 0)
 
 
 def place_tensor_on_positions(inputs, updates, positions, repeat=True):
@@ -140,20 +140,13 @@ def get_category_embedding(categories, embedding_layer, padding_emb_value):
     embedded_categories = embedding_layer(flat_categories)
     embedded_categories = tf.squeeze(embedded_categories, axis=1)
 
-    # Apply mask so the category embedding is zero at padded positions
-    mask_matrix = compute_padding_mask_from_categories(categories)
-    embedded_categories = tf.einsum("ij,jk->ik", mask_matrix, embedded_categories)
-
+    # Apply mask so the category embedding is zero (or one) at padded positions
+    mask = compute_padding_mask_from_categories(categories)
     if padding_emb_value == "ones":
-        ones_tensor = tf.ones_like(embedded_categories)
-        # Place ones to the at the padded position
-        inverted_mask = tf.reduce_sum(mask_matrix, axis=1)
-        inverted_mask = tf.cast(inverted_mask, dtype="bool")
-        inverted_mask = tf.logical_not(inverted_mask)
-        inverted_mask = tf.cast(inverted_mask, dtype="float32")
-        inverted_mask_matrix = tf.linalg.set_diag(mask_matrix, inverted_mask)
-        ones_tensor = tf.einsum("ij,jk->ik", inverted_mask_matrix, ones_tensor)
-        embedded_categories = tf.add(ones_tensor, embedded_categories)
+        padding_values = tf.ones_like(embedded_categories)
+    else:
+        padding_values = tf.zeros_like(embedded_categories)
+    embedded_categories = tf.where(mask, embedded_categories, padding_values)
 
     batch_size = tf.shape(categories)[0]
     seq_length = tf.shape(categories)[1]
@@ -222,6 +215,49 @@ class EarlyStoppingMonitor:
             return True
 
 
+class CompileCacheMonitor:
+    """
+    Class that counts hits and misses of the compile cache of a function compiled with XLA
+
+    XLA compiles a program for every combination of the input shapes, so the first call with a signature of
+    the shapes (e.g. a new batch size, sequence length or candidate count) is a miss and the following calls
+    with the same signature are hits. The counters are updated in the graph.
+    """
+
+    def __init__(self, name: str):
+        """
+        Initialize CompileCacheMonitor
+        Args:
+            name: Name of the monitored function
+        """
+        self.name = name
+        # Fingerprints of the seen shape signatures
+        self.seen = tf.lookup.experimental.MutableHashTable(tf.int64, tf.int64, default_value=0)
+        self.hits = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.misses = tf.Variable(0, dtype=tf.int64, trainable=False)
+
+    def update(self, *inputs):
+        """
+        Count a call of the function
+
+        Args:
+            *inputs: input tensors of the call, their ranks and shapes form the signature
+        """
+        signature = tf.concat([tf.concat([[tf.rank(tensor)], tf.shape(tensor)], axis=0)
+                               for tensor in tf.nest.flatten(inputs)], axis=0)
+        key = tf.bitcast(tf.fingerprint(tf.expand_dims(tf.cast(signature, tf.int64), 0)), tf.int64)
+        seen = self.seen.lookup(key)[0]
+        self.hits.assign_add(seen)
+        self.misses.assign_add(1 - seen)
+        self.seen.insert(key, tf.ones_like(key))
+
+    def result(self) -> dict:
+        """
+        Returns: dict with the number of hits and misses
+        """
+        return {"hits": int(self.hits.numpy()), "misses": int(self.misses.numpy())}
+
+
 def str_to_bool(v: str) -> bool:
     if isinstance(v, bool):
         return v
@@ -233,6 +269,20 @@ def str_to_bool(v: str) -> bool:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
+def get_neg_inf(dtype=tf.float32):
+    """Return a large negative number that is representable in the dtype.
+
+    Args:
+      dtype: The dtype of the tensor the number is added to
+
+    Returns:
+      -1e9 for float32 and bfloat16, the minimum of float16 for float16
+    """
+    if tf.as_dtype(dtype) == tf.float16:
+        return _NEG_INF_FP16
+    return _NEG_INF_FP32
+
+
 def get_padding(x, padding_value=0, dtype=tf.float32):
     """Return float tensor representing the padding values in x.
     Implementation from Tensorflow Official Models
@@ -257,6 +307,7 @@ def get_padding_bias(x, padding_value=0, dtype=tf.float32):
     Bias tensor that is added to the pre-softmax multi-headed attention logits,
     which has shape [batch_size, num_heads, length, length]. The tensor is zero at
     non-padding locations, and -1e9 (negative infinity) at padding locations.
+    The minimum of float16 is used instead of -1e9 for float16.
 
     Args:
       x: int tensor with shape [batch_size, length]
@@ -268,7 +319,7 @@ def get_padding_bias(x, padding_value=0, dtype=tf.float32):
     """
     with tf.name_scope("attention_bias"):
         padding = get_padding(x, padding_value, dtype)
-        attention_bias = padding * _NEG_INF_FP32
+        attention_bias = padding * get_neg_inf(dtype)
         attention_bias = tf.expand_dims(
             tf.expand_dims(attention_bias, axis=1), axis=1)
     return attention_bias